@@ -1,36 +1,64 @@
-import csv
-from collections import defaultdict
 from pathlib import Path
 
 import matplotlib.pyplot as plt
 import numpy as np
 from rich import print
 
+from ledger import LEDGER_FILENAME
+from rollups import monthly_table
+from txn_frame import load_frame, series
+
 MASTER_GRAB_CSV = "output/master_grab.csv"
 OUT_DIR = Path("output")
-
-
-def plot_monthly_spending(file_path):
-    # Open the CSV file and read data into a list of dictionaries
-    with open(file_path, newline="") as csvfile:
-        reader = csv.DictReader(csvfile)
-        transactions = list(reader)
-
-    # Process data
-    monthly_spend = defaultdict(lambda: defaultdict(float))
-    for txn in transactions:
-        if txn["txn_date"]:  # check if date exists
-            year_month = txn["txn_date"][:7]  # Extract Year-Month
-            txn_type = txn["txn_type"]
-            amount = float(txn["txn_amount"])
-            monthly_spend[year_month][txn_type] += amount
-
-    # Prepare data for plotting
-    months = sorted(monthly_spend.keys())
-    transport_spends = [
-        monthly_spend[month].get("Grab Transport", 0) for month in months
-    ]
-    food_spends = [monthly_spend[month].get("Grab Food", 0) for month in months]
+LEDGER_DB = OUT_DIR / LEDGER_FILENAME
+
+TRANSPORT_COLOR = "#1D263B"
+FOOD_COLOR = "#4CB963"
+
+
+def monthly_grab_spending(file_path):
+    """
+    Monthly Grab Transport / Grab Food spend and ride / order counts
+
+    Args:
+        file_path: master_grab.csv, master_grab.json or the ledger database
+
+    Returns:
+        months, transport_spends, food_spends, transport_times, food_times
+    """
+    if str(file_path).endswith(".db"):
+        # the ledger keeps monthly rollups, no need to touch transactions
+        months, types, sums, counts = monthly_table(provider="grab", db_path=file_path)
+    else:
+        frame = load_frame(file_path, provider="grab")
+        months, types, sums = frame.monthly_sum_by_type()
+        _, _, counts = frame.monthly_count_by_type()
+    return (
+        months,
+        series(types, sums, "Grab Transport"),
+        series(types, sums, "Grab Food"),
+        series(types, counts, "Grab Transport"),
+        series(types, counts, "Grab Food"),
+    )
+
+
+def _show_or_save(fig, save_path=None):
+    """
+    Show the figure, or save it if `save_path` is given, then close it: under
+    a non-interactive backend (e.g. Agg in `render_charts`) `plt.show()` does
+    nothing, and an unclosed figure would stay in memory
+    """
+    try:
+        if save_path is None:
+            plt.show()
+        else:
+            plt.savefig(save_path)
+    finally:
+        plt.close(fig)
+
+
+def plot_monthly_spending(file_path, save_path=None):
+    months, transport_spends, food_spends, _, _ = monthly_grab_spending(file_path)
 
     # Plotting
     fig, ax = plt.subplots()
@@ -47,30 +75,11 @@ def plot_monthly_spending(file_path):
 
     plt.xticks(rotation=45)
     plt.tight_layout()
-    plt.show()
-
-
-def plot_stacked_monthly_spending(file_path):
-    # Open the CSV file and read data into a list of dictionaries
-    with open(file_path, newline="") as csvfile:
-        reader = csv.DictReader(csvfile)
-        transactions = list(reader)
-
-    # Process data
-    monthly_spend = defaultdict(lambda: defaultdict(float))
-    for txn in transactions:
-        if txn["txn_date"]:  # Check if date exists
-            year_month = txn["txn_date"][:7]  # Extract Year-Month
-            txn_type = txn["txn_type"]
-            amount = float(txn["txn_amount"])
-            monthly_spend[year_month][txn_type] += amount
-
-    # Prepare data for plotting
-    months = sorted(monthly_spend.keys())
-    transport_spends = [
-        monthly_spend[month].get("Grab Transport", 0) for month in months
-    ]
-    food_spends = [monthly_spend[month].get("Grab Food", 0) for month in months]
+    _show_or_save(fig, save_path)
+
+
+def plot_stacked_monthly_spending(file_path, save_path=None):
+    months, transport_spends, food_spends, _, _ = monthly_grab_spending(file_path)
 
     # Plotting
     fig, ax = plt.subplots()
@@ -83,46 +92,27 @@ def plot_stacked_monthly_spending(file_path):
 
     plt.xticks(rotation=45)
     plt.tight_layout()
-    plt.show()
+    _show_or_save(fig, save_path)
 
 
 def plot_and_save_spending_charts(file_path):
     OUT_DIR.mkdir(exist_ok=True)  # Create the directory if it does not exist
 
-    # Open the CSV file and read data into a list of dictionaries
-    with open(file_path, newline="") as csvfile:
-        reader = csv.DictReader(csvfile)
-        transactions = list(reader)
-
-    # Process data
-    monthly_spend = defaultdict(lambda: defaultdict(float))
-    monthly_transport_times = defaultdict(int)
-    monthly_food_times = defaultdict(int)
-
-    for txn in transactions:
-        if txn["txn_date"]:  # Check if date exists
-            year_month = txn["txn_date"][:7]  # Extract Year-Month
-            txn_type = txn["txn_type"]
-            amount = float(txn["txn_amount"])
-            monthly_spend[year_month][txn_type] += amount
-            if txn_type == "Grab Transport":
-                monthly_transport_times[year_month] += 1
-            elif txn_type == "Grab Food":
-                monthly_food_times[year_month] += 1
-
-    # Prepare data for plotting
-    months = sorted(monthly_spend.keys())
-    transport_spends = [
-        monthly_spend[month].get("Grab Transport", 0) for month in months
-    ]
-    food_spends = [monthly_spend[month].get("Grab Food", 0) for month in months]
+    (
+        months,
+        transport_spends,
+        food_spends,
+        monthly_transport_times,
+        monthly_food_times,
+    ) = monthly_grab_spending(file_path)
 
     ###########################################################################
     ### Analysis for Grab Transport
 
-    for month in months[-6:]:
-        _total = transport_spends[months.index(month)]
-        _times = monthly_transport_times[month]
+    for i in range(max(len(months) - 6, 0), len(months)):
+        month = months[i]
+        _total = transport_spends[i]
+        _times = monthly_transport_times[i]
         if _times == 0:
             continue
         print(
@@ -132,39 +122,36 @@ def plot_and_save_spending_charts(file_path):
     ###########################################################################
     ### Plotting for Grab Transport
 
-    # make it 16:9 aspect ratio
-    fig, ax = plt.subplots(figsize=(21, 9))
-    transport_color = "#1D263B"
-    ax.bar(months, transport_spends, color=transport_color)
-    ax.set_ylabel("Amount Spent (SGD)")
-    ax.set_title("Monthly Spending on Grab Transport")
-    # Set the tick positions
-    ax.set_xticks(range(len(months)))
-    # Set the tick labels
-    ax.set_xticklabels(months, rotation=45)
-    # add horizontal grid lines
-    ax.yaxis.grid(True)
-    # add polynomial trend line
-    z = np.polyfit(range(len(months)), transport_spends, 15)
-    p = np.poly1d(z)
-    ax.plot(months, p(range(len(months))), "r--")
-    # label each bar with the amount
-    for i, v in enumerate(transport_spends):
-        ax.text(i, v + 5, f"{v:.2f}", color=transport_color, ha="center")
-    plt.tight_layout()
-    plt.savefig(
-        OUT_DIR / "grab_transport_spending.png"
-    )  # Save the figure as an image file
-    plt.close(fig)  # Close the figure to free up memory
+    draw_monthly_spending_chart(
+        months,
+        transport_spends,
+        title="Monthly Spending on Grab Transport",
+        color=TRANSPORT_COLOR,
+        save_path=OUT_DIR / "grab_transport_spending.png",
+    )
 
     ###########################################################################
     ### Plotting for Grab Food
 
+    draw_monthly_spending_chart(
+        months,
+        food_spends,
+        title="Monthly Spending on Grab Food",
+        color=FOOD_COLOR,
+        save_path=OUT_DIR / "grab_food_spending.png",
+    )
+
+
+def draw_monthly_spending_chart(months, spends, title, color, save_path):
+    """
+    Draw a 21:9 monthly bar chart with a polynomial trend line and save it as PNG.
+    Only depends on the plotted series, so it can run in a separate process.
+    """
+    # make it 16:9 aspect ratio
     fig, ax = plt.subplots(figsize=(21, 9))
-    food_color = "#4CB963"
-    ax.bar(months, food_spends, color=food_color)
+    ax.bar(months, spends, color=color)
     ax.set_ylabel("Amount Spent (SGD)")
-    ax.set_title("Monthly Spending on Grab Food")
+    ax.set_title(title)
     # Set the tick positions
     ax.set_xticks(range(len(months)))
     # Set the tick labels
@@ -172,14 +159,14 @@ def plot_and_save_spending_charts(file_path):
     # add horizontal grid lines
     ax.yaxis.grid(True)
     # add polynomial trend line
-    z = np.polyfit(range(len(months)), food_spends, 15)
+    z = np.polyfit(range(len(months)), spends, 15)
     p = np.poly1d(z)
     ax.plot(months, p(range(len(months))), "r--")
     # label each bar with the amount
-    for i, v in enumerate(food_spends):
-        ax.text(i, v + 5, f"{v:.2f}", color=food_color, ha="center")
+    for i, v in enumerate(spends):
+        ax.text(i, v + 5, f"{v:.2f}", color=color, ha="center")
     plt.tight_layout()
-    plt.savefig(OUT_DIR / "grab_food_spending.png")  # Save the figure as an image file
+    plt.savefig(save_path)  # Save the figure as an image file
     plt.close(fig)  # Close the figure to free up memory
 
 
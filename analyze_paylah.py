@@ -1,67 +1,138 @@
-import csv
-import json
-from collections import defaultdict
 from pathlib import Path
 
 import matplotlib.pyplot as plt
 import numpy as np
 from rich import print
 
+from ledger import LEDGER_FILENAME, query_transactions
+from online_stats import SpendStatsEngine
+from rollups import monthly_table
+from txn_frame import load_frame
+
 OUT_DIR = Path("output")
 MASTER_PAYLAH_JSON = OUT_DIR / "master_paylah.json"
-assert MASTER_PAYLAH_JSON.exists(), "Master PayLah JSON file not found"
+LEDGER_DB = OUT_DIR / LEDGER_FILENAME
+
+
+def load_paylah_frame(use_ledger: bool = False):
+    """
+    Load PayLah transactions either from master_paylah.json or from the ledger database
+    """
+    if not (MASTER_PAYLAH_JSON.exists() or LEDGER_DB.exists()):
+        raise FileNotFoundError(
+            "Neither master PayLah JSON file nor ledger database found"
+        )
+    if use_ledger:
+        return load_frame(LEDGER_DB, provider="paylah")
+    return load_frame(MASTER_PAYLAH_JSON)
 
 
-def stats_on_paylah_transactions():
-    with open(MASTER_PAYLAH_JSON) as jsonfile:
-        transactions = json.load(jsonfile)
+def stats_on_paylah_transactions(use_ledger: bool = False, use_online_stats=False):
+    if use_online_stats:
+        return online_stats_on_paylah_transactions()
 
-    txn_count = len(transactions)
-    total_spent = sum(float(txn["txn_amount"]) for txn in transactions)
-    median_spent = np.median([float(txn["txn_amount"]) for txn in transactions])
+    frame = load_paylah_frame(use_ledger)
+    amounts = frame.amounts
+
+    txn_count = len(frame)
+    total_spent = amounts.sum()
+    median_spent = np.median(amounts)
     avg_spent = total_spent / txn_count
-    std = np.std([float(txn["txn_amount"]) for txn in transactions])
+    std = amounts.std()
 
     large_amount_threshold = avg_spent + std
 
-    unique_txn_to = set(txn["txn_to"] for txn in transactions)
-    unique_txn_to = sorted(list(unique_txn_to))
-
     print(f"Total number of transactions: {txn_count}")
     print(f"Total amount spent: ${total_spent:.2f}")
     print(f"Average amount spent per transaction: ${avg_spent:.2f}")
     print(f"Median amount spent per transaction: ${median_spent:.2f}")
     print(f"Standard deviation of amount spent: {std:.2f}")
 
-    for txn in transactions:
-        if float(txn["txn_amount"]) > large_amount_threshold:
-            print(
-                f"[bold red]Large transaction[/bold red]: ${txn['txn_amount']} to {txn['txn_to']} on {txn['txn_date']}"
-            )
-
-
-def plot_monthly_spending():
-    with open(MASTER_PAYLAH_JSON) as jsonfile:
-        transactions = json.load(jsonfile)
+    by_category = frame.sum_by_category()
+    for category, total in sorted(by_category.items(), key=lambda x: -x[1]):
+        print(f"  {category or 'Uncategorized'}: ${total:.2f}")
+
+    for i in np.flatnonzero(amounts > large_amount_threshold):
+        txn = frame.row(i)
+        print(
+            f"[bold red]Large transaction[/bold red]: ${txn['txn_amount']} to {txn['txn_to']} on {txn['txn_date']}"
+        )
+
+
+def online_stats_on_paylah_transactions():
+    """
+    Same report as `stats_on_paylah_transactions`, but read from the running
+    statistics maintained by the parsers, so no transaction history is loaded.
+    Only the large transactions are fetched, through the ledger amount index.
+    """
+    engine = SpendStatsEngine.for_ledger(OUT_DIR)
+    stats = engine.get(SpendStatsEngine.provider_key("paylah"))
+    moments = stats.moments
+    if not moments.count:
+        raise RuntimeError("No online PayLah statistics found, run the parser first")
+
+    large_amount_threshold = moments.mean + moments.std
+
+    print(f"Total number of transactions: {moments.count}")
+    print(f"Total amount spent: ${moments.total:.2f}")
+    print(f"Average amount spent per transaction: ${moments.mean:.2f}")
+    print(f"Median amount spent per transaction: ${stats.sketch.quantile(0.5):.2f}")
+    print(f"Standard deviation of amount spent: {moments.std:.2f}")
+
+    large_txns = query_transactions(
+        provider="paylah", min_amount=large_amount_threshold, db_path=LEDGER_DB
+    )
+    for txn in large_txns:
+        print(
+            f"[bold red]Large transaction[/bold red]: ${txn['txn_amount']:.2f} to {txn['txn_to']} on {txn['txn_date']}"
+        )
+
+
+def monthly_paylah_spending(use_ledger: bool = False):
+    """
+    Monthly PayLah spend per txn_type
+
+    Returns:
+        months, types, monthly_spend and monthly_counts of shape (len(types), len(months))
+    """
+    if use_ledger:
+        # read the materialized monthly rollup instead of all transactions
+        return monthly_table(provider="paylah", db_path=LEDGER_DB)
+    frame = load_paylah_frame()
+    months, types, monthly_spend = frame.monthly_sum_by_type()
+    _, _, monthly_counts = frame.monthly_count_by_type()
+    return months, types, monthly_spend, monthly_counts
+
+
+def plot_monthly_spending(use_ledger: bool = False):
+    months, types, monthly_spend, monthly_counts = monthly_paylah_spending(use_ledger)
+    draw_paylah_monthly_chart(
+        months,
+        types,
+        monthly_spend,
+        monthly_counts,
+        save_path=OUT_DIR / "paylah_monthly_spending.png",
+    )
 
-    monthly_spend = defaultdict(lambda: defaultdict(float))
-    for txn in transactions:
-        if txn["txn_date"]:
-            year_month = txn["txn_date"][:7]
-            txn_type = txn["txn_type"]
-            amount = float(txn["txn_amount"])
-            monthly_spend[year_month][txn_type] += amount
 
-    months = sorted(monthly_spend.keys())
+def draw_paylah_monthly_chart(months, types, monthly_spend, monthly_counts, save_path):
+    """
+    Draw the monthly PayLah chart and save it as PNG.
+    Only depends on the plotted series, so it can run in a separate process.
+    """
+    monthly_spend = np.asarray(monthly_spend)
+    monthly_counts = np.asarray(monthly_counts)
+    monthly_totals = monthly_spend.sum(axis=0)
 
     # plot monthly spending
     fig, ax = plt.subplots(figsize=(21, 9))
     width = 0.5
-    x = range(len(months))
-    for txn_type in monthly_spend[months[0]]:
-        spends = [monthly_spend[month].get(txn_type, 0) for month in months]
-        ax.bar(x, spends, width, label=txn_type)
-        x = [p + width for p in x]
+    x = np.arange(len(months))
+    for type_idx, txn_type in enumerate(types):
+        if not monthly_counts[type_idx, 0]:
+            continue  # only types present in the first month, as before
+        ax.bar(x, monthly_spend[type_idx], width, label=txn_type)
+        x = x + width
 
     ax.set_ylabel("Total Amount Spent")
     ax.set_title("Monthly Spending on PayLah")
@@ -72,20 +143,18 @@ def plot_monthly_spending():
     # add horizontal grid lines
     ax.yaxis.grid(True)
     # add polynomial trend line
-    z = np.polyfit(
-        range(len(months)), [sum(monthly_spend[month].values()) for month in months], 10
-    )
+    z = np.polyfit(range(len(months)), monthly_totals, 10)
     p = np.poly1d(z)
     ax.plot(months, p(range(len(months))), "r--")
     # label each bar with the total amount spent
-    for i, month in enumerate(months):
-        total_spent = sum(monthly_spend[month].values())
+    for i, total_spent in enumerate(monthly_totals):
         ax.text(i, total_spent, f"${total_spent:.2f}", ha="center", va="bottom")
 
     plt.xticks(rotation=45)
     plt.tight_layout()
     # save the plot as an image
-    plt.savefig(OUT_DIR / "paylah_monthly_spending.png")
+    plt.savefig(save_path)
+    plt.close(fig)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,51 @@
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+TMP_SUFFIX = ".tmp"
+
+
+def tmp_path_for(path: Path) -> Path:
+    """
+    Hidden temporary sibling of `path`, unique per process and thread. It does
+    not end with `.json` / `.csv`, so directory scans never pick it up.
+    """
+    path = Path(path)
+    return path.with_name(
+        f".{path.name}.{os.getpid()}.{threading.get_ident()}{TMP_SUFFIX}"
+    )
+
+
+@contextmanager
+def atomic_write(path: Path, mode: str = "w", fsync: bool = False, **open_kwargs):
+    """
+    Open a temporary file for writing and rename it over `path` on success.
+
+    Readers and crashed runs only ever see the old or the complete new file,
+    never a truncated one. On error the temporary file is removed and `path`
+    is left untouched.
+
+    Args:
+        path: final path of the file
+        mode: "w" or "wb"
+        fsync: also flush the data to disk before the rename, to survive a
+            power loss and not only a process crash
+    """
+    path = Path(path)
+    tmp_path = tmp_path_for(path)
+    try:
+        with open(tmp_path, mode, **open_kwargs) as f:
+            yield f
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+def atomic_write_text(path: Path, text: str, fsync: bool = False):
+    with atomic_write(path, "w", fsync=fsync) as f:
+        f.write(text)
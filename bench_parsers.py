@@ -0,0 +1,186 @@
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from rich import print
+
+from gmail_export import get_msg_body
+from parser_fave import parse_fave_html
+from parser_grab import clean_html_styles, get_pure_string, parse_grab_html
+from parser_paylah import parse_paylah_html
+from synthetic_receipts import make_corpus, make_gmail_message
+
+BENCH_DIR = Path("bench_results")
+BASELINE_FILENAME = "baseline.json"
+DEFAULT_THRESHOLD = 0.10  # allowed slowdown before a benchmark counts as a regression
+
+
+def _corpora(n: int, seed: int) -> Dict[str, List]:
+    paylah = make_corpus("paylah", n, seed=seed)
+    fave = make_corpus("fave", n, seed=seed)
+    grab = make_corpus("grab", n, seed=seed)
+    messages = [
+        make_gmail_message(html, f"m{i}", multipart=i % 2 == 0)
+        for i, html in enumerate(paylah)
+    ]
+    return {"paylah": paylah, "fave": fave, "grab": grab, "messages": messages}
+
+
+def _benchmarks(corpora: Dict[str, List]) -> Dict[str, tuple]:
+    """name -> (function, inputs, size of each input in bytes)"""
+
+    def sizes(htmls):
+        return [len(h.encode("utf-8")) for h in htmls]
+
+    return {
+        "parse_paylah_html": (parse_paylah_html, corpora["paylah"], sizes(corpora["paylah"])),
+        "parse_fave_html": (parse_fave_html, corpora["fave"], sizes(corpora["fave"])),
+        "parse_grab_html": (parse_grab_html, corpora["grab"], sizes(corpora["grab"])),
+        "get_pure_string": (get_pure_string, corpora["grab"], sizes(corpora["grab"])),
+        "clean_html_styles": (clean_html_styles, corpora["grab"], sizes(corpora["grab"])),
+        "get_msg_body": (
+            get_msg_body,
+            corpora["messages"],
+            [m["sizeEstimate"] for m in corpora["messages"]],
+        ),
+    }
+
+
+def _run_once(func: Callable, inputs: list) -> float:
+    start = time.perf_counter()
+    for item in inputs:
+        func(item)
+    return time.perf_counter() - start
+
+
+def run_benchmark(func: Callable, inputs: list, input_sizes: list, repeat: int) -> dict:
+    """
+    Time `func` over the whole corpus `repeat` times (best run wins), then run
+    it once more under tracemalloc to measure allocations
+    """
+    # parsers report malformed receipts on stdout, keep the benchmark output clean
+    with contextlib.redirect_stdout(io.StringIO()):
+        _run_once(func, inputs[: max(1, len(inputs) // 10)])  # warm-up
+        best = min(_run_once(func, inputs) for _ in range(repeat))
+
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+        before = tracemalloc.take_snapshot()
+        for item in inputs:
+            func(item)
+        after = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    diff = after.compare_to(before, "filename")
+    n = len(inputs)
+    total_mb = sum(input_sizes) / 1e6
+    return {
+        "emails": n,
+        "megabytes": round(total_mb, 3),
+        "seconds": round(best, 6),
+        "emails_per_sec": round(n / best, 2),
+        "mb_per_sec": round(total_mb / best, 3),
+        "peak_alloc_kb": round(peak / 1024, 1),
+        "retained_blocks": sum(stat.count_diff for stat in diff),
+    }
+
+
+def run_suite(n: int = 200, repeat: int = 3, seed: int = 0, only: List[str] = None) -> dict:
+    benchmarks = _benchmarks(_corpora(n, seed))
+    results = {}
+    for name, (func, inputs, input_sizes) in benchmarks.items():
+        if only and name not in only:
+            continue
+        results[name] = run_benchmark(func, inputs, input_sizes, repeat)
+        r = results[name]
+        print(
+            f"{name:<20} {r['emails_per_sec']:>10.1f} emails/s {r['mb_per_sec']:>8.2f} MB/s "
+            f"peak {r['peak_alloc_kb']:>9.1f} KB"
+        )
+    return {
+        "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "params": {"n": n, "repeat": repeat, "seed": seed},
+        "results": results,
+    }
+
+
+def compare_to_baseline(
+    run: dict, baseline: dict, threshold: float, per_benchmark: Dict[str, float]
+) -> List[str]:
+    """
+    Returns:
+        Names of the benchmarks whose throughput dropped by more than their threshold
+    """
+    regressions = []
+    for name, result in run["results"].items():
+        base = baseline["results"].get(name)
+        if not base:
+            continue
+        allowed = per_benchmark.get(name, threshold)
+        change = result["emails_per_sec"] / base["emails_per_sec"] - 1
+        status = "[green]ok[/green]"
+        if change < -allowed:
+            status = "[bold red]REGRESSION[/bold red]"
+            regressions.append(name)
+        print(f"{name:<20} {change:>+8.1%} (allowed -{allowed:.0%}) {status}")
+    return regressions
+
+
+def _parse_thresholds(values: List[str]) -> Dict[str, float]:
+    thresholds = {}
+    for value in values or []:
+        name, _, limit = value.partition("=")
+        thresholds[name] = float(limit)
+    return thresholds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the receipt parsers on a synthetic corpus"
+    )
+    parser.add_argument("-n", type=int, default=200, help="emails per provider")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--only", nargs="*", help="benchmark names to run")
+    parser.add_argument("--out-dir", type=Path, default=BENCH_DIR)
+    parser.add_argument("--baseline", type=Path, help="defaults to <out-dir>/baseline.json")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument(
+        "--threshold-for",
+        nargs="*",
+        metavar="NAME=FRACTION",
+        help="per-benchmark thresholds, e.g. parse_grab_html=0.2",
+    )
+    args = parser.parse_args()
+
+    run = run_suite(n=args.n, repeat=args.repeat, seed=args.seed, only=args.only)
+
+    args.out_dir.mkdir(exist_ok=True, parents=True)
+    stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    run_path = args.out_dir / f"bench_{stamp}.json"
+    run_path.write_text(json.dumps(run, indent=4))
+    print(f"Saved results to {run_path}")
+
+    baseline_path = args.baseline or args.out_dir / BASELINE_FILENAME
+    if args.save_baseline:
+        baseline_path.write_text(json.dumps(run, indent=4))
+        print(f"Saved baseline to {baseline_path}")
+    elif baseline_path.exists():
+        baseline = json.loads(baseline_path.read_text())
+        regressions = compare_to_baseline(
+            run, baseline, args.threshold, _parse_thresholds(args.threshold_for)
+        )
+        if regressions:
+            sys.exit(1)
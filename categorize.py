@@ -0,0 +1,181 @@
+import csv
+import os
+from collections import deque
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+from instrumentation import METRICS
+from txn_record import Transaction
+
+# shipped rules; a file with the same columns can be given instead, e.g.
+# with the GMAIL_PAYLAH_CATEGORY_RULES environment variable
+DEFAULT_RULES_PATH = Path(__file__).parent / "merchant_categories.csv"
+RULES_ENV_VAR = "GMAIL_PAYLAH_CATEGORY_RULES"
+CATEGORY_FIELD = "txn_category"
+UNCATEGORIZED = "Uncategorized"
+# distinct (txn_type, txn_to) texts remembered by the result cache
+CACHE_SIZE = 65536
+
+
+def normalize(text: str) -> str:
+    """Lower-case and collapse whitespace, for both patterns and merchants"""
+    return " ".join(text.lower().split())
+
+
+class AhoCorasick:
+    """
+    Multi-pattern substring matcher: one pass over the text finds every
+    occurrence of every pattern, whatever the number of patterns.
+
+    The trie is stored as one transition dict per node. `fail` links point to
+    the longest proper suffix that is also a trie prefix, and `out` holds the
+    patterns ending at a node (including those inherited through `fail`).
+    """
+
+    def __init__(self, patterns: Iterable[str]):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.out: List[List[int]] = [[]]
+        self.patterns: List[str] = []
+        for pattern in patterns:
+            self._add(pattern)
+        self._link()
+
+    def _add(self, pattern: str):
+        node = 0
+        for char in pattern:
+            nxt = self.goto[node].get(char)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[node][char] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append([])
+            node = nxt
+        self.out[node].append(len(self.patterns))
+        self.patterns.append(pattern)
+
+    def _link(self):
+        # breadth-first, so the fail target of a node is always linked already
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                state = self.fail[node]
+                while state and char not in self.goto[state]:
+                    state = self.fail[state]
+                self.fail[child] = self.goto[state].get(char, 0)
+                self.out[child] = self.out[child] + self.out[self.fail[child]]
+
+    def find(self, text: str) -> List[Tuple[int, int]]:
+        """
+        Every occurrence of every pattern in `text`
+
+        Returns:
+            (end, index) pairs: `patterns[index]` ends just before `text[end]`
+        """
+        goto, fail, out = self.goto, self.fail, self.out
+        node = 0
+        found = []
+        for end, char in enumerate(text, 1):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if out[node]:
+                found.extend((end, i) for i in out[node])
+        return found
+
+
+def load_rules(rules_path: Path) -> List[Tuple[str, str]]:
+    """
+    Read (pattern, category) rules from a CSV file with "pattern" and
+    "category" columns. Lines whose pattern starts with "#" are comments.
+    """
+    rules = []
+    with open(rules_path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            pattern = normalize(row["pattern"] or "")
+            if pattern and not pattern.startswith("#"):
+                rules.append((pattern, row["category"].strip()))
+    return rules
+
+
+def _is_word_char(text: str, i: int) -> bool:
+    return 0 <= i < len(text) and text[i].isalnum()
+
+
+class CategoryEngine:
+    """
+    Assign a spending category to transactions from merchant pattern rules.
+
+    A pattern matches whole words only, e.g. "spa" matches "Spa Esprit" but
+    not "Spanish Grill". All patterns are compiled into one Aho-Corasick automaton, so matching a
+    transaction costs one pass over its text however many rules there are.
+    When several patterns match, the longest (most specific) one wins, and
+    among equally long ones the first in the rules file. Results are cached
+    per distinct text, as the same merchants recur in most transactions.
+    """
+
+    def __init__(self, rules: List[Tuple[str, str]], default: str = UNCATEGORIZED):
+        self.default = default
+        # a duplicated pattern keeps its first category
+        self.categories: Dict[str, str] = {}
+        for pattern, category in rules:
+            self.categories.setdefault(pattern, category)
+        self.matcher = AhoCorasick(self.categories)
+        self._categorize_text = lru_cache(maxsize=CACHE_SIZE)(self._match)
+
+    @classmethod
+    def from_file(cls, rules_path: Path = None) -> "CategoryEngine":
+        rules_path = rules_path or os.environ.get(RULES_ENV_VAR) or DEFAULT_RULES_PATH
+        return cls(load_rules(rules_path))
+
+    def _match(self, text: str) -> str:
+        patterns = self.matcher.patterns
+        best = None
+        for end, i in self.matcher.find(text):
+            start = end - len(patterns[i])
+            if _is_word_char(text, start - 1) or _is_word_char(text, end):
+                continue
+            # patterns were added in file order, so the index breaks ties
+            if best is None or (len(patterns[i]), -i) > (len(patterns[best]), -best):
+                best = i
+        if best is None:
+            return self.default
+        return self.categories[patterns[best]]
+
+    def categorize_text(self, text: str) -> str:
+        return self._categorize_text(normalize(text))
+
+    def categorize(self, txn: Union[Transaction, dict]) -> str:
+        """Category of a transaction, from its type and counterparty"""
+        # a newline never occurs in a normalized pattern, so no pattern can
+        # match across the two fields
+        return self._categorize_text(
+            f"{normalize(txn.get('txn_type') or '')}\n{normalize(txn.get('txn_to') or '')}"
+        )
+
+    def cache_info(self):
+        return self._categorize_text.cache_info()
+
+
+_default_engine: Optional[CategoryEngine] = None
+
+
+def default_engine() -> CategoryEngine:
+    """The engine of the shipped (or configured) rules, compiled on first use"""
+    global _default_engine
+    if _default_engine is None:
+        with METRICS.timer("compile_category_rules"):
+            _default_engine = CategoryEngine.from_file()
+    return _default_engine
+
+
+def categorize_transaction(
+    txn: Union[Transaction, dict]
+) -> Union[Transaction, dict]:
+    """Set the category field of a parsed transaction, and return it"""
+    txn[CATEGORY_FIELD] = default_engine().categorize(txn)
+    return txn
@@ -0,0 +1,116 @@
+import json
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict
+
+from atomic_io import atomic_write
+
+try:
+    import orjson
+except ImportError:  # optional, only makes JSON faster
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # optional, only needed for the "msgpack" codec
+    msgpack = None
+
+# codec of the archive files (messages, raw messages, spend stats) when none
+# is given; can be overridden with the GMAIL_PAYLAH_CODEC environment variable
+DEFAULT_CODEC = "json-fast"
+CODEC_ENV_VAR = "GMAIL_PAYLAH_CODEC"
+
+
+@dataclass(frozen=True)
+class Codec:
+    name: str
+    encode: Callable[[Any], bytes]
+    available: bool = True
+
+
+def _json_indent(obj) -> bytes:
+    # the original on-disk format, kept for the user-facing master files
+    return json.dumps(obj, indent=4).encode("utf-8")
+
+
+def _json_compact(obj) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _orjson(obj) -> bytes:
+    return orjson.dumps(obj)
+
+
+def _msgpack(obj) -> bytes:
+    return msgpack.packb(obj, use_bin_type=True)
+
+
+CODECS: Dict[str, Codec] = {
+    "json": Codec("json", _json_indent),
+    "json-compact": Codec("json-compact", _json_compact),
+    "orjson": Codec("orjson", _orjson, available=orjson is not None),
+    # orjson when installed, compact stdlib JSON otherwise (same bytes on read)
+    "json-fast": Codec(
+        "json-fast", _orjson if orjson is not None else _json_compact
+    ),
+    "msgpack": Codec("msgpack", _msgpack, available=msgpack is not None),
+}
+
+
+def resolve_codec(name: str = None) -> Codec:
+    """
+    Args:
+        name: key of CODECS; defaults to $GMAIL_PAYLAH_CODEC, then DEFAULT_CODEC
+    """
+    name = name or os.environ.get(CODEC_ENV_VAR) or DEFAULT_CODEC
+    if name not in CODECS:
+        raise ValueError(f"Unknown codec '{name}', choose from {sorted(CODECS)}")
+    codec = CODECS[name]
+    if not codec.available:
+        raise ValueError(f"Codec '{name}' needs the '{name}' package to be installed")
+    return codec
+
+
+def dumps(obj, codec: str = None) -> bytes:
+    return resolve_codec(codec).encode(obj)
+
+
+def loads(data: bytes):
+    """
+    Decode bytes written by any codec. JSON always starts with `{`, `[` or
+    whitespace, while a msgpack map or array never does.
+
+    Raises:
+        ValueError: if the data is not valid in the detected format
+    """
+    head = data.lstrip()[:1]
+    if head in (b"{", b"[") or not head:
+        if orjson is not None:
+            return orjson.loads(data)
+        return json.loads(data)
+    if msgpack is None:
+        raise ValueError("Data is not JSON, and msgpack is not installed to read it")
+    try:
+        return msgpack.unpackb(data, raw=False)
+    except Exception as e:
+        raise ValueError(f"Invalid msgpack data: {e}") from e
+
+
+def dump(obj, path: Path, codec: str = None) -> int:
+    """
+    Atomically write `obj` to `path` with the given codec
+
+    Returns:
+        Number of bytes written
+    """
+    data = dumps(obj, codec)
+    with atomic_write(path, "wb") as f:
+        f.write(data)
+    return len(data)
+
+
+def load(path: Path):
+    """Read a file written by any codec (or by the former `json.dump` calls)"""
+    with open(path, "rb") as f:
+        return loads(f.read())
@@ -0,0 +1,332 @@
+import argparse
+import json
+import math
+import os
+import random
+import time
+from pathlib import Path
+from statistics import mean
+
+from rich import print
+
+import codec
+from atomic_io import atomic_write_text
+from export_journal import RAW_SUFFIX, ExportJournal
+from gmail_export import (
+    LABEL_CHUNK_SIZE,
+    all_msg_ids_from_sender,
+    is_exported,
+    read_skipped_ids,
+)
+from gmail_helpers import (
+    EstimateResultSize,
+    GetMessageMetadata,
+    ListMessagesMatchingQuery,
+    date_query,
+    get_gmail_service,
+)
+from memory_budget import count_data_files
+from providers import PROVIDERS
+from sharded_listing import DEFAULT_MAX_PER_WINDOW
+
+OUTPUT_DIR = Path("output")
+DEFAULT_SAMPLE_SIZE = 50
+
+# Gmail API quota units per request, and the per-user rate limit
+# https://developers.google.com/gmail/api/reference/quota
+QUOTA_UNITS = {
+    "messages.list": 5,
+    "messages.get": 5,
+    "messages.batchModify": 50,
+}
+USER_QUOTA_UNITS_PER_SECOND = 250
+LIST_PAGE_SIZE = 100
+
+# used when there is nothing to sample or calibrate from
+DEFAULT_SIZE_ESTIMATE = 40 * 1024
+DEFAULT_LATENCY_SECONDS = 0.2
+# a format=full response carries the body base64url-encoded
+FULL_BYTES_PER_SIZE = 4 / 3
+RAW_BYTES_PER_SIZE = 4 / 3
+DATA_BYTES_PER_SIZE = 1.0
+# assumed download rate of one connection, on top of the request latency
+DOWNLOAD_BYTES_PER_SECOND = 2 * 1024**2
+
+
+def _calibrate_disk(provider_dir: Path, sample_size: int, rng: random.Random) -> dict:
+    """
+    Bytes on disk (raw and data file) per byte of `sizeEstimate`, measured on
+    a sample of already exported messages
+    """
+    raw_dir = provider_dir / "raw"
+    if not raw_dir.is_dir():
+        return {}
+    names = [e.name for e in os.scandir(raw_dir) if e.name.endswith(RAW_SUFFIX)]
+    raw_bytes = data_bytes = size_estimates = 0
+    for name in rng.sample(names, min(sample_size, len(names))):
+        data_path = provider_dir / f"{name[: -len(RAW_SUFFIX)]}.json"
+        try:
+            msg = codec.load(raw_dir / name)
+            size = msg["sizeEstimate"]
+            data_size = data_path.stat().st_size
+        except (ValueError, KeyError, TypeError, OSError):
+            # invalid raw files are `repair.py`'s business
+            continue
+        raw_bytes += (raw_dir / name).stat().st_size
+        data_bytes += data_size
+        size_estimates += size
+    if not size_estimates:
+        return {}
+    return {
+        "raw_bytes_per_size": raw_bytes / size_estimates,
+        "data_bytes_per_size": data_bytes / size_estimates,
+    }
+
+
+def _sample_metadata(service, msg_ids, subject_filter) -> dict:
+    """Time metadata-only requests of `msg_ids`: sizes, latency, subject pass rate"""
+    sizes, latencies, response_bytes, passed = [], [], [], 0
+    for msg_id in msg_ids:
+        start = time.perf_counter()
+        msg = GetMessageMetadata(service, user_id="me", msg_id=msg_id)
+        latencies.append(time.perf_counter() - start)
+        if msg is None:
+            continue
+        sizes.append(msg.get("sizeEstimate", 0))
+        response_bytes.append(len(json.dumps(msg)))
+        subject = next(
+            (h["value"] for h in msg["payload"].get("headers", []) if h["name"] == "Subject"),
+            "",
+        )
+        passed += bool(subject_filter(subject))
+    return {
+        "sampled": len(sizes),
+        "mean_size_estimate": mean(sizes) if sizes else DEFAULT_SIZE_ESTIMATE,
+        "mean_latency_seconds": mean(latencies) if latencies else DEFAULT_LATENCY_SECONDS,
+        "mean_metadata_bytes": mean(response_bytes) if response_bytes else 0,
+        "subject_pass_rate": passed / len(sizes) if sizes else 1.0,
+    }
+
+
+def estimate_export(
+    provider_name: str,
+    output_dir: Path = OUTPUT_DIR,
+    credentials_filepath: str = "credentials.json",
+    token_filepath: str = "token.json",
+    after: str = None,
+    before: str = None,
+    processed_label: str = None,
+    list_workers: int = 1,
+    fetch_workers: int = 1,
+    sample_size: int = DEFAULT_SAMPLE_SIZE,
+    full_listing: bool = True,
+    seed: int = 0,
+) -> dict:
+    """
+    Estimate the cost of exporting one provider without downloading any body
+
+    The matching ids are listed and checked against the local cache, then a
+    random sample of the new ones is fetched with metadata-only requests for
+    their `sizeEstimate`, latency and subject. From these, the estimate of the
+    real export is extrapolated: requests, quota units, transfer volume, disk
+    footprint and wall time. Bytes on disk per byte of `sizeEstimate` are
+    calibrated on the messages already exported, if any.
+
+    Args:
+        provider_name: key of `providers.PROVIDERS`
+        after, before, processed_label, list_workers: as for `main.provider_main`
+        fetch_workers: number of fetching threads (1 for the sequential
+            export, more for `pipeline.pipelined_provider_main`)
+        sample_size: number of new messages to request metadata for
+        full_listing: list every id (exact, costs one request per 100
+            messages); if False, use Gmail's result size estimate and sample
+            from the first page only, assuming every exported message is
+            still listed
+        seed: seed of the sampling
+
+    Returns:
+        The estimate, also printed
+    """
+    provider = PROVIDERS[provider_name]
+    provider_dir = Path(output_dir) / provider_name
+    rng = random.Random(seed)
+
+    def service_factory():
+        return get_gmail_service(
+            scope_name="readonly",
+            credentials_filepath=credentials_filepath,
+            credentials_token_filepath=token_filepath,
+            force_new_token=False,
+        )
+
+    service = service_factory()
+    extra_query = provider.gmail_query()
+    if processed_label:
+        extra_query = f"{extra_query} -label:{processed_label}".strip()
+    query = f"from:{provider.sender} {extra_query}".strip()
+
+    ### List (or estimate) the matching messages, and check the local cache
+    # the journal is only read: a dry run never creates or appends to it
+    journal = (
+        ExportJournal(provider_dir, read_only=True) if provider_dir.is_dir() else None
+    )
+    skipped = read_skipped_ids(provider_dir)
+
+    def is_new(msg_id):
+        return msg_id not in skipped and not is_exported(
+            provider_dir, msg_id, journal=journal
+        )
+
+    start = time.perf_counter()
+    if full_listing:
+        listed_ids = all_msg_ids_from_sender(
+            service=service,
+            sender=provider.sender,
+            extra_query=extra_query,
+            after=after,
+            before=before,
+            list_workers=list_workers,
+            service_factory=service_factory,
+        )
+        n_listed = len(listed_ids)
+        new_ids = [msg_id for msg_id in listed_ids if is_new(msg_id)]
+        n_new = len(new_ids)
+    else:
+        dated_query = f"{query} {date_query(after, before)}".strip()
+        n_listed = EstimateResultSize(service, "me", dated_query) or 0
+        first_page = ListMessagesMatchingQuery(
+            service, "me", dated_query, max_results=sample_size
+        ) or []
+        new_ids = [m["id"] for m in first_page if is_new(m["id"])]
+        n_known = count_data_files(provider_dir) + len(skipped)
+        n_new = max(len(new_ids), n_listed - n_known)
+    list_seconds = time.perf_counter() - start
+    if journal is not None:
+        journal.close()
+
+    ### Sample metadata of the new messages
+    sample = _sample_metadata(
+        service,
+        rng.sample(new_ids, min(sample_size, len(new_ids))),
+        provider.is_transaction_subject,
+    )
+    disk = _calibrate_disk(provider_dir, sample_size, rng)
+    raw_per_size = disk.get("raw_bytes_per_size", RAW_BYTES_PER_SIZE)
+    data_per_size = disk.get("data_bytes_per_size", DATA_BYTES_PER_SIZE)
+
+    ### Extrapolate
+    n_fetch = round(n_new * sample["subject_pass_rate"])
+    size = sample["mean_size_estimate"]
+    latency = sample["mean_latency_seconds"]
+    n_windows = math.ceil(n_listed / DEFAULT_MAX_PER_WINDOW)
+    requests = {
+        # sharded listing also bisects date windows with one-result requests
+        "messages.list": math.ceil(n_listed / LIST_PAGE_SIZE)
+        + (2 * n_windows if list_workers > 1 else 0),
+        "messages.get (metadata)": n_new,
+        "messages.get (full)": n_fetch,
+        "messages.batchModify": math.ceil(n_listed / LABEL_CHUNK_SIZE)
+        if processed_label
+        else 0,
+    }
+    units = {
+        "list": QUOTA_UNITS["messages.list"] * requests["messages.list"],
+        "prefilter": QUOTA_UNITS["messages.get"] * n_new,
+        "fetch": QUOTA_UNITS["messages.get"] * n_fetch
+        + QUOTA_UNITS["messages.batchModify"] * requests["messages.batchModify"],
+    }
+
+    def at_least_quota(seconds, stage):
+        # the per-user rate limit bounds every stage, whatever the concurrency
+        return max(seconds, units[stage] / USER_QUOTA_UNITS_PER_SECOND)
+
+    full_bytes = size * FULL_BYTES_PER_SIZE
+    wall = {
+        "list": at_least_quota(
+            list_seconds
+            if full_listing
+            else requests["messages.list"] * latency / max(1, list_workers),
+            "list",
+        ),
+        # the subject pre-filter runs sequentially
+        "prefilter": at_least_quota(n_new * latency, "prefilter"),
+        "fetch": at_least_quota(
+            n_fetch * (latency + full_bytes / DOWNLOAD_BYTES_PER_SECOND)
+            / max(1, fetch_workers),
+            "fetch",
+        ),
+    }
+    wall["total"] = sum(wall.values())
+
+    estimate = {
+        "provider": provider_name,
+        "query": query,
+        "listed": n_listed,
+        "listing": "full" if full_listing else "estimated",
+        "cached_or_skipped": n_listed - n_new,
+        "new": n_new,
+        **sample,
+        "full_fetches": n_fetch,
+        "requests": requests,
+        "quota_units": sum(units.values()),
+        "quota_units_by_stage": units,
+        "transfer_bytes": round(
+            n_new * sample["mean_metadata_bytes"] + n_fetch * full_bytes
+        ),
+        "disk_bytes": round(n_fetch * size * (raw_per_size + data_per_size)),
+        "disk_calibrated": bool(disk),
+        "wall_seconds": {stage: round(s, 1) for stage, s in wall.items()},
+        "list_workers": list_workers,
+        "fetch_workers": fetch_workers,
+    }
+    print(
+        f"{provider_name}: {n_listed} listed, {n_new} new, ~{n_fetch} to fetch; "
+        f"{estimate['quota_units']} quota units, "
+        f"{estimate['transfer_bytes'] / 2**20:.1f} MiB transfer, "
+        f"{estimate['disk_bytes'] / 2**20:.1f} MiB on disk, "
+        f"~{wall['total'] / 60:.1f} min"
+    )
+    return estimate
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Estimate the API quota, transfer, disk and time of an export"
+    )
+    parser.add_argument("providers", nargs="+", metavar="provider")
+    parser.add_argument("--output-dir", type=Path, default=OUTPUT_DIR)
+    parser.add_argument("--credentials", default="credentials.json")
+    parser.add_argument("--token", default="token.json")
+    parser.add_argument("--after", help="YYYY-MM-DD")
+    parser.add_argument("--before", help="YYYY-MM-DD")
+    parser.add_argument("--processed-label")
+    parser.add_argument("--list-workers", type=int, default=1)
+    parser.add_argument("--fetch-workers", type=int, default=1)
+    parser.add_argument("--sample", type=int, default=DEFAULT_SAMPLE_SIZE)
+    parser.add_argument(
+        "--quick", action="store_true", help="estimate the count instead of listing"
+    )
+    parser.add_argument("--json", type=Path, help="also save the estimates here")
+    args = parser.parse_args()
+    unknown = set(args.providers) - set(PROVIDERS)
+    if unknown:
+        parser.error(f"unknown providers: {', '.join(sorted(unknown))}")
+
+    estimates = [
+        estimate_export(
+            name,
+            output_dir=args.output_dir,
+            credentials_filepath=args.credentials,
+            token_filepath=args.token,
+            after=args.after,
+            before=args.before,
+            processed_label=args.processed_label,
+            list_workers=args.list_workers,
+            fetch_workers=args.fetch_workers,
+            sample_size=args.sample,
+            full_listing=not args.quick,
+        )
+        for name in args.providers
+    ]
+    if args.json:
+        atomic_write_text(args.json, json.dumps(estimates, indent=4))
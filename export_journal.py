@@ -0,0 +1,154 @@
+import os
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, Set
+
+from atomic_io import atomic_write_text
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+JOURNAL_FILENAME = "export_journal.log"
+RAW_SUFFIX = "_raw_msg.json"
+
+# a message is exported once both files are written
+STAGE_RAW = "raw"
+STAGE_DATA = "data"
+# written by repair when files are removed, cancels earlier records
+STAGE_FORGET = "forget"
+
+
+class ExportJournal:
+    """
+    Append-only record of which messages completed which export stage.
+
+    Every line is `<stage>\\t<key>\\n` where key is `<prefix><msg_id>`, and is
+    appended only after the file of that stage was atomically renamed into
+    place. A restart reads the journal once instead of stat-ing (or
+    validating) every exported file. A line torn by a crash has no newline
+    and is ignored.
+
+    Several processes, possibly on several machines sharing the directory,
+    may append to the same journal (see `work_queue`): each batch of records
+    is a single `write` on a file opened in append mode, under an exclusive
+    `fcntl` lock. The lock is what makes the append safe on NFS, where
+    O_APPEND alone is not atomic across clients.
+
+    With `read_only`, nothing is created or written (e.g. for the dry-run
+    estimate of `export_estimate`): a missing journal is seeded in memory
+    only, and recording raises.
+    """
+
+    def __init__(self, out_dir: Path, read_only: bool = False):
+        self.out_dir = Path(out_dir)
+        self.path = self.out_dir / JOURNAL_FILENAME
+        self.read_only = read_only
+        self._lock = threading.Lock()
+        self._done: Dict[str, Set[str]] = {STAGE_RAW: set(), STAGE_DATA: set()}
+        self._offset = 0
+        self._fd = None
+        if read_only:
+            if self.path.exists():
+                self.refresh()
+            else:
+                raw, data = self._scan_archive()
+                self._done[STAGE_RAW].update(raw)
+                self._done[STAGE_DATA].update(data)
+            return
+        self.out_dir.mkdir(exist_ok=True, parents=True)
+        if not self.path.exists():
+            self._bootstrap()
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        self.refresh()
+
+    def _scan_archive(self):
+        """Keys of the raw and data files on disk (one directory listing each)"""
+        if not self.out_dir.is_dir():
+            return set(), set()
+        data = {
+            e.name[: -len(".json")]
+            for e in os.scandir(self.out_dir)
+            if e.name.endswith(".json") and not e.name.startswith(".")
+        }
+        raw_dir = self.out_dir / "raw"
+        raw = set()
+        if raw_dir.is_dir():
+            raw = {
+                e.name[: -len(RAW_SUFFIX)]
+                for e in os.scandir(raw_dir)
+                if e.name.endswith(RAW_SUFFIX) and not e.name.startswith(".")
+            }
+        return raw, data
+
+    def _bootstrap(self):
+        """
+        Seed a new journal from the file names of an archive exported before
+        journaling existed (one directory listing, no file reads)
+        """
+        raw, data = self._scan_archive()
+        lines = [f"{STAGE_RAW}\t{key}\n" for key in sorted(raw)]
+        lines += [f"{STAGE_DATA}\t{key}\n" for key in sorted(data)]
+        atomic_write_text(self.path, "".join(lines))
+
+    def refresh(self):
+        """Read the records appended since the last read (e.g. by other workers)"""
+        with self._lock, open(self.path, "rb") as f:
+            f.seek(self._offset)
+            chunk = f.read()
+            complete = chunk[: chunk.rfind(b"\n") + 1]
+            self._offset += len(complete)
+        for line in complete.decode("utf-8").splitlines():
+            stage, _, key = line.partition("\t")
+            if stage == STAGE_FORGET:
+                for done in self._done.values():
+                    done.discard(key)
+            elif stage in self._done and key:
+                self._done[stage].add(key)
+
+    def _append(self, stage: str, keys: Iterable[str]):
+        if self.read_only:
+            raise RuntimeError(f"{self.path} was opened read-only")
+        data = "".join(f"{stage}\t{key}\n" for key in keys).encode("utf-8")
+        if not data:
+            return
+        if fcntl is None:
+            os.write(self._fd, data)
+            return
+        # taking the lock also makes an NFS client revalidate the file size
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        try:
+            os.write(self._fd, data)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    def record(self, stage: str, key: str):
+        self.record_many(stage, [key])
+
+    def record_many(self, stage: str, keys: Iterable[str]):
+        keys = list(keys)
+        with self._lock:
+            self._append(stage, keys)
+            self._done[stage].update(keys)
+
+    def forget(self, keys: Iterable[str]):
+        keys = list(keys)
+        with self._lock:
+            self._append(STAGE_FORGET, keys)
+            for done in self._done.values():
+                done.difference_update(keys)
+
+    def is_done(self, key: str, stages: Iterable[str] = (STAGE_RAW, STAGE_DATA)) -> bool:
+        return all(key in self._done[stage] for stage in stages)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
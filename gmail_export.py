@@ -1,11 +1,33 @@
 import base64
 import datetime
-import json
 from pathlib import Path
+from typing import Callable, List
 
 from tqdm import tqdm
 
-from gmail_helpers import GetMessage, ListMessagesMatchingQuery, get_gmail_service
+from gmail_helpers import (
+    BatchModifyMessages,
+    CreateLabel,
+    CreateMsgLabels,
+    GetMessage,
+    GetMessageMetadata,
+    ListMessagesMatchingQuery,
+    MakeLabel,
+    date_query,
+    get_gmail_service,
+)
+from atomic_io import atomic_write
+from codec import dump as codec_dump
+from codec import load as codec_load
+from export_journal import STAGE_DATA, STAGE_RAW, ExportJournal
+from instrumentation import METRICS, instrument, text_bytes
+from memory_budget import MEMORY
+from sharded_listing import list_msg_ids_sharded
+
+SKIPPED_FILENAME = "skipped_ids.txt"
+# Gmail searches label names with "/" and " " replaced by "-", keep it plain
+PROCESSED_LABEL = "gmail-paylah-processed"
+LABEL_CHUNK_SIZE = 1000
 
 
 def get_all_labels(service):
@@ -31,23 +53,161 @@ def get_all_labels(service):
     return label_to_id_map
 
 
-def all_msg_ids_from_sender(service, sender: str):
+def get_or_create_label_id(service, label_name: str) -> str:
+    """
+    Return the id of the user label `label_name`, creating a hidden label if
+    it does not exist yet
+
+    Raises:
+        RuntimeError: if the label cannot be created, most likely because the
+            token was authorized without the "modify" scope
+    """
+    label_id = get_all_labels(service).get(label_name)
+    if label_id is None:
+        label = CreateLabel(
+            service,
+            user_id="me",
+            label_object=MakeLabel(label_name, mlv="hide", llv="labelHide"),
+        )
+        if label is None:
+            raise RuntimeError(
+                f"Could not create the Gmail label '{label_name}'. Labeling "
+                "processed messages needs the 'modify' scope: delete the token "
+                "file (or use force_new_token=True) and authorize again."
+            )
+        label_id = label["id"]
+    return label_id
+
+
+def mark_processed(service, msg_ids: List[str], label_id: str) -> int:
+    """
+    Add the processed label to `msg_ids` with batchModify requests of up to
+    1000 messages each
+
+    Returns:
+        Number of messages labeled, without those of the failed requests
+    """
+    labeled = BatchModifyMessages(
+        service,
+        user_id="me",
+        msg_ids=msg_ids,
+        msg_labels=CreateMsgLabels(to_add=[label_id]),
+        chunk_size=LABEL_CHUNK_SIZE,
+    )
+    METRICS.inc("messages_labeled", labeled)
+    failed = len(msg_ids) - labeled
+    if failed:
+        # not fatal: unlabeled messages are listed again and read from the cache
+        METRICS.inc("messages_label_failed", failed)
+        print(f"Could not label {failed} of {len(msg_ids)} messages as processed")
+    return labeled
+
+
+def all_msg_ids_from_sender(
+    service,
+    sender: str,
+    extra_query: str = "",
+    after: str = None,
+    before: str = None,
+    list_workers: int = 1,
+    service_factory: Callable = None,
+):
     """
     Query all messages from a particular sender
 
     Args:
         service: Authorized Gmail API service instance.
         sender: email address of the sender
+        extra_query: additional Gmail search operators, e.g. from
+            `providers.Provider.gmail_query`
+        after: only messages on or after this "YYYY-MM-DD" date
+        before: only messages before this "YYYY-MM-DD" date
+        list_workers: if > 1, list date windows concurrently, see
+            `sharded_listing.list_msg_ids_sharded` (needs `service_factory`)
+        service_factory: returns a new authorized Gmail API service
 
     Returns:
         A list of message ids
     """
-    query = f"from:{sender}"
-    msg_ids = ListMessagesMatchingQuery(service, user_id="me", query=query)
-    msg_ids = [i["id"] for i in msg_ids]
+    query = f"from:{sender} {extra_query}".strip()
+    if list_workers > 1 and service_factory is not None:
+        msg_ids = list_msg_ids_sharded(
+            service_factory, query, after=after, before=before, max_workers=list_workers
+        )
+    else:
+        query = f"{query} {date_query(after, before)}".strip()
+        msg_ids = ListMessagesMatchingQuery(service, user_id="me", query=query)
+        msg_ids = [i["id"] for i in msg_ids]
+    METRICS.inc("messages_listed", len(msg_ids))
     return msg_ids
 
 
+def read_skipped_ids(out_dir: Path) -> set:
+    """Ids of the messages rejected by an earlier subject pre-filter"""
+    skipped_path = Path(out_dir) / SKIPPED_FILENAME
+    if not skipped_path.is_file():
+        return set()
+    return set(skipped_path.read_text().split())
+
+
+def prefilter_msg_ids(
+    service,
+    msg_ids: List[str],
+    out_dir: Path,
+    subject_filter: Callable[[str], bool],
+    prefix: str = "",
+    journal: ExportJournal = None,
+) -> List[str]:
+    """
+    Drop messages whose subject does not pass `subject_filter` before any
+    full fetch, using a `format=metadata` request (headers only, no body).
+
+    Messages already exported are kept without any request. Rejected ids are
+    appended to `<out_dir>/skipped_ids.txt` so they are not checked again.
+
+    Returns:
+        The ids of the messages to export, in the listed order
+    """
+    out_dir = Path(out_dir)
+    skipped = read_skipped_ids(out_dir)
+
+    kept = []
+    rejected = []
+    for msg_id in msg_ids:
+        if msg_id in skipped:
+            continue
+        if is_exported(out_dir, msg_id, prefix, save_raw=False, journal=journal):
+            kept.append(msg_id)
+            continue
+        msg = GetMessageMetadata(service, user_id="me", msg_id=msg_id)
+        if msg is None:
+            # request failed, let the full fetch retry it
+            kept.append(msg_id)
+            continue
+        subject = next(
+            (
+                h["value"]
+                for h in msg["payload"].get("headers", [])
+                if h["name"] == "Subject"
+            ),
+            "",
+        )
+        if subject_filter(subject):
+            kept.append(msg_id)
+        else:
+            rejected.append(msg_id)
+
+    if rejected:
+        out_dir.mkdir(exist_ok=True, parents=True)
+        with (out_dir / SKIPPED_FILENAME).open("a") as f:
+            f.writelines(f"{msg_id}\n" for msg_id in rejected)
+    METRICS.inc("messages_prefiltered_out", len(rejected))
+    print(
+        f"Kept {len(kept)} messages, skipped {len(msg_ids) - len(kept)} by subject"
+    )
+    return kept
+
+
 def decode_message_part(data):
     """Decode a base64 URL safe encoded string to a byte string, then to a UTF-8 string."""
     byte_str = base64.urlsafe_b64decode(data.encode("ASCII"))
@@ -94,6 +254,7 @@ def get_msg_metadata(msg: dict) -> dict:
     return metadata
 
 
+@instrument("get_msg_body", measure_bytes=text_bytes)
 def get_msg_body(msg: dict) -> str:
     """
     msg is a dictionary
@@ -144,38 +305,161 @@ def get_multipart_payload(parts: list) -> str:
     return "\n".join(decoded_parts)
 
 
-def save_raw_message(msg: dict, save_path: Path):
+@instrument("save_raw_message")
+def save_raw_message(msg: dict, save_path: Path, codec: str = None):
     """
     Save the raw Message object (dict) as a .txt file
 
     Args:
         msg: a msg object returned by the Gmail API
         save_path: Path object to save the raw message
+        codec: serialization codec, see `codec.CODECS`
+
+    Returns:
+        Whether `save_path` now holds a readable copy of the message
     """
+    if msg is None:
+        # the request failed, there is nothing to save
+        return False
     save_path = Path(save_path)
     if save_path.exists():
-        return
-    success = False
+        # may be the str(msg) fallback of an earlier run: only keep a readable copy
+        try:
+            if isinstance(codec_load(save_path), dict):
+                return True
+        except ValueError:
+            pass
+    # both attempts write to a temporary file first, so a crash never leaves
+    # a truncated raw file behind
     try:
-        with save_path.open("w") as f:
-            json.dump(msg, f, indent=4)
-        success = True
+        METRICS.add_bytes("save_raw_message", codec_dump(msg, save_path, codec))
+        return True
     except Exception as e:
         error_1 = str(e)
-        pass
     try:
-        if not success:
-            with save_path.open("w") as f:
-                f.write(str(msg))
-            success = True
+        with atomic_write(save_path) as f:
+            f.write(str(msg))
     except Exception as e:
-        error_2 = str(e)
-        pass
-    if not success:
         print(f"Failed to save {save_path}")
         print(f"Error 1: {error_1}")
-        print(f"Error 2: {error_2}")
-    return
+        print(f"Error 2: {e}")
+    # the str(msg) fallback is not readable, the message has to be fetched again
+    return False
+
+
+def fetch_message(
+    service,
+    msg_id: str,
+    out_dir: Path,
+    prefix: str = "",
+    save_raw: bool = True,
+    journal: ExportJournal = None,
+    codec: str = None,
+    normalize: Callable[[dict], dict] = None,
+) -> dict:
+    """
+    Fetch and decode one message, save it to `out_dir` and return the saved data
+
+    Both files are written atomically with `codec` (see `codec.CODECS`); each
+    completed stage is then recorded in `journal`, if given. If `normalize` is
+    given (e.g. `Provider.normalize_email`), the data file is saved with its
+    result; the raw file always keeps the original message.
+
+    Returns:
+        A dictionary of metadata plus the decoded "body", or None if the
+        message could not be fetched (nothing is saved, so the next export
+        tries again)
+    """
+    out_dir = Path(out_dir)
+    key = f"{prefix}{msg_id}"
+    msg = GetMessage(service, user_id="me", msg_id=msg_id)
+    if msg is None:
+        METRICS.inc("messages_fetch_failed")
+        return None
+    if save_raw:
+        raw_dir = out_dir / "raw"
+        raw_dir.mkdir(exist_ok=True, parents=True)
+        raw_ok = save_raw_message(
+            msg=msg, save_path=raw_dir / f"{key}_raw_msg.json", codec=codec
+        )
+        if raw_ok and journal is not None:
+            journal.record(STAGE_RAW, key)
+
+    data = get_msg_metadata(msg)
+    decoded_body = get_msg_body(msg)
+    data["body"] = decoded_body
+    if normalize is not None:
+        data = normalize(data)
+    save_path = out_dir / f"{key}.json"
+    with METRICS.timer("write_message"):
+        METRICS.add_bytes("write_message", codec_dump(data, save_path, codec))
+    if journal is not None:
+        journal.record(STAGE_DATA, key)
+    return data
+
+
+def is_exported(
+    out_dir: Path,
+    msg_id: str,
+    prefix: str = "",
+    save_raw: bool = True,
+    journal: ExportJournal = None,
+) -> bool:
+    """
+    Whether a message was already exported, from the journal if given (no
+    file system access), from the presence of its files otherwise
+    """
+    key = f"{prefix}{msg_id}"
+    if journal is not None:
+        stages = (STAGE_RAW, STAGE_DATA) if save_raw else (STAGE_DATA,)
+        return journal.is_done(key, stages)
+    out_dir = Path(out_dir)
+    raw_ok = not save_raw or (out_dir / "raw" / f"{key}_raw_msg.json").is_file()
+    return raw_ok and (out_dir / f"{key}.json").is_file()
+
+
+def export_message(
+    service,
+    msg_id: str,
+    out_dir: Path,
+    prefix: str = "",
+    use_cache: bool = True,
+    save_raw: bool = True,
+    journal: ExportJournal = None,
+    normalize: Callable[[dict], dict] = None,
+) -> str:
+    """
+    Fetch one message and save its metadata and decoded body
+
+    Args:
+        service: Authorized Gmail API service instance.
+        msg_id: id of the message to export
+        out_dir: Output directory to save the message
+        prefix: prefix to add to the filename
+        use_cache: if True, skip the message if it has already been saved
+        save_raw: if True, save the raw Message object (dict) as well
+        journal: export journal of `out_dir`, see `export_journal.ExportJournal`
+        normalize: applied to the data before it is saved, see `fetch_message`
+
+    Returns:
+        "cached" if the message was skipped, "fetched" if it was saved,
+        "failed" if it could not be fetched
+    """
+    if use_cache and is_exported(out_dir, msg_id, prefix, save_raw, journal):
+        METRICS.cache_hit("export_cache")
+        return "cached"
+    METRICS.cache_miss("export_cache")
+
+    data = fetch_message(
+        service,
+        msg_id,
+        out_dir,
+        prefix=prefix,
+        save_raw=save_raw,
+        journal=journal,
+        normalize=normalize,
+    )
+    return "fetched" if data is not None else "failed"
 
 
 def export_email_content(
@@ -184,6 +468,15 @@ def export_email_content(
     prefix: str = "",
     use_cache: bool = True,
     save_raw: bool = True,
+    credentials_filepath: str = "credentials.json",
+    token_filepath: str = "token.json",
+    extra_query: str = "",
+    subject_filter: Callable[[str], bool] = None,
+    processed_label: str = None,
+    after: str = None,
+    before: str = None,
+    list_workers: int = 1,
+    normalize: Callable[[dict], dict] = None,
 ):
     """
     Query all Gmail messages from a particular sender.
@@ -194,40 +487,106 @@ def export_email_content(
         prefix: prefix to add to the filename
         use_cache: if True, skip messages that have already been saved
         save_raw: if True, save the raw Message object (dict) as a .txt file
+        credentials_filepath: OAuth client secrets of the Gmail API project
+        token_filepath: token of the mailbox to export
+        extra_query: additional Gmail search operators (subject, date window)
+        subject_filter: if given, messages whose subject fails it are skipped
+            after a metadata-only request, before any full fetch
+        processed_label: if given (needs the "modify" scope), messages carrying
+            this label are excluded from the listing by Gmail, and every
+            exported or skipped message gets the label
+        after: only export messages on or after this "YYYY-MM-DD" date
+        before: only export messages before this "YYYY-MM-DD" date
+        list_workers: number of concurrent date-sharded listing threads
+        normalize: applied to every fetched message before it is saved, see
+            `fetch_message`
+
+    Returns:
+        A dictionary with the number of "listed", "skipped" (by subject),
+        "cached", "fetched", "failed" and "labeled" messages, or None if
+        authentication failed
     """
-    try:
-        # Authenticate and get Gmail service
-        service = get_gmail_service(
-            scope_name="readonly",
-            credentials_filepath="credentials.json",
-            credentials_token_filepath="token.json",
+    def service_factory():
+        return get_gmail_service(
+            scope_name="modify" if processed_label else "readonly",
+            credentials_filepath=credentials_filepath,
+            credentials_token_filepath=token_filepath,
             force_new_token=False,
         )
+
+    try:
+        # Authenticate and get Gmail service
+        service = service_factory()
     except Exception as e:
         print(e)
-        if Path("token.json").exists():
-            print("Try deleting outdated token.json and try again.")
+        if Path(token_filepath).exists():
+            print(f"Try deleting outdated {token_filepath} and try again.")
         return
 
+    label_id = None
+    if processed_label:
+        label_id = get_or_create_label_id(service, processed_label)
+        extra_query = f"{extra_query} -label:{processed_label}".strip()
+
     # Query/Obtain all message ids from the sender
-    msg_ids = all_msg_ids_from_sender(service=service, sender=sender)
-    print(f"Total number of '{sender}' messages: {len(msg_ids)}")
+    with MEMORY.stage("list_messages"):
+        listed_ids = all_msg_ids_from_sender(
+            service=service,
+            sender=sender,
+            extra_query=extra_query,
+            after=after,
+            before=before,
+            list_workers=list_workers,
+            service_factory=service_factory,
+        )
+    print(f"Total number of '{sender}' messages: {len(listed_ids)}")
+
+    summary = {
+        "listed": len(listed_ids),
+        "cached": 0,
+        "fetched": 0,
+        "failed": 0,
+        "labeled": 0,
+    }
+    # completed messages are read from the journal instead of stat-ing files
+    journal = ExportJournal(out_dir)
+    msg_ids = listed_ids
+    if subject_filter is not None:
+        with MEMORY.stage("prefilter"):
+            msg_ids = prefilter_msg_ids(
+                service, msg_ids, out_dir, subject_filter, prefix=prefix, journal=journal
+            )
+    summary["skipped"] = summary["listed"] - len(msg_ids)
+
+    to_label = []
+    if label_id:
+        kept = set(msg_ids)
+        to_label = [msg_id for msg_id in listed_ids if msg_id not in kept]
 
     # Query/Obtain messages one by one
-    for msg_id in tqdm(msg_ids):
-        raw_dir = out_dir / "raw"
-        raw_dir.mkdir(exist_ok=True, parents=True)
-        raw_path = raw_dir / f"{prefix}{msg_id}_raw_msg.json"
-        save_path = out_dir / f"{prefix}{msg_id}.json"
-        if use_cache and raw_path.is_file() and save_path.is_file():
-            continue
-
-        msg = GetMessage(service, user_id="me", msg_id=msg_id)
-        if save_raw:
-            save_raw_message(msg=msg, save_path=raw_path)
-
-        data = get_msg_metadata(msg)
-        decoded_body = get_msg_body(msg)
-        data["body"] = decoded_body
-        with save_path.open("w") as f:
-            json.dump(data, f, indent=4)
+    with MEMORY.stage("fetch_messages"):
+        for msg_id in tqdm(msg_ids):
+            result = export_message(
+                service,
+                msg_id=msg_id,
+                out_dir=out_dir,
+                prefix=prefix,
+                use_cache=use_cache,
+                save_raw=save_raw,
+                journal=journal,
+                normalize=normalize,
+            )
+            summary[result] += 1
+            # a failed message is listed (and fetched) again next time
+            if label_id and result != "failed":
+                to_label.append(msg_id)
+                # label as we go, so a crash only costs the last chunk
+                if len(to_label) >= LABEL_CHUNK_SIZE:
+                    summary["labeled"] += mark_processed(service, to_label, label_id)
+                    to_label = []
+
+    if label_id and to_label:
+        summary["labeled"] += mark_processed(service, to_label, label_id)
+
+    journal.close()
+    return summary
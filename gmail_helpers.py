@@ -1,5 +1,9 @@
+import datetime
+import json
 import os
+import threading
 from pathlib import Path
+from typing import Dict
 
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
@@ -7,6 +11,9 @@ from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
+from atomic_io import atomic_write_text
+from instrumentation import instrument
+
 SCOPE_MAP = {
     "readonly": "https://www.googleapis.com/auth/gmail.readonly",
     "compose": "https://www.googleapis.com/auth/gmail.compose",
@@ -23,6 +30,47 @@ SCOPE_DESC_MAP = {
     "full": "Full access to the account's mailboxes, including permanent deletion of threads and messages.",
 }
 
+# scopes granted along with a broader one
+SCOPE_INCLUDES = {
+    "full": set(SCOPE_MAP),
+    "modify": {"readonly", "metadata"},
+    "readonly": {"metadata"},
+}
+
+# one lock per token file: threads of a process (e.g. the provider exports of
+# `multi_account`) authorize one at a time, so a single refresh or login flow
+# runs and the others read the token it saved
+_TOKEN_LOCKS: Dict[Path, threading.Lock] = {}
+_TOKEN_LOCKS_GUARD = threading.Lock()
+
+
+def _token_lock(token_filepath: Path) -> threading.Lock:
+    with _TOKEN_LOCKS_GUARD:
+        return _TOKEN_LOCKS.setdefault(token_filepath.resolve(), threading.Lock())
+
+
+def _check_token_scope(token_filepath: Path, scope_name: str):
+    """
+    Raise if the saved token was authorized without `scope_name`, e.g. a
+    "readonly" token reused for labeling, which needs "modify"
+    """
+    granted_urls = json.loads(token_filepath.read_text()).get("scopes")
+    if not granted_urls:
+        # not recorded by older tokens, the API calls will tell
+        return
+    url_to_name = {url: name for name, url in SCOPE_MAP.items()}
+    granted = {url_to_name.get(url, url) for url in granted_urls}
+    if any(
+        scope_name == name or scope_name in SCOPE_INCLUDES.get(name, ())
+        for name in granted
+    ):
+        return
+    raise RuntimeError(
+        f"Token '{token_filepath}' was authorized for {', '.join(sorted(granted))}, "
+        f"not for the '{scope_name}' scope. Delete it (or use force_new_token=True) "
+        f"and authorize again with '{scope_name}'."
+    )
+
 
 def get_gmail_service(
     scope_name: str = "readonly",
@@ -45,29 +93,31 @@ def get_gmail_service(
     ), f"File '{credentials_filepath}' does not exist"
 
     credentials_token_filepath = Path(credentials_token_filepath)
-    if credentials_token_filepath.exists() and force_new_token:
-        os.remove(credentials_token_filepath)
-
-    creds = None
-    # The file token.json stores the user's access and refresh tokens, and is
-    # created automatically when the authorization flow completes for the first
-    # time.
-    if credentials_token_filepath.exists():
-        creds = Credentials.from_authorized_user_file(
-            str(credentials_token_filepath), scopes
-        )
-    # If there are no (valid) credentials available, let the user log in.
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                str(credentials_filepath), scopes
+    with _token_lock(credentials_token_filepath):
+        if credentials_token_filepath.exists() and force_new_token:
+            os.remove(credentials_token_filepath)
+
+        creds = None
+        # The file token.json stores the user's access and refresh tokens, and is
+        # created automatically when the authorization flow completes for the first
+        # time.
+        if credentials_token_filepath.exists():
+            _check_token_scope(credentials_token_filepath, scope_name)
+            creds = Credentials.from_authorized_user_file(
+                str(credentials_token_filepath), scopes
             )
-            creds = flow.run_local_server(port=0)
-        # Save the credentials for the next run
-        with credentials_token_filepath.open("w") as token:
-            token.write(creds.to_json())
+        # If there are no (valid) credentials available, let the user log in.
+        if not creds or not creds.valid:
+            if creds and creds.expired and creds.refresh_token:
+                creds.refresh(Request())
+            else:
+                flow = InstalledAppFlow.from_client_secrets_file(
+                    str(credentials_filepath), scopes
+                )
+                creds = flow.run_local_server(port=0)
+            # Save the credentials for the next run, never as a truncated file
+            credentials_token_filepath.parent.mkdir(exist_ok=True, parents=True)
+            atomic_write_text(credentials_token_filepath, creds.to_json())
 
     service = build("gmail", "v1", credentials=creds)
     return service
@@ -151,6 +201,35 @@ def ModifyMessage(service, user_id, msg_id, msg_labels):
         print("An error occurred: {}".format(err))
 
 
+@instrument("BatchModifyMessages")
+def BatchModifyMessages(service, user_id, msg_ids, msg_labels, chunk_size=1000):
+    """Modify the Labels on many Messages, `chunk_size` Messages per request.
+
+    Args:
+      service: Authorized Gmail API service instance.
+      user_id: User's email address. The special value "me"
+      can be used to indicate the authenticated user.
+      msg_ids: The ids of the messages to modify.
+      msg_labels: The change in labels, see CreateMsgLabels.
+      chunk_size: Number of ids per request, at most 1000.
+
+    Returns:
+      Number of messages modified, without those of the failed requests.
+    """
+    msg_ids = list(msg_ids)
+    modified = 0
+    for i in range(0, len(msg_ids), chunk_size):
+        chunk = msg_ids[i : i + chunk_size]
+        try:
+            service.users().messages().batchModify(
+                userId=user_id, body=dict(msg_labels, ids=chunk)
+            ).execute()
+            modified += len(chunk)
+        except HttpError as err:
+            print("An error occurred: {}".format(err))
+    return modified
+
+
 def CreateMsgLabels(to_add=[], to_delete=[]):
     """Create object to update labels.
 
@@ -163,7 +242,51 @@ def CreateMsgLabels(to_add=[], to_delete=[]):
 ############# Query Functions
 
 
-def ListMessagesMatchingQuery(service, user_id, query=""):
+def date_query(after=None, before=None) -> str:
+    """Gmail search operators restricting messages to [after, before).
+
+    Args:
+      after: datetime.date or "YYYY-MM-DD" string, inclusive.
+      before: datetime.date or "YYYY-MM-DD" string, exclusive.
+
+    Returns:
+      A string such as "after:2023/01/01 before:2023/02/01".
+    """
+    terms = []
+    for operator, value in [("after", after), ("before", before)]:
+        if value:
+            value = datetime.date.fromisoformat(str(value))
+            terms.append(f"{operator}:{value:%Y/%m/%d}")
+    return " ".join(terms)
+
+
+@instrument("EstimateResultSize")
+def EstimateResultSize(service, user_id, query=""):
+    """Estimated number of Messages matching the query, from a single request.
+
+    Args:
+      service: Authorized Gmail API service instance.
+      user_id: User's email address. The special value "me"
+      can be used to indicate the authenticated user.
+      query: String used to filter messages returned.
+
+    Returns:
+      The resultSizeEstimate reported by Gmail (approximate).
+    """
+    try:
+        response = (
+            service.users()
+            .messages()
+            .list(userId=user_id, q=query, maxResults=1)
+            .execute()
+        )
+        return response.get("resultSizeEstimate", 0)
+    except HttpError as err:
+        print("An error occurred: {}".format(err))
+
+
+@instrument("ListMessagesMatchingQuery")
+def ListMessagesMatchingQuery(service, user_id, query="", max_results=None):
     """List all Messages of the user's mailbox matching the query.
 
     Args:
@@ -172,6 +295,7 @@ def ListMessagesMatchingQuery(service, user_id, query=""):
       can be used to indicate the authenticated user.
       query: String used to filter messages returned.
       Eg.- 'from:user@some_domain.com' for Messages from a particular sender.
+      max_results: Stop after the page that reaches this many Messages.
 
     Returns:
       List of Messages that match the criteria of the query. Note that the
@@ -185,6 +309,8 @@ def ListMessagesMatchingQuery(service, user_id, query=""):
             messages.extend(response["messages"])
 
         while "nextPageToken" in response:
+            if max_results is not None and len(messages) >= max_results:
+                break
             page_token = response["nextPageToken"]
             response = (
                 service.users()
@@ -242,6 +368,7 @@ def ListMessagesWithLabels(service, user_id, label_ids=[]):
 ############# Messages Functions
 
 
+@instrument("GetMessage", measure_bytes=lambda msg: msg.get("sizeEstimate", 0))
 def GetMessage(service, user_id, msg_id):
     """Get a Message with given ID.
 
@@ -261,6 +388,37 @@ def GetMessage(service, user_id, msg_id):
         print("An error occurred: {}".format(err))
 
 
+@instrument("GetMessageMetadata")
+def GetMessageMetadata(service, user_id, msg_id, headers=("Subject",)):
+    """Get only the labels and the given headers of a Message.
+
+    Args:
+      service: Authorized Gmail API service instance.
+      user_id: User's email address. The special value "me"
+      can be used to indicate the authenticated user.
+      msg_id: The ID of the Message required.
+      headers: Names of the headers to return.
+
+    Returns:
+      A Message without body, with payload["headers"] limited to `headers`.
+    """
+    try:
+        message = (
+            service.users()
+            .messages()
+            .get(
+                userId=user_id,
+                id=msg_id,
+                format="metadata",
+                metadataHeaders=list(headers),
+            )
+            .execute()
+        )
+        return message
+    except HttpError as err:
+        print("An error occurred: {}".format(err))
+
+
 def GetMimeMessage(service, user_id, msg_id):
     """Get a Message and use it to create a MIME Message.
 
@@ -0,0 +1,185 @@
+import argparse
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable, Optional
+
+from bs4 import BeautifulSoup, Comment
+from rich import print
+
+import codec
+from instrumentation import METRICS, instrument, text_bytes
+
+OUTPUT_DIR = Path("output")
+# set on data files whose body was normalized, so it is not done twice
+NORMALIZED_FLAG = "body_normalized"
+
+# tags whose text nodes are never rendered: whitespace between their
+# children is dropped instead of collapsed
+_STRUCTURAL_TAGS = {"html", "head", "table", "thead", "tbody", "tfoot", "tr", "ul", "ol"}
+# tags whose whitespace is significant
+_PREFORMATTED_TAGS = {"pre", "textarea"}
+_WHITESPACE = re.compile(r"\s+")
+_HIDDEN_STYLE = re.compile(r"display\s*:\s*none|visibility\s*:\s*hidden", re.I)
+
+
+def strip_styles(soup: BeautifulSoup) -> BeautifulSoup:
+    """Remove all style attributes and <style> tags, in place"""
+    for tag in soup.find_all(style=True):
+        del tag["style"]
+    for style_tag in soup.find_all("style"):
+        style_tag.decompose()
+    return soup
+
+
+def _is_tracking_image(img) -> bool:
+    """1x1 (or hidden) images only load a tracking URL, they show nothing"""
+    if img.get("width") in ("0", "1") or img.get("height") in ("0", "1"):
+        return True
+    return bool(_HIDDEN_STYLE.search(img.get("style", "")))
+
+
+@instrument("normalize_html", measure_bytes=text_bytes)
+def normalize_html(html_str: str) -> str:
+    """
+    Compact canonical form of an email body: styles, scripts, comments,
+    stylesheet links and tracking images are removed, and whitespace is
+    collapsed. Text and element structure are kept.
+
+    Parsed with "html.parser", like the provider parsers, so that the tree
+    they see is the same.
+    """
+    soup = BeautifulSoup(html_str, "html.parser")
+    # before strip_styles, which removes the hiding styles
+    for img in soup.find_all("img"):
+        if _is_tracking_image(img):
+            img.decompose()
+    strip_styles(soup)
+    for tag in soup(["script", "noscript", "link"]):
+        tag.decompose()
+    for comment in soup.find_all(string=lambda s: isinstance(s, Comment)):
+        comment.extract()
+
+    for text in soup.find_all(string=True):
+        if any(p.name in _PREFORMATTED_TAGS for p in text.parents):
+            continue
+        collapsed = _WHITESPACE.sub(" ", text)
+        if collapsed == " " and text.parent.name in _STRUCTURAL_TAGS:
+            text.extract()
+        elif collapsed != text:
+            text.replace_with(collapsed)
+    return str(soup)
+
+
+def normalize_email(email_data: dict, parse: Optional[Callable[[dict], object]] = None) -> dict:
+    """
+    The exported email with a normalized body
+
+    Args:
+        email_data: the dictionary saved by `gmail_export.export_message`
+        parse: the provider's `transaction_from_email`; if given, the
+            normalized body is only kept if it parses to the same result as
+            the original one
+
+    Returns:
+        A new dictionary, or `email_data` itself if there was nothing to do
+        or the parse results differ
+    """
+    body = email_data.get("body")
+    if not body or email_data.get(NORMALIZED_FLAG):
+        return email_data
+    normalized = dict(email_data, body=normalize_html(body))
+    normalized[NORMALIZED_FLAG] = True
+    if parse is not None and parse(dict(email_data)) != parse(dict(normalized)):
+        METRICS.inc("normalize_mismatch")
+        print(
+            f"[yellow]Kept the original body of {email_data.get('id')}: "
+            "the parser reads the normalized body differently"
+        )
+        return email_data
+    METRICS.inc("normalize_bytes_saved", text_bytes(body) - text_bytes(normalized["body"]))
+    return normalized
+
+
+def _normalize_file(args) -> tuple:
+    """Worker: normalize one data file in place; returns (bytes before, after, status)"""
+    provider_name, path, dry_run = args
+    # not at the top: providers imports this module
+    from providers import PROVIDERS
+
+    size_before = os.path.getsize(path)
+    email_data = codec.load(path)
+    normalized = PROVIDERS[provider_name].normalize_email(email_data)
+    if normalized is email_data:
+        done = email_data.get(NORMALIZED_FLAG) or not email_data.get("body")
+        return size_before, size_before, "unchanged" if done else "mismatch"
+    if dry_run:
+        return size_before, len(codec.dumps(normalized)), "normalized"
+    return size_before, codec.dump(normalized, path), "normalized"
+
+
+def normalize_archive(
+    provider_name: str,
+    output_dir: Path = OUTPUT_DIR,
+    max_workers: int = None,
+    dry_run: bool = False,
+) -> dict:
+    """
+    Normalize the bodies of every data file already exported for a provider.
+    The raw files keep the original messages.
+
+    Returns:
+        Counts of "normalized", "unchanged" and "mismatch" files, and the
+        total size before and after
+    """
+    provider_dir = Path(output_dir) / provider_name
+    paths = [
+        e.path
+        for e in os.scandir(provider_dir)
+        if e.name.endswith(".json") and not e.name.startswith(".")
+    ]
+    summary = dict.fromkeys(
+        ["normalized", "unchanged", "mismatch", "bytes_before", "bytes_after"], 0
+    )
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(
+            _normalize_file,
+            [(provider_name, path, dry_run) for path in paths],
+            chunksize=64,
+        )
+        for size_before, size_after, status in results:
+            summary[status] += 1
+            summary["bytes_before"] += size_before
+            summary["bytes_after"] += size_after
+    print(
+        f"{provider_name}: normalized {summary['normalized']} bodies, "
+        f"{summary['bytes_before'] / 2**20:.1f} MiB -> {summary['bytes_after'] / 2**20:.1f} MiB, "
+        f"{summary['mismatch']} kept because the parse result differed"
+    )
+    return summary
+
+
+if __name__ == "__main__":
+    from providers import PROVIDERS
+
+    parser = argparse.ArgumentParser(
+        description="Normalize the email bodies of an existing archive"
+    )
+    parser.add_argument(
+        "providers",
+        nargs="*",
+        metavar="provider",
+        help=f"one of {', '.join(PROVIDERS)} (default: all providers)",
+    )
+    parser.add_argument("--output-dir", type=Path, default=OUTPUT_DIR)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--dry-run", action="store_true", help="only report the savings")
+    args = parser.parse_args()
+    unknown = set(args.providers) - set(PROVIDERS)
+    if unknown:
+        parser.error(f"unknown providers: {', '.join(sorted(unknown))}")
+
+    for name in args.providers or list(PROVIDERS):
+        if (args.output_dir / name).is_dir():
+            normalize_archive(name, args.output_dir, args.workers, args.dry_run)
@@ -0,0 +1,221 @@
+import functools
+import json
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict
+
+from atomic_io import atomic_write_text
+
+RUN_REPORT_FILENAME = "run_report.json"
+PROMETHEUS_FILENAME = "gmail_paylah.prom"
+METRIC_PREFIX = "gmail_paylah"
+
+# latency histogram bucket upper bounds, in seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for i, upper in enumerate(self.buckets):
+            if value <= upper:
+                self.bucket_counts[i] += 1
+                break
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket containing the q-quantile"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for upper, n in zip(self.buckets, self.bucket_counts):
+            seen += n
+            if seen >= rank:
+                return upper
+        return float("inf")
+
+    def cumulative_counts(self):
+        total = 0
+        for n in self.bucket_counts:
+            total += n
+            yield total
+
+
+class Metrics:
+    """
+    Thread-safe, in-process registry of stage timers, byte counters, event
+    counters and cache hit/miss counters for one pipeline run.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+        self.latency: Dict[str, Histogram] = {}
+        self.bytes: Dict[str, int] = {}
+        self.counters: Dict[str, float] = {}
+        self.cache: Dict[str, Dict[str, int]] = {}
+        self.extra: Dict[str, object] = {}
+
+    def reset(self):
+        self.__init__()
+
+    def observe(self, stage: str, seconds: float):
+        with self._lock:
+            if stage not in self.latency:
+                self.latency[stage] = Histogram()
+            self.latency[stage].observe(seconds)
+
+    def add_bytes(self, stage: str, n: int):
+        with self._lock:
+            self.bytes[stage] = self.bytes.get(stage, 0) + int(n)
+
+    def inc(self, name: str, value: float = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def cache_hit(self, cache: str):
+        self._cache_event(cache, "hit")
+
+    def cache_miss(self, cache: str):
+        self._cache_event(cache, "miss")
+
+    def _cache_event(self, cache: str, result: str):
+        with self._lock:
+            counts = self.cache.setdefault(cache, {"hit": 0, "miss": 0})
+            counts[result] += 1
+
+    @contextmanager
+    def timer(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    ############# Exporters
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            stages = {}
+            for stage in sorted(set(self.latency) | set(self.bytes)):
+                hist = self.latency.get(stage, Histogram())
+                stages[stage] = {
+                    "count": hist.count,
+                    "total_seconds": round(hist.sum, 6),
+                    "mean_seconds": round(hist.sum / hist.count, 6)
+                    if hist.count
+                    else 0.0,
+                    "p50_seconds": hist.quantile(0.5),
+                    "p95_seconds": hist.quantile(0.95),
+                    "bytes": self.bytes.get(stage, 0),
+                    "histogram": dict(
+                        zip(map(str, hist.buckets), hist.bucket_counts)
+                    ),
+                }
+            caches = {}
+            for cache, counts in self.cache.items():
+                total = counts["hit"] + counts["miss"]
+                caches[cache] = dict(
+                    counts, hit_rate=round(counts["hit"] / total, 4) if total else 0.0
+                )
+            return {
+                "started_at": self.started_at,
+                "wall_seconds": round(time.time() - self.started_at, 3),
+                "stages": stages,
+                "counters": dict(self.counters),
+                "caches": caches,
+                **self.extra,
+            }
+
+    def to_prometheus(self) -> str:
+        p = METRIC_PREFIX
+        lines = [
+            f"# HELP {p}_stage_seconds Latency of each pipeline stage.",
+            f"# TYPE {p}_stage_seconds histogram",
+        ]
+        with self._lock:
+            for stage, hist in sorted(self.latency.items()):
+                for upper, n in zip(hist.buckets, hist.cumulative_counts()):
+                    lines.append(f'{p}_stage_seconds_bucket{{stage="{stage}",le="{upper}"}} {n}')
+                lines.append(f'{p}_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {hist.count}')
+                lines.append(f'{p}_stage_seconds_sum{{stage="{stage}"}} {hist.sum}')
+                lines.append(f'{p}_stage_seconds_count{{stage="{stage}"}} {hist.count}')
+
+            lines.append(f"# HELP {p}_stage_bytes_total Bytes processed by each stage.")
+            lines.append(f"# TYPE {p}_stage_bytes_total counter")
+            for stage, n in sorted(self.bytes.items()):
+                lines.append(f'{p}_stage_bytes_total{{stage="{stage}"}} {n}')
+
+            lines.append(f"# HELP {p}_events_total Pipeline event counters.")
+            lines.append(f"# TYPE {p}_events_total counter")
+            for name, value in sorted(self.counters.items()):
+                lines.append(f'{p}_events_total{{name="{name}"}} {value}')
+
+            lines.append(f"# HELP {p}_cache_requests_total Cache lookups by result.")
+            lines.append(f"# TYPE {p}_cache_requests_total counter")
+            for cache, counts in sorted(self.cache.items()):
+                for result, n in sorted(counts.items()):
+                    lines.append(
+                        f'{p}_cache_requests_total{{cache="{cache}",result="{result}"}} {n}'
+                    )
+        return "\n".join(lines) + "\n"
+
+    def write_reports(self, output_dir: Path) -> dict:
+        """
+        Write the JSON run report and the Prometheus textfile into `output_dir`.
+        Both are written to a temporary file and renamed, so that the
+        node_exporter textfile collector never reads a partial file.
+        """
+        output_dir = Path(output_dir)
+        output_dir.mkdir(exist_ok=True, parents=True)
+        report = self.to_dict()
+        atomic_write_text(output_dir / RUN_REPORT_FILENAME, json.dumps(report, indent=4))
+        atomic_write_text(output_dir / PROMETHEUS_FILENAME, self.to_prometheus())
+        return report
+
+
+# process-wide registry used by all modules
+METRICS = Metrics()
+
+
+def instrument(stage: str, measure_bytes: Callable = None):
+    """
+    Decorator timing every call of a function as `stage`
+
+    Args:
+        stage: stage name used in the reports
+        measure_bytes: optional function of the return value giving the
+            number of bytes the call produced
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                METRICS.inc(f"{stage}_errors")
+                raise
+            finally:
+                METRICS.observe(stage, time.perf_counter() - start)
+            if measure_bytes is not None and result is not None:
+                METRICS.add_bytes(stage, measure_bytes(result))
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def text_bytes(s: str) -> int:
+    return len(s.encode("utf-8")) if s else 0
@@ -0,0 +1,562 @@
+import sqlite3
+from pathlib import Path
+from typing import Callable, Iterable, List, Optional
+
+OUTPUT_DIR = Path("output")
+LEDGER_FILENAME = "ledger.db"
+
+TXN_FIELDS = [
+    "txn_type",
+    "txn_id",
+    "txn_date",
+    "txn_time",
+    "txn_amount",
+    "txn_from",
+    "txn_to",
+]
+# fields of the master outputs and of query results: the category is derived
+# from the rules, so it is not part of the transaction identity (`txn_key`)
+OUTPUT_FIELDS = TXN_FIELDS + ["txn_category"]
+
+# columns that may be used in GROUP BY / ORDER BY clauses of the query API
+GROUPABLE_COLUMNS = {
+    "provider",
+    "txn_type",
+    "txn_date",
+    "txn_month",
+    "txn_from",
+    "txn_to",
+    "txn_category",
+}
+# orderings of single transactions, and of groups (their aggregates)
+TRANSACTION_ORDER_COLUMNS = {"txn_amount", "txn_date"}
+GROUP_ORDER_COLUMNS = {"total", "count"}
+ORDERABLE_COLUMNS = TRANSACTION_ORDER_COLUMNS | GROUP_ORDER_COLUMNS
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS transactions (
+    txn_key     TEXT PRIMARY KEY,
+    provider    TEXT NOT NULL,
+    txn_type    TEXT NOT NULL,
+    txn_id      TEXT,
+    txn_date    TEXT,
+    txn_month   TEXT,
+    txn_time    TEXT,
+    txn_amount  REAL NOT NULL,
+    txn_from    TEXT,
+    txn_to      TEXT,
+    txn_category TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_txn_date ON transactions (txn_date);
+CREATE INDEX IF NOT EXISTS idx_txn_provider_type ON transactions (provider, txn_type, txn_date);
+CREATE INDEX IF NOT EXISTS idx_txn_to ON transactions (txn_to);
+CREATE INDEX IF NOT EXISTS idx_txn_amount ON transactions (txn_amount);
+CREATE TABLE IF NOT EXISTS ledger_meta (
+    key         TEXT PRIMARY KEY,
+    value
+);
+"""
+
+# Materialized rollups, kept up to date by triggers so that each inserted or
+# removed transaction only touches its own daily / monthly / counterparty bucket
+ROLLUP_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rollup_daily (
+    provider    TEXT NOT NULL,
+    txn_type    TEXT NOT NULL,
+    txn_date    TEXT NOT NULL,
+    total       REAL NOT NULL,
+    count       INTEGER NOT NULL,
+    PRIMARY KEY (provider, txn_type, txn_date)
+);
+CREATE TABLE IF NOT EXISTS rollup_monthly (
+    provider    TEXT NOT NULL,
+    txn_type    TEXT NOT NULL,
+    txn_month   TEXT NOT NULL,
+    total       REAL NOT NULL,
+    count       INTEGER NOT NULL,
+    PRIMARY KEY (provider, txn_type, txn_month)
+);
+CREATE TABLE IF NOT EXISTS rollup_counterparty (
+    provider    TEXT NOT NULL,
+    txn_to      TEXT NOT NULL,
+    total       REAL NOT NULL,
+    count       INTEGER NOT NULL,
+    PRIMARY KEY (provider, txn_to)
+);
+
+CREATE TRIGGER IF NOT EXISTS trg_rollup_insert AFTER INSERT ON transactions
+BEGIN
+    INSERT INTO rollup_daily (provider, txn_type, txn_date, total, count)
+    SELECT NEW.provider, NEW.txn_type, NEW.txn_date, NEW.txn_amount, 1
+    WHERE NEW.txn_date IS NOT NULL
+    ON CONFLICT (provider, txn_type, txn_date)
+    DO UPDATE SET total = total + excluded.total, count = count + 1;
+
+    INSERT INTO rollup_monthly (provider, txn_type, txn_month, total, count)
+    SELECT NEW.provider, NEW.txn_type, NEW.txn_month, NEW.txn_amount, 1
+    WHERE NEW.txn_month IS NOT NULL
+    ON CONFLICT (provider, txn_type, txn_month)
+    DO UPDATE SET total = total + excluded.total, count = count + 1;
+
+    INSERT INTO rollup_counterparty (provider, txn_to, total, count)
+    VALUES (NEW.provider, COALESCE(NEW.txn_to, ''), NEW.txn_amount, 1)
+    ON CONFLICT (provider, txn_to)
+    DO UPDATE SET total = total + excluded.total, count = count + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_rollup_delete AFTER DELETE ON transactions
+BEGIN
+    UPDATE rollup_daily SET total = total - OLD.txn_amount, count = count - 1
+    WHERE provider = OLD.provider AND txn_type = OLD.txn_type
+    AND txn_date = OLD.txn_date;
+    DELETE FROM rollup_daily WHERE count <= 0 AND provider = OLD.provider
+    AND txn_type = OLD.txn_type AND txn_date = OLD.txn_date;
+
+    UPDATE rollup_monthly SET total = total - OLD.txn_amount, count = count - 1
+    WHERE provider = OLD.provider AND txn_type = OLD.txn_type
+    AND txn_month = OLD.txn_month;
+    DELETE FROM rollup_monthly WHERE count <= 0 AND provider = OLD.provider
+    AND txn_type = OLD.txn_type AND txn_month = OLD.txn_month;
+
+    UPDATE rollup_counterparty SET total = total - OLD.txn_amount, count = count - 1
+    WHERE provider = OLD.provider AND txn_to = COALESCE(OLD.txn_to, '');
+    DELETE FROM rollup_counterparty WHERE count <= 0 AND provider = OLD.provider
+    AND txn_to = COALESCE(OLD.txn_to, '');
+END;
+"""
+
+# bump whenever a migration has to run on existing ledger files
+SCHEMA_VERSION = 3
+
+
+def ledger_path(output_dir: Path = OUTPUT_DIR) -> Path:
+    return Path(output_dir) / LEDGER_FILENAME
+
+
+def connect_ledger(db_path: Path = None) -> sqlite3.Connection:
+    """
+    Open (and create if needed) the unified transaction ledger
+
+    Args:
+        db_path: path to the SQLite file, defaults to output/ledger.db
+
+    Returns:
+        A sqlite3 connection with rows accessible by column name
+    """
+    db_path = Path(db_path) if db_path else ledger_path()
+    db_path.parent.mkdir(exist_ok=True, parents=True)
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(SCHEMA)
+    conn.executescript(ROLLUP_SCHEMA)
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version < SCHEMA_VERSION:
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(transactions)")}
+        if "txn_category" not in columns:
+            # ledger created before categories existed, filled by the next sync
+            conn.execute("ALTER TABLE transactions ADD COLUMN txn_category TEXT")
+        if version < 1:
+            # ledger created before the rollups existed, backfill them once
+            rebuild_rollups(conn)
+        with conn:
+            # a random id tells a re-created ledger from the old one, and the
+            # version counts the syncs that changed something
+            conn.execute(
+                "INSERT OR IGNORE INTO ledger_meta VALUES "
+                "('ledger_id', lower(hex(randomblob(8))))"
+            )
+            conn.execute("INSERT OR IGNORE INTO ledger_meta VALUES ('version', 0)")
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    return conn
+
+
+def connect_ledger_readonly(db_path: Path = None) -> sqlite3.Connection:
+    """
+    Open the ledger for queries only (`mode=ro`): unlike `connect_ledger`, no
+    pragma or schema statement is run, so a query never writes while a parser
+    is syncing. A missing or outdated ledger is first created or migrated
+    once with `connect_ledger`.
+
+    Returns:
+        A read-only sqlite3 connection with rows accessible by column name
+    """
+    db_path = Path(db_path) if db_path else ledger_path()
+    uri = f"{db_path.resolve().as_uri()}?mode=ro"
+    if db_path.exists():
+        conn = sqlite3.connect(uri, uri=True)
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+            conn.row_factory = sqlite3.Row
+            return conn
+        conn.close()
+    connect_ledger(db_path).close()
+    conn = sqlite3.connect(uri, uri=True)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def ledger_version(conn: sqlite3.Connection) -> str:
+    """
+    Identifier of the current ledger content, e.g. "3f0a9c2e51b7d408-12": it
+    changes whenever a sync inserts, updates or removes a transaction
+    """
+    meta = dict(conn.execute("SELECT key, value FROM ledger_meta").fetchall())
+    return f"{meta.get('ledger_id', '')}-{meta.get('version', 0)}"
+
+
+def rebuild_rollups(conn: sqlite3.Connection):
+    """Recompute every rollup table from scratch with one GROUP BY each"""
+    with conn:
+        conn.execute("DELETE FROM rollup_daily")
+        conn.execute("DELETE FROM rollup_monthly")
+        conn.execute("DELETE FROM rollup_counterparty")
+        conn.execute(
+            "INSERT INTO rollup_daily SELECT provider, txn_type, txn_date, "
+            "SUM(txn_amount), COUNT(*) FROM transactions "
+            "WHERE txn_date IS NOT NULL GROUP BY provider, txn_type, txn_date"
+        )
+        conn.execute(
+            "INSERT INTO rollup_monthly SELECT provider, txn_type, txn_month, "
+            "SUM(txn_amount), COUNT(*) FROM transactions "
+            "WHERE txn_month IS NOT NULL GROUP BY provider, txn_type, txn_month"
+        )
+        conn.execute(
+            "INSERT INTO rollup_counterparty SELECT provider, COALESCE(txn_to, ''), "
+            "SUM(txn_amount), COUNT(*) FROM transactions "
+            "GROUP BY provider, COALESCE(txn_to, '')"
+        )
+
+
+def txn_key(provider: str, txn: dict) -> str:
+    """Stable identity of a transaction, used to make ledger writes idempotent."""
+    values = [provider] + [str(txn.get(field) or "") for field in TXN_FIELDS]
+    return "|".join(values)
+
+
+def _to_row(provider: str, txn: dict) -> tuple:
+    txn_date = txn.get("txn_date")
+    return (
+        txn_key(provider, txn),
+        provider,
+        txn.get("txn_type") or provider,
+        txn.get("txn_id"),
+        txn_date,
+        txn_date[:7] if txn_date else None,
+        txn.get("txn_time"),
+        float(txn.get("txn_amount") or 0),
+        txn.get("txn_from"),
+        txn.get("txn_to"),
+        txn.get("txn_category"),
+    )
+
+
+def sync_provider(
+    provider: str,
+    transactions: Iterable[dict],
+    db_path: Path = None,
+    batch_size: int = 5000,
+    on_new: Callable[[dict], None] = None,
+    on_removed: Callable[[dict], None] = None,
+) -> int:
+    """
+    Make the ledger rows of one provider match the given transactions.
+    Rows that are already present are left untouched apart from their
+    category (which changes with the rules), rows that are no longer
+    produced by the parser are removed. If anything changed, the ledger
+    version (see `ledger_version`) is incremented.
+
+    Args:
+        provider: provider name, e.g. "paylah", "fave" or "grab"
+        transactions: all transaction dicts produced by the provider parser,
+            consumed lazily in batches of `batch_size`
+        db_path: path to the ledger SQLite file
+        batch_size: number of rows buffered per insert
+        on_new: optional callback, called with every transaction that was not
+            in the ledger yet (e.g. to score it for anomalies)
+        on_removed: optional callback, called with every ledger row (as
+            returned by `query_transactions`) that is about to be removed
+
+    Returns:
+        Number of newly inserted transactions
+    """
+    conn = connect_ledger(db_path)
+    inserted = updated = 0
+    with conn:
+        conn.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS current_keys (txn_key TEXT PRIMARY KEY)"
+        )
+        conn.execute("DELETE FROM current_keys")
+
+        insert_sql = (
+            "INSERT OR IGNORE INTO transactions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+        )
+        update_category_sql = (
+            "UPDATE transactions SET txn_category = ? "
+            "WHERE txn_key = ? AND txn_category IS NOT ?"
+        )
+
+        def _flush(rows, txns):
+            nonlocal updated
+            conn.executemany(
+                "INSERT OR IGNORE INTO current_keys (txn_key) VALUES (?)",
+                [(r[0],) for r in rows],
+            )
+            updated += conn.executemany(
+                update_category_sql, [(r[-1], r[0], r[-1]) for r in rows]
+            ).rowcount
+            if on_new is None:
+                # rowcount excludes rows written by the rollup triggers
+                return conn.executemany(insert_sql, rows).rowcount
+            n_new = 0
+            for row, txn in zip(rows, txns):
+                if conn.execute(insert_sql, row).rowcount:
+                    n_new += 1
+                    on_new(txn)
+            return n_new
+
+        rows, txns = [], []
+        for txn in transactions:
+            rows.append(_to_row(provider, txn))
+            if on_new is not None:
+                txns.append(txn)
+            if len(rows) >= batch_size:
+                inserted += _flush(rows, txns)
+                rows, txns = [], []
+        if rows:
+            inserted += _flush(rows, txns)
+
+        stale_where = (
+            "WHERE provider = ? AND txn_key NOT IN (SELECT txn_key FROM current_keys)"
+        )
+        if on_removed is not None:
+            for row in conn.execute(
+                f"SELECT provider, {', '.join(OUTPUT_FIELDS)} FROM transactions "
+                f"{stale_where}",
+                (provider,),
+            ).fetchall():
+                on_removed(dict(row))
+        removed = conn.execute(
+            f"DELETE FROM transactions {stale_where}", (provider,)
+        ).rowcount
+        if inserted or updated or removed:
+            conn.execute(
+                "UPDATE ledger_meta SET value = value + 1 WHERE key = 'version'"
+            )
+    conn.close()
+    return inserted
+
+
+############# Query Functions
+
+
+def _where_clause(
+    start_date: str = None,
+    end_date: str = None,
+    provider: str = None,
+    txn_type: str = None,
+    txn_to: str = None,
+    min_amount: float = None,
+):
+    conditions, params = [], []
+    if start_date:
+        conditions.append("txn_date >= ?")
+        params.append(start_date)
+    if end_date:
+        conditions.append("txn_date <= ?")
+        params.append(end_date)
+    if provider:
+        conditions.append("provider = ?")
+        params.append(provider)
+    if txn_type:
+        conditions.append("txn_type = ?")
+        params.append(txn_type)
+    if txn_to:
+        conditions.append("txn_to = ?")
+        params.append(txn_to)
+    if min_amount is not None:
+        conditions.append("txn_amount > ?")
+        params.append(min_amount)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    return where, params
+
+
+def query_transactions(
+    start_date: str = None,
+    end_date: str = None,
+    provider: str = None,
+    txn_type: str = None,
+    txn_to: str = None,
+    min_amount: float = None,
+    db_path: Path = None,
+) -> List[dict]:
+    """
+    Return transactions within an inclusive date range, ordered by date
+
+    Args:
+        start_date: "YYYY-MM-DD" lower bound, or None
+        end_date: "YYYY-MM-DD" upper bound, or None
+        provider: only return transactions of this provider
+        txn_type: only return transactions of this type
+        txn_to: only return transactions to this counterparty
+        min_amount: only return transactions strictly larger than this amount
+        db_path: path to the ledger SQLite file
+
+    Returns:
+        A list of transaction dicts in the same shape the parsers produce
+    """
+    where, params = _where_clause(
+        start_date, end_date, provider, txn_type, txn_to, min_amount
+    )
+    conn = connect_ledger_readonly(db_path)
+    rows = conn.execute(
+        f"SELECT provider, {', '.join(OUTPUT_FIELDS)} FROM transactions {where} "
+        "ORDER BY txn_date, txn_time",
+        params,
+    ).fetchall()
+    conn.close()
+    return [dict(row) for row in rows]
+
+
+def grouped_sums(
+    group_by: List[str],
+    start_date: str = None,
+    end_date: str = None,
+    provider: str = None,
+    txn_type: str = None,
+    db_path: Path = None,
+) -> List[dict]:
+    """
+    Sum and count transaction amounts grouped by the given columns
+
+    Args:
+        group_by: columns to group by, e.g. ["txn_month", "txn_type"]
+        start_date, end_date, provider, txn_type: optional filters
+
+    Returns:
+        A list of dicts with the group columns plus "total" and "count"
+
+    Raises:
+        ValueError: for a column that cannot be grouped by
+    """
+    if isinstance(group_by, str):
+        group_by = [group_by]
+    for column in group_by:
+        if column not in GROUPABLE_COLUMNS:
+            raise ValueError(f"Cannot group by '{column}'")
+    columns = ", ".join(group_by)
+    where, params = _where_clause(start_date, end_date, provider, txn_type)
+    conn = connect_ledger_readonly(db_path)
+    rows = conn.execute(
+        f"SELECT {columns}, SUM(txn_amount) AS total, COUNT(*) AS count "
+        f"FROM transactions {where} GROUP BY {columns} ORDER BY {columns}",
+        params,
+    ).fetchall()
+    conn.close()
+    return [dict(row) for row in rows]
+
+
+def top_n(
+    n: int = 10,
+    group_by: Optional[str] = None,
+    order_by: str = "txn_amount",
+    start_date: str = None,
+    end_date: str = None,
+    provider: str = None,
+    txn_type: str = None,
+    db_path: Path = None,
+) -> List[dict]:
+    """
+    Return the N largest transactions, or the N largest groups
+
+    Args:
+        n: number of rows to return
+        group_by: if given (e.g. "txn_to"), rank groups by "total" or "count"
+        order_by: "txn_amount" or "txn_date" for single transactions,
+            "total" or "count" for groups ("txn_amount" ranks groups by total)
+        start_date, end_date, provider, txn_type: optional filters
+
+    Returns:
+        A list of dicts ordered from largest to smallest
+
+    Raises:
+        ValueError: for an unknown column, or an ordering that does not
+            apply (e.g. "total" without `group_by`)
+    """
+    if order_by not in ORDERABLE_COLUMNS:
+        raise ValueError(f"Cannot order by '{order_by}'")
+    if group_by:
+        if group_by not in GROUPABLE_COLUMNS:
+            raise ValueError(f"Cannot group by '{group_by}'")
+        if order_by == "txn_amount":
+            order_by = "total"
+        if order_by not in GROUP_ORDER_COLUMNS:
+            raise ValueError(
+                f"Groups can only be ordered by 'total' or 'count', not '{order_by}'"
+            )
+    elif order_by not in TRANSACTION_ORDER_COLUMNS:
+        raise ValueError(f"'{order_by}' orders groups, give a group_by column")
+    where, params = _where_clause(start_date, end_date, provider, txn_type)
+    conn = connect_ledger_readonly(db_path)
+    if group_by:
+        sql = (
+            f"SELECT {group_by}, SUM(txn_amount) AS total, COUNT(*) AS count "
+            f"FROM transactions {where} GROUP BY {group_by} "
+            f"ORDER BY {order_by} DESC LIMIT ?"
+        )
+    else:
+        sql = (
+            f"SELECT provider, {', '.join(OUTPUT_FIELDS)} FROM transactions {where} "
+            f"ORDER BY {order_by} DESC LIMIT ?"
+        )
+    rows = conn.execute(sql, params + [n]).fetchall()
+    conn.close()
+    return [dict(row) for row in rows]
+
+
+def large_transactions(
+    provider: str = None,
+    start_date: str = None,
+    end_date: str = None,
+    db_path: Path = None,
+) -> dict:
+    """
+    Transactions more than one standard deviation above the mean amount, the
+    rule of `analyze_paylah.stats_on_paylah_transactions`, computed in SQL
+
+    Returns:
+        A dict with the "count", "mean", "std" and "threshold" of the amounts
+        and the "transactions" above the threshold, ordered by date
+    """
+    where, params = _where_clause(start_date, end_date, provider)
+    conn = connect_ledger_readonly(db_path)
+    count, total, total_squares = conn.execute(
+        "SELECT COUNT(*), SUM(txn_amount), SUM(txn_amount * txn_amount) "
+        f"FROM transactions {where}",
+        params,
+    ).fetchone()
+    conn.close()
+    if not count:
+        return {"count": 0, "mean": None, "std": None, "threshold": None, "transactions": []}
+    mean = total / count
+    # population standard deviation, like numpy's default
+    std = max(total_squares / count - mean * mean, 0.0) ** 0.5
+    threshold = mean + std
+    transactions = query_transactions(
+        start_date, end_date, provider, min_amount=threshold, db_path=db_path
+    )
+    return {
+        "count": count,
+        "mean": mean,
+        "std": std,
+        "threshold": threshold,
+        "transactions": transactions,
+    }
+
+
+def load_provider_transactions(provider: str, db_path: Path = None) -> List[dict]:
+    """Convenience wrapper returning all transactions of a provider, amounts as strings"""
+    transactions = query_transactions(provider=provider, db_path=db_path)
+    for txn in transactions:
+        txn["txn_amount"] = f"{txn['txn_amount']:.2f}"
+        txn.pop("provider")
+    return transactions
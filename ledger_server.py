@@ -0,0 +1,286 @@
+import argparse
+import datetime
+import json
+import re
+import sqlite3
+import threading
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+from rich import print
+
+from instrumentation import METRICS
+from ledger import (
+    connect_ledger,
+    large_transactions,
+    ledger_path,
+    ledger_version,
+    query_transactions,
+)
+from rollups import monthly_rollup
+
+OUTPUT_DIR = Path("output")
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+# rendered responses kept in memory, across all endpoints and query strings
+DEFAULT_CACHE_SIZE = 256
+
+_MONTH = re.compile(r"^\d{4}-\d{2}$")
+
+
+def _date(value: str) -> str:
+    return datetime.date.fromisoformat(value).isoformat()
+
+
+def _month(value: str) -> str:
+    if not _MONTH.match(value):
+        raise ValueError(f"expected YYYY-MM, got '{value}'")
+    return value
+
+
+############# Endpoints
+
+# endpoint -> (function of the ledger path and the query parameters,
+#              accepted parameters and their parsers)
+ENDPOINTS: Dict[str, Tuple[Callable, Dict[str, Callable]]] = {
+    "transactions": (
+        lambda db_path, p: query_transactions(
+            start_date=p.get("start"),
+            end_date=p.get("end"),
+            provider=p.get("provider"),
+            txn_type=p.get("txn_type"),
+            txn_to=p.get("txn_to"),
+            min_amount=p.get("min_amount"),
+            db_path=db_path,
+        ),
+        {
+            "start": _date,
+            "end": _date,
+            "provider": str,
+            "txn_type": str,
+            "txn_to": str,
+            "min_amount": float,
+        },
+    ),
+    "monthly": (
+        lambda db_path, p: monthly_rollup(
+            provider=p.get("provider"),
+            txn_type=p.get("txn_type"),
+            start_month=p.get("start"),
+            end_month=p.get("end"),
+            db_path=db_path,
+        ),
+        {"start": _month, "end": _month, "provider": str, "txn_type": str},
+    ),
+    "large": (
+        lambda db_path, p: large_transactions(
+            provider=p.get("provider", "paylah"),
+            start_date=p.get("start"),
+            end_date=p.get("end"),
+            db_path=db_path,
+        ),
+        {"start": _date, "end": _date, "provider": str},
+    ),
+}
+
+
+def parse_params(endpoint: str, query: List[Tuple[str, str]]) -> Tuple[Tuple[str, object], ...]:
+    """
+    Validated query parameters of an endpoint, as a hashable sorted tuple
+
+    Raises:
+        ValueError: for an unknown, repeated or invalid parameter
+    """
+    accepted = ENDPOINTS[endpoint][1]
+    params = {}
+    for name, value in query:
+        if name not in accepted:
+            raise ValueError(f"unknown parameter '{name}' for /{endpoint}")
+        if name in params:
+            raise ValueError(f"parameter '{name}' given twice")
+        try:
+            params[name] = accepted[name](value)
+        except ValueError as e:
+            raise ValueError(f"invalid '{name}': {e}") from None
+    return tuple(sorted(params.items()))
+
+
+class LedgerService:
+    """
+    The query endpoints over one ledger file, with rendered responses cached
+    per ledger version
+
+    The version (see `ledger.ledger_version`) is read with one small query per
+    request. It is the ETag of every response, and part of the cache key, so
+    a cached response is never served after a sync changed the ledger.
+    """
+
+    def __init__(self, db_path: Path, cache_size: int = DEFAULT_CACHE_SIZE):
+        self.db_path = Path(db_path)
+        # create or migrate the ledger once: the query helpers then open it
+        # read-only (`ledger.connect_ledger_readonly`), without any DDL
+        connect_ledger(self.db_path).close()
+        # the handler threads share one read-only connection for the version reads
+        self._conn = sqlite3.connect(
+            f"{self.db_path.resolve().as_uri()}?mode=ro",
+            uri=True,
+            check_same_thread=False,
+        )
+        self._lock = threading.Lock()
+        self._render = lru_cache(maxsize=cache_size)(self._compute)
+
+    def version(self) -> str:
+        with self._lock:
+            return ledger_version(self._conn)
+
+    def _compute(self, version: str, endpoint: str, params: tuple) -> bytes:
+        METRICS.cache_miss("ledger_server")
+        with METRICS.timer(f"serve_{endpoint}"):
+            result = ENDPOINTS[endpoint][0](self.db_path, dict(params))
+            return json.dumps(
+                {"version": version, "result": result}, separators=(",", ":")
+            ).encode()
+
+    def render(self, version: str, endpoint: str, params: tuple) -> bytes:
+        """JSON body of an endpoint, from the cache if already rendered"""
+        hits = self._render.cache_info().hits
+        body = self._render(version, endpoint, params)
+        if self._render.cache_info().hits > hits:
+            METRICS.cache_hit("ledger_server")
+        return body
+
+    def cache_info(self):
+        return self._render.cache_info()
+
+    def close(self):
+        self._conn.close()
+
+
+def _etags(header: str) -> List[str]:
+    """Entity tags of an If-None-Match header, weak tags compared as strong"""
+    tags = []
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag:
+            tags.append(tag)
+    return tags
+
+
+class LedgerRequestHandler(BaseHTTPRequestHandler):
+    """GET /transactions, /monthly, /large and /version as JSON"""
+
+    service: LedgerService = None
+    quiet = False
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        endpoint = url.path.strip("/")
+        if endpoint == "version":
+            self._send_json(200, {"version": self.service.version()})
+            return
+        if endpoint not in ENDPOINTS:
+            endpoints = ", ".join(f"/{name}" for name in ["version", *ENDPOINTS])
+            self._send_json(404, {"error": f"unknown endpoint, use one of {endpoints}"})
+            return
+        try:
+            params = parse_params(endpoint, parse_qsl(url.query))
+        except ValueError as e:
+            self._send_json(400, {"error": str(e)})
+            return
+
+        version = self.service.version()
+        etag = f'"{version}"'
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match and (
+            if_none_match.strip() == "*" or etag in _etags(if_none_match)
+        ):
+            # the client's copy is current: no query, no body
+            METRICS.inc("ledger_server_not_modified")
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        body = self.service.render(version, endpoint, params)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        # the client may keep the response, but has to revalidate it
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status: int, payload: dict):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if not self.quiet:
+            super().log_message(format, *args)
+
+
+def make_server(
+    output_dir: Path = OUTPUT_DIR,
+    host: str = DEFAULT_HOST,
+    port: int = DEFAULT_PORT,
+    cache_size: int = DEFAULT_CACHE_SIZE,
+    quiet: bool = False,
+) -> ThreadingHTTPServer:
+    """
+    HTTP server over the ledger of `output_dir`, one thread per request
+
+    Endpoints (all GET, JSON):
+        /transactions?start=&end=&provider=&txn_type=&txn_to=&min_amount=
+            transactions in an inclusive date range, see `ledger.query_transactions`
+        /monthly?start=YYYY-MM&end=YYYY-MM&provider=&txn_type=
+            monthly totals and counts per provider and txn_type, from the rollup
+        /large?provider=paylah&start=&end=
+            transactions above mean + std, see `ledger.large_transactions`
+        /version
+            the current ledger version
+
+    Returns:
+        The server, not started yet (call `serve_forever`)
+    """
+    service = LedgerService(ledger_path(output_dir), cache_size)
+    handler = type(
+        "BoundLedgerRequestHandler",
+        (LedgerRequestHandler,),
+        {"service": service, "quiet": quiet},
+    )
+    return ThreadingHTTPServer((host, port), handler)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve ledger queries over HTTP, with ETag revalidation"
+    )
+    parser.add_argument("--output-dir", type=Path, default=OUTPUT_DIR)
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_SIZE)
+    parser.add_argument("--quiet", action="store_true", help="do not log requests")
+    args = parser.parse_args()
+
+    server = make_server(
+        args.output_dir, args.host, args.port, args.cache_size, args.quiet
+    )
+    print(f"Serving {ledger_path(args.output_dir)} on http://{args.host}:{args.port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.RequestHandlerClass.service.close()
@@ -1,53 +1,123 @@
 from pathlib import Path
 
+from export_estimate import estimate_export
 from gmail_export import export_email_content
-from parser_fave import main as parse_fave
-from parser_grab import main as parse_grab
-from parser_paylah import main as parse_paylah
+from instrumentation import METRICS
+from memory_budget import MEMORY, parse_kwargs_for_budget
+from pipeline import DEFAULT_FETCH_WORKERS, pipelined_provider_main
+from providers import PROVIDERS
 
 OUTPUT_DIR = Path("output")
 
 
-def paylah_main(output_dir: Path = OUTPUT_DIR):
-    ### Export PayLah Emails
-    paylah_dir = output_dir / "paylah"
-    paylah_dir.mkdir(exist_ok=True, parents=True)
-    export_email_content(
-        out_dir=paylah_dir,
-        sender="paylah.alert@dbs.com",
-        use_cache=True,
-    )
-    ### Parse All PayLah Emails
-    parse_paylah(output_dir=output_dir)
+def provider_main(
+    provider_name: str,
+    output_dir: Path = OUTPUT_DIR,
+    credentials_filepath: str = "credentials.json",
+    token_filepath: str = "token.json",
+    pipelined: bool = False,
+    after: str = None,
+    before: str = None,
+    processed_label: str = None,
+    list_workers: int = 1,
+    memory_budget=None,
+    dry_run: bool = False,
+    normalize_bodies: bool = False,
+):
+    """
+    Export all emails of one provider, then parse them into the master files
+
+    Only transaction emails are fetched: the provider's subject filter is
+    pushed into the Gmail query and checked exactly on a metadata pre-pass.
 
+    Args:
+        pipelined: overlap fetching and parsing, see `pipeline.pipelined_provider_main`
+        after: only export emails on or after this "YYYY-MM-DD" date
+        before: only export emails before this "YYYY-MM-DD" date
+        processed_label: label exported emails and leave them out of later
+            listings, e.g. `gmail_export.PROCESSED_LABEL` (needs a token with
+            the "modify" scope)
+        list_workers: list date windows concurrently, for very large senders
+        memory_budget: memory ceiling such as "512M": sizes the parse batches
+            (and pipeline queue), switches to streaming when the history does
+            not fit, and records the peak memory of every stage in the run report
+        dry_run: download no body, only estimate the cost of the export, see
+            `export_estimate.estimate_export`
+        normalize_bodies: save new emails with compact bodies (styles,
+            scripts and tracking images removed), see `html_normalize`
 
-def fave_main(output_dir: Path = OUTPUT_DIR):
-    ### Export Fave Emails
-    fave_dir = output_dir / "fave"
-    fave_dir.mkdir(exist_ok=True, parents=True)
-    export_email_content(
-        out_dir=fave_dir,
-        sender="hi@myfave.com",
+    Returns:
+        The export summary of `export_email_content`, or the estimate
+    """
+    if dry_run:
+        return estimate_export(
+            provider_name,
+            output_dir=output_dir,
+            credentials_filepath=credentials_filepath,
+            token_filepath=token_filepath,
+            after=after,
+            before=before,
+            processed_label=processed_label,
+            list_workers=list_workers,
+            fetch_workers=DEFAULT_FETCH_WORKERS if pipelined else 1,
+        )
+    if pipelined:
+        return pipelined_provider_main(
+            provider_name,
+            output_dir=output_dir,
+            credentials_filepath=credentials_filepath,
+            token_filepath=token_filepath,
+            after=after,
+            before=before,
+            processed_label=processed_label,
+            list_workers=list_workers,
+            memory_budget=memory_budget,
+            normalize_bodies=normalize_bodies,
+        )
+    if memory_budget:
+        MEMORY.start(memory_budget)
+    provider = PROVIDERS[provider_name]
+    output_dir = Path(output_dir)
+    ### Export Emails
+    provider_dir = output_dir / provider.name
+    provider_dir.mkdir(exist_ok=True, parents=True)
+    summary = export_email_content(
+        out_dir=provider_dir,
+        sender=provider.sender,
         use_cache=True,
+        credentials_filepath=credentials_filepath,
+        token_filepath=token_filepath,
+        extra_query=provider.gmail_query(),
+        subject_filter=provider.is_transaction_subject,
+        processed_label=processed_label,
+        after=after,
+        before=before,
+        list_workers=list_workers,
+        normalize=provider.normalize_email if normalize_bodies else None,
     )
-    ### Parse All Fave Emails
-    parse_fave(output_dir=output_dir)
+    ### Parse All Emails
+    with MEMORY.stage("parse"):
+        provider.parse_main(
+            output_dir=output_dir,
+            **parse_kwargs_for_budget(memory_budget, provider_dir),
+        )
+    return summary
 
 
-def grab_main(output_dir: Path = OUTPUT_DIR):
-    ### Export Grab Emails
-    grab_dir = output_dir / "grab"
-    grab_dir.mkdir(exist_ok=True, parents=True)
-    export_email_content(
-        out_dir=grab_dir,
-        sender="no-reply@grab.com",
-        use_cache=True,
-    )
-    ### Parse All Grab Emails
-    parse_grab(output_dir=output_dir)
+def paylah_main(output_dir: Path = OUTPUT_DIR, pipelined: bool = False):
+    return provider_main("paylah", output_dir, pipelined=pipelined)
+
+
+def fave_main(output_dir: Path = OUTPUT_DIR, pipelined: bool = False):
+    return provider_main("fave", output_dir, pipelined=pipelined)
+
+
+def grab_main(output_dir: Path = OUTPUT_DIR, pipelined: bool = False):
+    return provider_main("grab", output_dir, pipelined=pipelined)
 
 
 if __name__ == "__main__":
     # fave_main()
     # paylah_main()
     grab_main()
+    METRICS.write_reports(OUTPUT_DIR)
@@ -0,0 +1,234 @@
+import os
+import re
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+from rich import print
+
+from instrumentation import METRICS
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# rough in-memory sizes used to turn a byte budget into item counts
+# parsed transaction record (`txn_record.Transaction`), with its unshared strings
+EST_TRANSACTION_BYTES = 512
+# exported message (metadata + HTML body) waiting in the pipeline queue
+EST_MESSAGE_BYTES = 96 * 1024
+
+# shares of the budget given to the parse batches and the pipeline queue; the
+# rest is left for the listed ids, the interpreter and the libraries
+PARSE_SHARE = 0.5
+QUEUE_SHARE = 0.25
+
+MIN_BATCH_SIZE = 500
+MIN_QUEUE_SIZE = 4
+MAX_QUEUE_SIZE = 256
+MAX_FETCH_WORKERS = 4
+
+# allocation sites kept per stage in the run report
+TOP_ALLOCATIONS = 5
+
+_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3}
+
+# allocations of tracemalloc itself and of module imports are not stage memory
+_SNAPSHOT_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+
+def _take_snapshot() -> tracemalloc.Snapshot:
+    return tracemalloc.take_snapshot().filter_traces(_SNAPSHOT_FILTERS)
+
+
+def parse_size(size) -> int:
+    """
+    Args:
+        size: number of bytes, or a string like "512M", "1.5G", "800MB"
+
+    Returns:
+        Number of bytes
+    """
+    if isinstance(size, (int, float)):
+        return int(size)
+    match = re.fullmatch(r"\s*([\d.]+)\s*([KMG]?)I?B?\s*", str(size).upper())
+    if not match:
+        raise ValueError(f"Invalid memory size '{size}', expected e.g. 512M or 2G")
+    return int(float(match.group(1)) * _UNITS[match.group(2)])
+
+
+def count_data_files(provider_dir: Path) -> int:
+    """Number of exported messages, from one directory listing"""
+    if not Path(provider_dir).is_dir():
+        return 0
+    return sum(
+        1
+        for e in os.scandir(provider_dir)
+        if e.name.endswith(".json") and not e.name.startswith(".")
+    )
+
+
+@dataclass(frozen=True)
+class MemoryPlan:
+    budget_bytes: int
+    # messages expected to be parsed
+    n_messages: int
+    streaming: bool
+    batch_size: int
+    queue_size: int
+    fetch_workers: int
+
+    def parse_kwargs(self) -> dict:
+        return {"streaming": self.streaming, "batch_size": self.batch_size}
+
+
+def plan_memory(budget, n_messages: int) -> MemoryPlan:
+    """
+    Size the parse batches and the pipeline queue to fit a memory budget
+
+    The parsers hold every transaction in memory unless they stream, so
+    streaming is switched on once all transactions would not fit in the
+    parse share of the budget. The external sort then spills batches of
+    `batch_size` transactions to disk.
+
+    Args:
+        budget: memory ceiling, see `parse_size`
+        n_messages: number of messages that will be parsed
+
+    Returns:
+        The MemoryPlan, also recorded in the run report
+    """
+    budget_bytes = parse_size(budget)
+    parse_items = int(budget_bytes * PARSE_SHARE) // EST_TRANSACTION_BYTES
+    queue_items = int(budget_bytes * QUEUE_SHARE) // EST_MESSAGE_BYTES
+    queue_size = min(MAX_QUEUE_SIZE, max(MIN_QUEUE_SIZE, queue_items))
+    plan = MemoryPlan(
+        budget_bytes=budget_bytes,
+        n_messages=n_messages,
+        streaming=n_messages > parse_items,
+        batch_size=max(MIN_BATCH_SIZE, parse_items),
+        # every fetching thread holds one more message besides the queue
+        fetch_workers=min(MAX_FETCH_WORKERS, max(1, queue_size // 4)),
+        queue_size=queue_size,
+    )
+    METRICS.extra.setdefault("memory", {})["plan"] = asdict(plan)
+    return plan
+
+
+def parse_kwargs_for_budget(budget, provider_dir: Path) -> dict:
+    """
+    Keyword arguments of `Provider.parse_main` for a memory budget, or no
+    arguments (the in-memory defaults) without a budget
+
+    Args:
+        budget: memory ceiling, or None
+        provider_dir: directory of the exported messages
+    """
+    if not budget:
+        return {}
+    return plan_memory(budget, count_data_files(provider_dir)).parse_kwargs()
+
+
+class MemoryTracker:
+    """
+    Peak Python heap usage per stage, measured with tracemalloc.
+
+    Stages may be nested or run concurrently in threads: tracemalloc has a
+    single process-wide peak, so on every stage boundary the peak so far is
+    folded into all open stages before it is reset. The allocation sites
+    that grew most during a stage are found by comparing the tracemalloc
+    snapshots taken at its start and end.
+
+    Tracking is off (and free) until `start` is called.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._open = {}
+        self.budget_bytes = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.budget_bytes is not None and tracemalloc.is_tracing()
+
+    def start(self, budget):
+        """Start tracing against a memory budget (see `parse_size`)"""
+        self.budget_bytes = parse_size(budget)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        METRICS.extra.setdefault("memory", {})["budget_bytes"] = self.budget_bytes
+
+    def stop(self):
+        tracemalloc.stop()
+        self.budget_bytes = None
+        self._open.clear()
+
+    def _fold_peak(self):
+        _, peak = tracemalloc.get_traced_memory()
+        for entry in self._open.values():
+            entry["peak"] = max(entry["peak"], peak)
+        tracemalloc.reset_peak()
+
+    @contextmanager
+    def stage(self, name: str, snapshot: bool = True):
+        """
+        Record the peak memory of the enclosed code as `name`
+
+        Args:
+            name: stage name used in the run report
+            snapshot: also record the top allocation sites; taking snapshots
+                is slow on large heaps, so leave it off for short stages
+        """
+        if not self.enabled:
+            yield
+            return
+        token = object()
+        with self._lock:
+            self._fold_peak()
+            current, _ = tracemalloc.get_traced_memory()
+            self._open[token] = {"start": current, "peak": current}
+        before = _take_snapshot() if snapshot else None
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._fold_peak()
+                entry = self._open.pop(token)
+            self._record(name, entry, before)
+
+    def _record(self, name: str, entry: dict, before):
+        stats = {
+            "peak_bytes": entry["peak"],
+            "growth_bytes": entry["peak"] - entry["start"],
+        }
+        if resource is not None:
+            # ru_maxrss is in KiB on Linux: the process high-water mark,
+            # including memory tracemalloc does not see (C extensions)
+            stats["max_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        if before is not None:
+            diff = _take_snapshot().compare_to(before, "lineno")
+            growth = [d for d in diff if d.size_diff > 0][:TOP_ALLOCATIONS]
+            stats["top_allocations"] = {str(d.traceback[0]): d.size_diff for d in growth}
+        with self._lock:
+            stages = METRICS.extra.setdefault("memory", {}).setdefault("stages", {})
+            previous = stages.get(name)
+            if previous is None or previous["peak_bytes"] <= stats["peak_bytes"]:
+                stages[name] = stats
+        if self.budget_bytes and entry["peak"] > self.budget_bytes:
+            METRICS.inc("memory_budget_exceeded")
+            print(
+                f"[yellow]Stage '{name}' peaked at {entry['peak'] / 2**20:.1f} MiB, "
+                f"over the budget of {self.budget_bytes / 2**20:.1f} MiB"
+            )
+
+
+# process-wide tracker used by all modules
+MEMORY = MemoryTracker()
@@ -0,0 +1,243 @@
+import argparse
+import json
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import List
+
+from rich import print
+
+from atomic_io import atomic_write_text
+from gmail_export import export_email_content
+from instrumentation import METRICS
+from memory_budget import MEMORY, parse_kwargs_for_budget
+from providers import PROVIDERS
+
+AGGREGATE_REPORT_FILENAME = "multi_account_report.json"
+
+EXAMPLE_MANIFEST = """
+{
+    "max_concurrent_accounts": 4,
+    "accounts": [
+        {
+            "name": "household",
+            "credentials": "credentials.json",
+            "token": "tokens/household.json",
+            "output_root": "output/household",
+            "providers": ["paylah", "fave", "grab"],
+            "max_concurrency": 3,
+            "processed_label": null,
+            "memory_budget": "1G",
+            "normalize_bodies": false
+        }
+    ]
+}
+"""
+
+
+def load_manifest(manifest_path: Path) -> dict:
+    """
+    Load an accounts manifest (see EXAMPLE_MANIFEST). Relative paths are
+    resolved against the directory of the manifest file.
+
+    Raises:
+        ValueError: on duplicate account names or unknown providers
+    """
+    manifest_path = Path(manifest_path)
+    with manifest_path.open("r") as f:
+        manifest = json.load(f)
+
+    base = manifest_path.parent
+    names = set()
+    for account in manifest["accounts"]:
+        if account["name"] in names:
+            raise ValueError(f"Duplicate account '{account['name']}'")
+        names.add(account["name"])
+        for key, default in [
+            ("credentials", "credentials.json"),
+            ("token", f"tokens/{account['name']}.json"),
+            ("output_root", f"output/{account['name']}"),
+        ]:
+            account[key] = str(base / account.get(key, default))
+        account.setdefault("providers", list(PROVIDERS))
+        account.setdefault("max_concurrency", len(account["providers"]))
+        for provider_name in account["providers"]:
+            if provider_name not in PROVIDERS:
+                raise ValueError(f"Unknown provider '{provider_name}'")
+    return manifest
+
+
+def run_account(account: dict) -> dict:
+    """
+    Export and parse every provider of one account. Runs in its own worker
+    process, so accounts never share a Gmail service, metrics or open files.
+
+    Providers are exported concurrently (up to `max_concurrency` at once);
+    parsing is serialized per account because all providers write into the
+    same ledger and statistics files.
+
+    With a "memory_budget", the account's budget is shared evenly by its
+    concurrent providers. With "normalize_bodies", new emails are saved with
+    compact bodies, see `html_normalize`.
+    """
+    METRICS.reset()
+    memory_budget = account.get("memory_budget")
+    provider_budget = None
+    if memory_budget:
+        MEMORY.start(memory_budget)
+        provider_budget = MEMORY.budget_bytes // account["max_concurrency"]
+    try:
+        start = time.time()
+        output_root = Path(account["output_root"])
+        output_root.mkdir(exist_ok=True, parents=True)
+        parse_lock = threading.Lock()
+
+        def _run_provider(provider_name: str) -> dict:
+            provider = PROVIDERS[provider_name]
+            provider_dir = output_root / provider.name
+            provider_dir.mkdir(exist_ok=True, parents=True)
+            with MEMORY.stage(f"export_{provider_name}"):
+                summary = export_email_content(
+                    out_dir=provider_dir,
+                    sender=provider.sender,
+                    use_cache=True,
+                    credentials_filepath=account["credentials"],
+                    token_filepath=account["token"],
+                    extra_query=provider.gmail_query(),
+                    subject_filter=provider.is_transaction_subject,
+                    processed_label=account.get("processed_label"),
+                    normalize=provider.normalize_email
+                    if account.get("normalize_bodies")
+                    else None,
+                )
+            if summary is None:
+                raise RuntimeError(
+                    f"Authentication failed for token {account['token']}"
+                )
+            with parse_lock, MEMORY.stage(f"parse_{provider_name}"):
+                provider.parse_main(
+                    output_dir=output_root,
+                    **parse_kwargs_for_budget(provider_budget, provider_dir),
+                )
+            return summary
+
+        results = {}
+        with ThreadPoolExecutor(max_workers=account["max_concurrency"]) as executor:
+            futures = {
+                executor.submit(_run_provider, name): name
+                for name in account["providers"]
+            }
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    results[name] = dict(future.result(), status="ok")
+                except Exception as e:
+                    traceback.print_exc()
+                    results[name] = {"status": "failed", "error": str(e)}
+
+        report = METRICS.write_reports(output_root)
+        return {
+            "name": account["name"],
+            "output_root": str(output_root),
+            "status": "ok"
+            if all(r["status"] == "ok" for r in results.values())
+            else "failed",
+            "seconds": round(time.time() - start, 3),
+            "providers": results,
+            "stages": report["stages"],
+            "caches": report["caches"],
+            "memory": report.get("memory"),
+        }
+    finally:
+        if memory_budget:
+            MEMORY.stop()
+
+
+def run_all_accounts(
+    manifest: dict,
+    max_concurrent_accounts: int = None,
+    only: List[str] = None,
+    memory_budget: str = None,
+) -> dict:
+    """
+    Run every account of the manifest in isolated worker processes
+
+    Args:
+        manifest: loaded manifest, see `load_manifest`
+        max_concurrent_accounts: global limit of accounts processed at once,
+            overrides the manifest's "max_concurrent_accounts"
+        only: optional list of account names to run
+        memory_budget: memory ceiling of each account process (e.g. "1G"),
+            for the accounts without a "memory_budget" in the manifest
+
+    Returns:
+        The aggregate report
+    """
+    accounts = [a for a in manifest["accounts"] if not only or a["name"] in only]
+    for account in accounts:
+        account.setdefault("memory_budget", memory_budget)
+    max_workers = max_concurrent_accounts or manifest.get("max_concurrent_accounts", 4)
+    start = time.time()
+
+    account_reports = []
+    with ProcessPoolExecutor(max_workers=max(1, min(max_workers, len(accounts)))) as executor:
+        futures = {executor.submit(run_account, a): a["name"] for a in accounts}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                account_report = future.result()
+            except Exception as e:
+                account_report = {"name": name, "status": "failed", "error": str(e)}
+            print(f"Account {name}: {account_report['status']}")
+            account_reports.append(account_report)
+
+    totals = {
+        "listed": 0,
+        "skipped": 0,
+        "cached": 0,
+        "fetched": 0,
+        "failed": 0,
+        "labeled": 0,
+    }
+    for account_report in account_reports:
+        for result in account_report.get("providers", {}).values():
+            for key in totals:
+                totals[key] += result.get(key, 0)
+
+    return {
+        "wall_seconds": round(time.time() - start, 3),
+        "accounts_ok": sum(r["status"] == "ok" for r in account_reports),
+        "accounts_failed": sum(r["status"] != "ok" for r in account_reports),
+        "totals": totals,
+        "accounts": sorted(account_reports, key=lambda r: r["name"]),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export and parse many Gmail accounts concurrently",
+        epilog=f"Example manifest:\n{EXAMPLE_MANIFEST}",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("manifest", type=Path)
+    parser.add_argument("--max-accounts", type=int, help="global concurrency limit")
+    parser.add_argument("--only", nargs="*", help="account names to run")
+    parser.add_argument(
+        "--memory-budget", help='memory ceiling per account process, e.g. "1G"'
+    )
+    parser.add_argument(
+        "--report", type=Path, default=Path("output") / AGGREGATE_REPORT_FILENAME
+    )
+    args = parser.parse_args()
+
+    report = run_all_accounts(
+        load_manifest(args.manifest),
+        max_concurrent_accounts=args.max_accounts,
+        only=args.only,
+        memory_budget=args.memory_budget,
+    )
+    args.report.parent.mkdir(exist_ok=True, parents=True)
+    atomic_write_text(args.report, json.dumps(report, indent=4))
+    print(f"Saved aggregate report to {args.report}")
@@ -0,0 +1,352 @@
+import math
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Union
+
+from rich import print
+
+import codec
+from ledger import (
+    connect_ledger,
+    ledger_path,
+    ledger_version,
+    query_transactions,
+    sync_provider,
+)
+from txn_record import Transaction
+
+OUT_DIR = Path("output")
+SPEND_STATS_FILENAME = "spend_stats.json"
+
+
+class RunningStats:
+    """
+    Streaming count / mean / variance (Welford), mergeable with Chan's
+    parallel formula so that statistics of separate runs or shards combine
+    exactly.
+    """
+
+    def __init__(self, count=0, mean=0.0, m2=0.0, min=None, max=None):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+        self.min = min
+        self.max = max
+
+    def update(self, x: float):
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+        self.min = x if self.min is None else min(self.min, x)
+        self.max = x if self.max is None else max(self.max, x)
+
+    def merge(self, other: "RunningStats"):
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.__init__(**other.to_dict())
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def total(self) -> float:
+        return self.mean * self.count
+
+    @property
+    def variance(self) -> float:
+        # population variance, same as np.std's default
+        return self.m2 / self.count if self.count else 0.0
+
+    @property
+    def std(self) -> float:
+        return math.sqrt(self.variance)
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "m2": self.m2,
+            "min": self.min,
+            "max": self.max,
+        }
+
+
+class QuantileSketch:
+    """
+    Log-bucketed quantile sketch (DDSketch style).
+
+    Values are counted in buckets whose boundaries grow geometrically by
+    `gamma`, which bounds the relative error of every quantile by
+    `relative_accuracy`. Two sketches with the same accuracy merge by adding
+    their bucket counts, so merging is exact and order independent.
+    """
+
+    def __init__(self, relative_accuracy: float = 0.01, buckets=None, zero_count=0):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.buckets: Dict[int, int] = {int(k): v for k, v in (buckets or {}).items()}
+        self.zero_count = zero_count  # values <= 0 (e.g. unparsed amounts)
+
+    @property
+    def count(self) -> int:
+        return self.zero_count + sum(self.buckets.values())
+
+    def _index(self, x: float) -> int:
+        return math.ceil(math.log(x) / self._log_gamma)
+
+    def _value(self, index: int) -> float:
+        # midpoint of the bucket (gamma^(i-1), gamma^i]
+        return 2 * self.gamma**index / (self.gamma + 1)
+
+    def update(self, x: float):
+        if x <= 0:
+            self.zero_count += 1
+            return
+        index = self._index(x)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def merge(self, other: "QuantileSketch"):
+        if self.relative_accuracy != other.relative_accuracy:
+            raise ValueError("Cannot merge sketches with different accuracy")
+        self.zero_count += other.zero_count
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+
+    def quantile(self, q: float) -> Optional[float]:
+        total = self.count
+        if total == 0:
+            return None
+        rank = q * (total - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if rank < seen:
+                return self._value(index)
+        return self._value(max(self.buckets))
+
+    def rank(self, x: float) -> float:
+        """Approximate fraction of observed values <= x"""
+        total = self.count
+        if total == 0:
+            return 0.0
+        if x <= 0:
+            return self.zero_count / total
+        limit = self._index(x)
+        below = self.zero_count + sum(c for i, c in self.buckets.items() if i <= limit)
+        return below / total
+
+    def to_dict(self) -> dict:
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "zero_count": self.zero_count,
+            "buckets": {str(k): v for k, v in self.buckets.items()},
+        }
+
+
+class AmountStats:
+    """Running moments plus a quantile sketch of transaction amounts"""
+
+    def __init__(self, moments: RunningStats = None, sketch: QuantileSketch = None):
+        self.moments = moments or RunningStats()
+        self.sketch = sketch or QuantileSketch()
+
+    def update(self, amount: float):
+        self.moments.update(amount)
+        self.sketch.update(amount)
+
+    def merge(self, other: "AmountStats"):
+        self.moments.merge(other.moments)
+        self.sketch.merge(other.sketch)
+
+    def to_dict(self) -> dict:
+        return {"moments": self.moments.to_dict(), "sketch": self.sketch.to_dict()}
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "AmountStats":
+        return cls(RunningStats(**d["moments"]), QuantileSketch(**d["sketch"]))
+
+
+class SpendStatsEngine:
+    """
+    Per-provider and per-counterparty amount statistics that are updated one
+    transaction at a time, persisted as JSON, and mergeable across runs/shards.
+
+    A transaction is flagged as large with the same rule the PayLah stats have
+    always used (amount > mean + std of the provider), evaluated against the
+    statistics *before* the transaction is added.
+
+    The statistics describe one ledger content: `ledger_version` (see
+    `ledger.ledger_version`) is saved with them, and `for_ledger` rebuilds
+    them from the ledger when it no longer matches.
+    """
+
+    def __init__(
+        self,
+        groups: Dict[str, AmountStats] = None,
+        min_count: int = 30,
+        ledger_version: Optional[str] = None,
+    ):
+        self.groups: Dict[str, AmountStats] = groups or {}
+        # don't flag anything until a group has seen enough history
+        self.min_count = min_count
+        self.ledger_version = ledger_version
+
+    @staticmethod
+    def provider_key(provider: str) -> str:
+        return f"provider:{provider}"
+
+    @staticmethod
+    def counterparty_key(provider: str, txn_to: str) -> str:
+        return f"txn_to:{provider}:{txn_to or ''}"
+
+    def get(self, key: str) -> AmountStats:
+        if key not in self.groups:
+            self.groups[key] = AmountStats()
+        return self.groups[key]
+
+    def score(self, provider: str, txn: Union[Transaction, dict]) -> dict:
+        """
+        Score a transaction against the current statistics
+
+        Returns:
+            A dictionary with the provider z-score, the approximate quantile rank
+            within the provider and within the counterparty, and `is_large`
+        """
+        amount = float(txn.get("txn_amount") or 0)
+        stats = self.get(self.provider_key(provider))
+        party = self.get(self.counterparty_key(provider, txn.get("txn_to")))
+        moments = stats.moments
+        zscore = (amount - moments.mean) / moments.std if moments.std else 0.0
+        return {
+            "zscore": zscore,
+            "provider_rank": stats.sketch.rank(amount),
+            "counterparty_rank": party.sketch.rank(amount),
+            "is_large": moments.count >= self.min_count
+            and amount > moments.mean + moments.std,
+        }
+
+    def update(self, provider: str, txn: Union[Transaction, dict]):
+        amount = float(txn.get("txn_amount") or 0)
+        self.get(self.provider_key(provider)).update(amount)
+        self.get(self.counterparty_key(provider, txn.get("txn_to"))).update(amount)
+
+    def score_and_update(
+        self, provider: str, txn: Union[Transaction, dict]
+    ) -> dict:
+        result = self.score(provider, txn)
+        self.update(provider, txn)
+        return result
+
+    def new_transaction_callback(self, provider: str):
+        """
+        Callback for `ledger.sync_provider(on_new=...)` that scores every newly
+        added transaction, reports large ones, and folds it into the stats
+        """
+
+        def _on_new(txn: dict):
+            result = self.score_and_update(provider, txn)
+            if result["is_large"]:
+                print(
+                    f"[bold red]Large transaction[/bold red]: ${txn['txn_amount']} to {txn.get('txn_to')} on {txn.get('txn_date')} (z={result['zscore']:.1f})"
+                )
+
+        return _on_new
+
+    def merge(self, other: "SpendStatsEngine"):
+        for key, stats in other.groups.items():
+            self.get(key).merge(stats)
+
+    ############# Ledger
+
+    def rebuild(self, output_dir: Path = OUT_DIR):
+        """Recompute the statistics from every transaction of the ledger"""
+        db_path = ledger_path(output_dir)
+        conn = connect_ledger(db_path)
+        version = ledger_version(conn)
+        conn.close()
+        self.groups = {}
+        for txn in query_transactions(db_path=db_path):
+            self.update(txn["provider"], txn)
+        self.ledger_version = version
+
+    @classmethod
+    def for_ledger(cls, output_dir: Path = OUT_DIR) -> "SpendStatsEngine":
+        """
+        The saved statistics, rebuilt from the ledger if they do not match
+        its current version: saved before versions existed, missing, or
+        left behind by a sync that did not update them, or by a new ledger
+        """
+        engine = cls.load(output_dir)
+        conn = connect_ledger(ledger_path(output_dir))
+        version = ledger_version(conn)
+        conn.close()
+        if engine.ledger_version != version:
+            print("Rebuilding the spend statistics from the ledger")
+            engine.rebuild(output_dir)
+        return engine
+
+    def sync_provider(
+        self,
+        provider: str,
+        transactions: Iterable[Transaction],
+        output_dir: Path = OUT_DIR,
+    ) -> int:
+        """
+        `ledger.sync_provider` that keeps the statistics in step: new
+        transactions are scored and added. A removed one cannot be taken
+        out exactly (the running minimum and maximum are not invertible),
+        so if any row is removed the statistics are rebuilt instead.
+
+        Returns:
+            Number of newly inserted transactions
+        """
+        removed = []
+        inserted = sync_provider(
+            provider,
+            transactions,
+            db_path=ledger_path(output_dir),
+            on_new=self.new_transaction_callback(provider),
+            on_removed=removed.append,
+        )
+        if removed:
+            self.rebuild(output_dir)
+        else:
+            conn = connect_ledger(ledger_path(output_dir))
+            self.ledger_version = ledger_version(conn)
+            conn.close()
+        return inserted
+
+    ############# Persistence
+
+    def to_dict(self) -> dict:
+        return {
+            "ledger_version": self.ledger_version,
+            "groups": {key: stats.to_dict() for key, stats in self.groups.items()},
+        }
+
+    def save(self, output_dir: Path = OUT_DIR):
+        path = Path(output_dir) / SPEND_STATS_FILENAME
+        codec.dump(self.to_dict(), path)
+
+    @classmethod
+    def load(cls, output_dir: Path = OUT_DIR) -> "SpendStatsEngine":
+        path = Path(output_dir) / SPEND_STATS_FILENAME
+        if not path.exists():
+            return cls()
+        data = codec.load(path)
+        if "groups" not in data:
+            # saved without a ledger version: `for_ledger` rebuilds it
+            return cls({key: AmountStats.from_dict(d) for key, d in data.items()})
+        return cls(
+            {key: AmountStats.from_dict(d) for key, d in data["groups"].items()},
+            ledger_version=data["ledger_version"],
+        )
@@ -1,12 +1,22 @@
 import csv
-import json
 import os
+from operator import attrgetter
 from pathlib import Path
+from typing import Iterable, Optional
 
 from bs4 import BeautifulSoup
 
+import codec
+from atomic_io import atomic_write
+from categorize import categorize_transaction
+from instrumentation import METRICS, instrument
+from online_stats import SpendStatsEngine
+from streaming import stream_master_outputs
+from txn_record import Transaction
 
-def parse_fave_html(html_str: str) -> dict:
+
+@instrument("parse_fave_html")
+def parse_fave_html(html_str: str) -> Transaction:
     # make soup
     soup = BeautifulSoup(html_str, "html.parser")
 
@@ -49,54 +59,98 @@ def parse_fave_html(html_str: str) -> dict:
         else:
             pass
 
-    data_dict = {
-        "txn_type": "Fave",
-        "txn_id": txn_id,
-        "txn_date": None,
-        "txn_time": txn_time,
-        "txn_amount": txn_amount,
-        "txn_from": "me",
-        "txn_to": txn_to,
-    }
-
-    return data_dict
-
-
-def main(output_dir="output"):
+    return Transaction(
+        txn_type="Fave",
+        txn_id=txn_id,
+        txn_time=txn_time,
+        txn_amount=txn_amount,
+        txn_from="me",
+        txn_to=txn_to,
+        provider="fave",
+    )
+
+
+def transaction_from_email(email_data: dict, source=None) -> Optional[Transaction]:
+    """
+    Parse one exported Fave email (metadata + decoded body)
+
+    Args:
+        email_data: the dictionary saved by `gmail_export.export_message`
+        source: where the email came from, only used in log messages
+
+    Returns:
+        The transaction record, or None if it is not a FavePay receipt
+    """
+    source = source or email_data.get("id")
+    fave_html = email_data.get("body")
+    subject = email_data.get("subject")
+    if not subject.startswith("Your FavePay Receipt"):
+        return None
+
+    txn = parse_fave_html(fave_html)
+    if txn is None:
+        print(f"Skipping '{source}' (likely not a transaction email)")
+        return None
+
+    txn.txn_date = email_data["date"]
+    return categorize_transaction(txn)
+
+
+def iter_fave_transactions(fave_dir: Path):
+    """
+    Lazily parse every exported FavePay receipt in `fave_dir`, one file at a time
+    """
+    for entry in os.scandir(fave_dir):
+        if not entry.name.endswith(".json"):
+            continue
+        fave_file = fave_dir / entry.name
+        with METRICS.timer("read_message"):
+            email_data = codec.load(fave_file)
+
+        txn = transaction_from_email(email_data, source=fave_file)
+        if txn is not None:
+            yield txn
+
+
+def main(
+    output_dir="output",
+    streaming: bool = False,
+    batch_size: int = 5000,
+    transactions: Iterable[Transaction] = None,
+):
+    """
+    Parse all exported Fave emails into the master files and the ledger
+
+    Args:
+        output_dir: root output directory
+        streaming: bounded-memory mode, see `streaming.stream_master_outputs`
+        batch_size: sort batch size of the streaming mode
+        transactions: already parsed transactions (e.g. from `pipeline`),
+            instead of parsing every file of the Fave directory
+    """
     output_dir = Path(output_dir)
     fave_dir = output_dir / "fave"
-    fave_files = os.listdir(fave_dir)
-    fave_files = [fave_dir / i for i in fave_files if i.endswith(".json")]
+    if transactions is None:
+        transactions = iter_fave_transactions(fave_dir)
 
-    all_data_dicts = []
-    for fave_file in fave_files:
-        with open(fave_file, "r") as f:
-            email_data = json.load(f)
-
-        fave_html = email_data.get("body")
-        subject = email_data.get("subject")
-        if not subject.startswith("Your FavePay Receipt"):
-            continue
-
-        data_dict = parse_fave_html(fave_html)
-        if not data_dict:
-            print(f"Skipping '{fave_file}' (likely not a transaction email)")
-            continue
+    if streaming:
+        # bounded memory: external sort + incremental JSON / JSONL / CSV output
+        stream_master_outputs(transactions, output_dir, "fave", batch_size)
+        return
 
-        date_str = email_data["date"]
-        data_dict["txn_date"] = date_str
-        all_data_dicts.append(data_dict)
+    all_txns = list(transactions)
 
     # sort by date
-    all_data_dicts.sort(key=lambda x: x["txn_date"])
+    all_txns.sort(key=attrgetter("date_ordinal"))
 
     out_json = output_dir / "master_fave.json"
-    with out_json.open("w") as f:
-        json.dump(all_data_dicts, f, indent=4)
-        print(f"Saved {len(all_data_dicts)} transactions to {out_json}")
+    with METRICS.timer("write_master_json"):
+        # the master files stay indented JSON, they are meant to be opened by hand
+        codec.dump([txn.to_dict() for txn in all_txns], out_json, codec="json")
+        print(f"Saved {len(all_txns)} transactions to {out_json}")
 
     out_csv = output_dir / "master_fave.csv"
-    with out_csv.open("w") as f:
+    with METRICS.timer("write_master_csv"), atomic_write(out_csv) as f:
         fieldnames = [
             "txn_type",
             "txn_id",
@@ -105,11 +159,19 @@ def main(output_dir="output"):
             "txn_amount",
             "txn_from",
             "txn_to",
+            "txn_category",
         ]
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(all_data_dicts)
-        print(f"Saved {len(all_data_dicts)} transactions to {out_csv}")
+        writer = csv.writer(f)
+        writer.writerow(fieldnames)
+        writer.writerows(txn.to_row(fieldnames) for txn in all_txns)
+        print(f"Saved {len(all_txns)} transactions to {out_csv}")
+
+    # score every transaction that is new to the ledger for anomalies
+    spend_stats = SpendStatsEngine.for_ledger(output_dir)
+    with METRICS.timer("ledger_sync"):
+        inserted = spend_stats.sync_provider("fave", all_txns, output_dir)
+    spend_stats.save(output_dir)
+    print(f"Added {inserted} new transactions to the ledger")
 
 
 if __name__ == "__main__":
@@ -1,12 +1,21 @@
 import csv
-import json
 import os
+from operator import attrgetter
 from pathlib import Path
-from typing import List
+from typing import Iterable, List, Optional
 
 from bs4 import BeautifulSoup
 from rich import print
 
+import codec
+from atomic_io import atomic_write
+from categorize import categorize_transaction
+from html_normalize import strip_styles
+from instrumentation import METRICS, instrument
+from online_stats import SpendStatsEngine
+from streaming import stream_master_outputs
+from txn_record import Transaction
+
 
 def get_pure_string(html_str):
     """
@@ -51,19 +60,15 @@ def clean_html_styles(html_str):
     # Parse the HTML with BeautifulSoup
     soup = BeautifulSoup(html_str, "lxml")
 
-    # Remove all style attributes
-    for tag in soup.find_all(style=True):
-        del tag["style"]
-
-    # Remove all <style> tags
-    for style_tag in soup.find_all("style"):
-        style_tag.decompose()
+    # Remove all style attributes and <style> tags
+    strip_styles(soup)
 
     # Return the prettified HTML
     return soup.prettify()
 
 
-def parse_grab_html(html_str: str) -> dict:
+@instrument("parse_grab_html")
+def parse_grab_html(html_str: str) -> Transaction:
     pure_str: str = get_pure_string(html_str).lower()
 
     data_lst: List[str] = get_txt_data_lst(html_str)
@@ -96,61 +101,103 @@ def parse_grab_html(html_str: str) -> dict:
 
         txn_amount = f"{float(txn_amount):.2f}"
 
-    data_dict = {
-        "txn_type": txn_type,
-        "txn_id": None,
-        "txn_date": None,
-        "txn_time": None,
-        "txn_amount": txn_amount,
-        "txn_from": "me",
-        "txn_to": "Grab",
-    }
-    # print(data_dict)
+    return Transaction(
+        txn_type=txn_type,
+        txn_amount=txn_amount,
+        txn_from="me",
+        txn_to="Grab",
+        provider="grab",
+    )
 
-    return data_dict
 
+def transaction_from_email(email_data: dict, source=None) -> Optional[Transaction]:
+    """
+    Parse one exported Grab email (metadata + decoded body)
 
-def main(output_dir="output"):
-    output_dir = Path(output_dir)
-    grab_dir = output_dir / "grab"
-    grab_files = os.listdir(grab_dir)
-    grab_files = [grab_dir / i for i in grab_files if i.endswith(".json")]
+    Args:
+        email_data: the dictionary saved by `gmail_export.export_message`
+        source: where the email came from, only used in log messages
 
-    all_data_dicts = []
-    for grab_file in grab_files:
-        with open(grab_file, "r") as f:
-            email_data = json.load(f)
+    Returns:
+        The transaction record, or None if it is not an e-receipt
+    """
+    source = source or email_data.get("id")
+    _id = email_data.get("id")
+    _date = email_data.get("date")
+    subject = email_data.get("subject")
+    body = email_data.get("body")
 
-        _id = email_data.get("id")
-        _date = email_data.get("date")
-        subject = email_data.get("subject")
-        body = email_data.get("body")
+    is_receipt = "e-receipt" in subject.lower()
 
-        is_receipt = "e-receipt" in subject.lower()
+    if not is_receipt:
+        return None
+
+    if not body:
+        print(f"Skipping '{source}' as no body")
+        return None
+
+    txn = parse_grab_html(body)
+
+    txn.txn_id = _id
+    txn.txn_date = _date
+    return categorize_transaction(txn)
 
-        if not is_receipt:
-            continue
 
-        if not body:
-            print(f"Skipping '{grab_file}' as no body")
+def iter_grab_transactions(grab_dir: Path):
+    """
+    Lazily parse every exported Grab e-receipt in `grab_dir`, one file at a time
+    """
+    for entry in os.scandir(grab_dir):
+        if not entry.name.endswith(".json"):
             continue
+        grab_file = grab_dir / entry.name
+        with METRICS.timer("read_message"):
+            email_data = codec.load(grab_file)
+
+        txn = transaction_from_email(email_data, source=grab_file)
+        if txn is not None:
+            yield txn
+
+
+def main(
+    output_dir="output",
+    streaming: bool = False,
+    batch_size: int = 5000,
+    transactions: Iterable[Transaction] = None,
+):
+    """
+    Parse all exported Grab emails into the master files and the ledger
+
+    Args:
+        output_dir: root output directory
+        streaming: bounded-memory mode, see `streaming.stream_master_outputs`
+        batch_size: sort batch size of the streaming mode
+        transactions: already parsed transactions (e.g. from `pipeline`),
+            instead of parsing every file of the Grab directory
+    """
+    output_dir = Path(output_dir)
+    grab_dir = output_dir / "grab"
+    if transactions is None:
+        transactions = iter_grab_transactions(grab_dir)
 
-        data_dict = parse_grab_html(body)
+    if streaming:
+        # bounded memory: external sort + incremental JSON / JSONL / CSV output
+        stream_master_outputs(transactions, output_dir, "grab", batch_size)
+        return
 
-        data_dict["txn_id"] = _id
-        data_dict["txn_date"] = _date
-        all_data_dicts.append(data_dict)
+    all_txns = list(transactions)
 
     # sort by date
-    all_data_dicts.sort(key=lambda x: x["txn_date"])
+    all_txns.sort(key=attrgetter("date_ordinal"))
 
     out_json = output_dir / "master_grab.json"
-    with out_json.open("w") as f:
-        json.dump(all_data_dicts, f, indent=4)
-        print(f"Saved {len(all_data_dicts)} transactions to {out_json}")
+    with METRICS.timer("write_master_json"):
+        # the master files stay indented JSON, they are meant to be opened by hand
+        codec.dump([txn.to_dict() for txn in all_txns], out_json, codec="json")
+        print(f"Saved {len(all_txns)} transactions to {out_json}")
 
     out_csv = output_dir / "master_grab.csv"
-    with out_csv.open("w") as f:
+    with METRICS.timer("write_master_csv"), atomic_write(out_csv) as f:
         fieldnames = [
             "txn_type",
             "txn_id",
@@ -159,12 +206,19 @@ def main(output_dir="output"):
             "txn_amount",
             "txn_from",
             "txn_to",
+            "txn_category",
         ]
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        for data_dict in all_data_dicts:
-            writer.writerow(data_dict)
-        print(f"Saved {len(all_data_dicts)} transactions to {out_csv}")
+        writer = csv.writer(f)
+        writer.writerow(fieldnames)
+        writer.writerows(txn.to_row(fieldnames) for txn in all_txns)
+        print(f"Saved {len(all_txns)} transactions to {out_csv}")
+
+    # score every transaction that is new to the ledger for anomalies
+    spend_stats = SpendStatsEngine.for_ledger(output_dir)
+    with METRICS.timer("ledger_sync"):
+        inserted = spend_stats.sync_provider("grab", all_txns, output_dir)
+    spend_stats.save(output_dir)
+    print(f"Added {inserted} new transactions to the ledger")
 
 
 if __name__ == "__main__":
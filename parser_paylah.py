@@ -1,13 +1,23 @@
 import csv
-import json
 import os
+from operator import attrgetter
 from pathlib import Path
+from typing import Iterable, Optional
 from re import compile
 
 from bs4 import BeautifulSoup
 
+import codec
+from atomic_io import atomic_write
+from categorize import categorize_transaction
+from instrumentation import METRICS, instrument
+from online_stats import SpendStatsEngine
+from streaming import stream_master_outputs
+from txn_record import Transaction
 
-def parse_paylah_html(html_str: str) -> dict:
+
+@instrument("parse_paylah_html")
+def parse_paylah_html(html_str: str) -> Optional[Transaction]:
     # make soup
     soup = BeautifulSoup(html_str, "html.parser")
 
@@ -52,44 +62,90 @@ def parse_paylah_html(html_str: str) -> dict:
     # simplify txn_from
     if "0920" in data_dict["txn_from"]:
         data_dict["txn_from"] = "me"
-    return data_dict
+    return Transaction(**data_dict, provider="paylah")
 
 
-def main(output_dir="output"):
-    output_dir = Path(output_dir)
-    paylah_dir = output_dir / "paylah"
-    paylah_files = os.listdir(paylah_dir)
-    paylah_files = [paylah_dir / i for i in paylah_files if i.endswith(".json")]
+def transaction_from_email(email_data: dict, source=None) -> Optional[Transaction]:
+    """
+    Parse one exported PayLah email (metadata + decoded body)
 
-    all_data_dicts = []
-    for paylah_file in paylah_files:
-        with open(paylah_file, "r") as f:
-            email_data = json.load(f)
+    Args:
+        email_data: the dictionary saved by `gmail_export.export_message`
+        source: where the email came from, only used in log messages
+
+    Returns:
+        The transaction record, or None if it is not a transaction alert
+    """
+    source = source or email_data.get("id")
+    paylah_html = email_data.get("body")
+    if email_data["subject"] != "Transaction Alerts":
+        print(f"Skipping '{source}' (likely not a transaction email)")
+        return None
+
+    txn = parse_paylah_html(paylah_html)
+    if txn is None:
+        print(f"Skipping '{source}' (likely not a transaction email)")
+        return None
+
+    txn.txn_date = email_data["date"]
+    return categorize_transaction(txn)
 
-        paylah_html = email_data.get("body")
-        if email_data["subject"] != "Transaction Alerts":
-            print(f"Skipping '{paylah_file}' (likely not a transaction email)")
-            continue
 
-        data_dict = parse_paylah_html(paylah_html)
-        if not data_dict:
-            print(f"Skipping '{paylah_file}' (likely not a transaction email)")
+def iter_paylah_transactions(paylah_dir: Path):
+    """
+    Lazily parse every exported PayLah transaction alert in `paylah_dir`, one file at a time
+    """
+    for entry in os.scandir(paylah_dir):
+        if not entry.name.endswith(".json"):
             continue
+        paylah_file = paylah_dir / entry.name
+        with METRICS.timer("read_message"):
+            email_data = codec.load(paylah_file)
+
+        txn = transaction_from_email(email_data, source=paylah_file)
+        if txn is not None:
+            yield txn
+
+
+def main(
+    output_dir="output",
+    streaming: bool = False,
+    batch_size: int = 5000,
+    transactions: Iterable[Transaction] = None,
+):
+    """
+    Parse all exported PayLah emails into the master files and the ledger
+
+    Args:
+        output_dir: root output directory
+        streaming: bounded-memory mode, see `streaming.stream_master_outputs`
+        batch_size: sort batch size of the streaming mode
+        transactions: already parsed transactions (e.g. from `pipeline`),
+            instead of parsing every file of the PayLah directory
+    """
+    output_dir = Path(output_dir)
+    paylah_dir = output_dir / "paylah"
+    if transactions is None:
+        transactions = iter_paylah_transactions(paylah_dir)
+
+    if streaming:
+        # bounded memory: external sort + incremental JSON / JSONL / CSV output
+        stream_master_outputs(transactions, output_dir, "paylah", batch_size)
+        return
 
-        date_str = email_data["date"]
-        data_dict["txn_date"] = date_str
-        all_data_dicts.append(data_dict)
+    all_txns = list(transactions)
 
     # sort by date
-    all_data_dicts.sort(key=lambda x: x["txn_date"])
+    all_txns.sort(key=attrgetter("date_ordinal"))
 
     out_json = output_dir / "master_paylah.json"
-    with out_json.open("w") as f:
-        json.dump(all_data_dicts, f, indent=4)
-        print(f"Saved {len(all_data_dicts)} transactions to master_paylah.json")
+    with METRICS.timer("write_master_json"):
+        # the master files stay indented JSON, they are meant to be opened by hand
+        codec.dump([txn.to_dict() for txn in all_txns], out_json, codec="json")
+        print(f"Saved {len(all_txns)} transactions to master_paylah.json")
 
     out_csv = output_dir / "master_paylah.csv"
-    with out_csv.open("w") as f:
+    with METRICS.timer("write_master_csv"), atomic_write(out_csv) as f:
         fieldnames = [
             "txn_type",
             "txn_id",
@@ -98,11 +154,19 @@ def main(output_dir="output"):
             "txn_amount",
             "txn_from",
             "txn_to",
+            "txn_category",
         ]
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(all_data_dicts)
-        print(f"Saved {len(all_data_dicts)} transactions to master_paylah.csv")
+        writer = csv.writer(f)
+        writer.writerow(fieldnames)
+        writer.writerows(txn.to_row(fieldnames) for txn in all_txns)
+        print(f"Saved {len(all_txns)} transactions to master_paylah.csv")
+
+    # score every transaction that is new to the ledger for anomalies
+    spend_stats = SpendStatsEngine.for_ledger(output_dir)
+    with METRICS.timer("ledger_sync"):
+        inserted = spend_stats.sync_provider("paylah", all_txns, output_dir)
+    spend_stats.save(output_dir)
+    print(f"Added {inserted} new transactions to the ledger")
 
 
 if __name__ == "__main__":
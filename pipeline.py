@@ -0,0 +1,303 @@
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Callable, Iterator
+
+from rich import print
+
+from gmail_export import (
+    all_msg_ids_from_sender,
+    fetch_message,
+    get_or_create_label_id,
+    is_exported,
+    mark_processed,
+    prefilter_msg_ids,
+)
+import codec
+from export_journal import ExportJournal
+from gmail_helpers import get_gmail_service
+from instrumentation import METRICS
+from memory_budget import MEMORY, count_data_files, plan_memory
+from providers import PROVIDERS
+from txn_record import Transaction
+
+OUTPUT_DIR = Path("output")
+DEFAULT_FETCH_WORKERS = 4
+DEFAULT_QUEUE_SIZE = 64
+
+_DONE = object()
+
+
+def _fetch_into_queue(
+    msg_ids,
+    out_dir: Path,
+    service_factory: Callable,
+    messages: queue.Queue,
+    fetch_workers: int,
+    stop: threading.Event,
+    summary: dict,
+    journal: ExportJournal,
+    normalize: Callable[[dict], dict] = None,
+):
+    """
+    Producer: put the exported data (metadata + body) of every message into
+    `messages`. Cached messages are read from disk, new ones are fetched,
+    saved and handed over without being read back. Messages that cannot be
+    fetched are counted as "failed" and left for the next export.
+
+    The first error stops the fetching and is handed to the consumer at once.
+    """
+    local = threading.local()
+    lock = threading.Lock()
+
+    def _one(msg_id):
+        if stop.is_set():
+            return
+        if is_exported(out_dir, msg_id, journal=journal):
+            METRICS.cache_hit("export_cache")
+            with METRICS.timer("read_message"):
+                data = codec.load(out_dir / f"{msg_id}.json")
+            result = "cached"
+        else:
+            METRICS.cache_miss("export_cache")
+            # Gmail API service objects are not thread-safe, one per thread
+            if not hasattr(local, "service"):
+                local.service = service_factory()
+            data = fetch_message(
+                local.service, msg_id, out_dir, journal=journal, normalize=normalize
+            )
+            result = "fetched" if data is not None else "failed"
+        with lock:
+            summary[result] += 1
+        if data is None:
+            return
+        # blocks while the parser is behind, bounding memory to the queue size
+        messages.put(data)
+
+    executor = ThreadPoolExecutor(max_workers=fetch_workers)
+    try:
+        futures = [executor.submit(_one, msg_id) for msg_id in msg_ids]
+        for future in as_completed(futures):
+            future.result()
+    except BaseException as e:
+        # don't fetch the remaining messages first: cancel them, and let the
+        # consumer raise now
+        stop.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+        messages.put(e)
+    finally:
+        executor.shutdown()
+        messages.put(_DONE)
+
+
+def pipelined_transactions(
+    provider_name: str,
+    msg_ids,
+    output_dir: Path,
+    service_factory: Callable,
+    fetch_workers: int = DEFAULT_FETCH_WORKERS,
+    queue_size: int = DEFAULT_QUEUE_SIZE,
+    summary: dict = None,
+    journal: ExportJournal = None,
+    normalize: Callable[[dict], dict] = None,
+) -> Iterator[Transaction]:
+    """
+    Yield the transactions of every listed message while the messages are
+    still being fetched in background threads.
+
+    Data files already on disk that are not in the listing are parsed at the
+    end, so the result matches a full parse of the provider directory.
+
+    Args:
+        provider_name: key of `providers.PROVIDERS`
+        msg_ids: listed message ids
+        output_dir: root output directory
+        service_factory: returns a new authorized Gmail API service
+        fetch_workers: number of fetching threads
+        queue_size: maximum number of fetched messages waiting to be parsed
+        summary: optional dictionary whose "cached", "fetched" and "failed"
+            counts are incremented as messages are exported
+        journal: export journal of the provider directory, opened if not given
+        normalize: applied to every fetched message before it is saved and
+            parsed, see `gmail_export.fetch_message`
+    """
+    if summary is None:
+        summary = {"cached": 0, "fetched": 0, "failed": 0}
+    parser = PROVIDERS[provider_name].parser()
+    out_dir = Path(output_dir) / provider_name
+    (out_dir / "raw").mkdir(exist_ok=True, parents=True)
+    if journal is None:
+        journal = ExportJournal(out_dir)
+
+    messages = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    producer = threading.Thread(
+        target=_fetch_into_queue,
+        args=(
+            msg_ids,
+            out_dir,
+            service_factory,
+            messages,
+            fetch_workers,
+            stop,
+            summary,
+            journal,
+            normalize,
+        ),
+        daemon=True,
+    )
+    producer.start()
+
+    seen = set()
+    try:
+        while True:
+            with METRICS.timer("pipeline_wait"):
+                item = messages.get()
+            if item is _DONE:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            seen.add(f"{item['id']}.json")
+            txn = parser.transaction_from_email(item)
+            if txn is not None:
+                yield txn
+    finally:
+        stop.set()
+        # unblock the producer if the consumer stopped early
+        while producer.is_alive():
+            try:
+                messages.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        producer.join()
+
+    for entry in os.scandir(out_dir):
+        if not entry.name.endswith(".json") or entry.name in seen:
+            continue
+        with METRICS.timer("read_message"):
+            email_data = codec.load(entry.path)
+        txn = parser.transaction_from_email(email_data, source=entry.path)
+        if txn is not None:
+            yield txn
+
+
+def pipelined_provider_main(
+    provider_name: str,
+    output_dir: Path = OUTPUT_DIR,
+    credentials_filepath: str = "credentials.json",
+    token_filepath: str = "token.json",
+    fetch_workers: int = DEFAULT_FETCH_WORKERS,
+    queue_size: int = DEFAULT_QUEUE_SIZE,
+    after: str = None,
+    before: str = None,
+    processed_label: str = None,
+    list_workers: int = 1,
+    memory_budget=None,
+    normalize_bodies: bool = False,
+    **parse_kwargs,
+):
+    """
+    Export and parse one provider with fetching and parsing overlapped.
+
+    Messages are fetched by `fetch_workers` threads and passed to the parser
+    through a queue of at most `queue_size` messages; the parser consumes them
+    as they arrive, so the run takes about max(fetch, parse) instead of their
+    sum, and new bodies are never read back from disk.
+
+    With `processed_label`, listed messages are labeled once the parse has
+    finished, see `gmail_export.export_email_content`.
+
+    With `memory_budget` (e.g. "512M"), the queue, the number of fetching
+    threads and the parse batches are sized by `memory_budget.plan_memory`
+    instead, and the peak memory of every stage goes into the run report.
+
+    With `normalize_bodies`, new messages are saved with compact bodies, see
+    `html_normalize.normalize_email`.
+
+    Returns:
+        The export summary ("listed", "skipped", "cached", "fetched",
+        "failed", "labeled")
+    """
+    provider = PROVIDERS[provider_name]
+    output_dir = Path(output_dir)
+    if memory_budget:
+        MEMORY.start(memory_budget)
+
+    def service_factory():
+        return get_gmail_service(
+            scope_name="modify" if processed_label else "readonly",
+            credentials_filepath=credentials_filepath,
+            credentials_token_filepath=token_filepath,
+            force_new_token=False,
+        )
+
+    service = service_factory()
+    extra_query = provider.gmail_query()
+    if processed_label:
+        label_id = get_or_create_label_id(service, processed_label)
+        extra_query = f"{extra_query} -label:{processed_label}".strip()
+    with MEMORY.stage("list_messages"):
+        listed_ids = all_msg_ids_from_sender(
+            service=service,
+            sender=provider.sender,
+            extra_query=extra_query,
+            after=after,
+            before=before,
+            list_workers=list_workers,
+            service_factory=service_factory,
+        )
+    print(f"Total number of '{provider.sender}' messages: {len(listed_ids)}")
+    summary = {
+        "listed": len(listed_ids),
+        "cached": 0,
+        "fetched": 0,
+        "failed": 0,
+        "labeled": 0,
+    }
+    journal = ExportJournal(output_dir / provider_name)
+    with MEMORY.stage("prefilter"):
+        msg_ids = prefilter_msg_ids(
+            service,
+            listed_ids,
+            output_dir / provider_name,
+            provider.is_transaction_subject,
+            journal=journal,
+        )
+    summary["skipped"] = summary["listed"] - len(msg_ids)
+
+    if memory_budget:
+        new_messages = sum(not journal.is_done(msg_id) for msg_id in msg_ids)
+        plan = plan_memory(
+            memory_budget, count_data_files(output_dir / provider_name) + new_messages
+        )
+        fetch_workers, queue_size = plan.fetch_workers, plan.queue_size
+        parse_kwargs = dict(plan.parse_kwargs(), **parse_kwargs)
+
+    transactions = pipelined_transactions(
+        provider_name,
+        msg_ids,
+        output_dir,
+        service_factory,
+        fetch_workers=fetch_workers,
+        queue_size=queue_size,
+        summary=summary,
+        journal=journal,
+        normalize=provider.normalize_email if normalize_bodies else None,
+    )
+    with MEMORY.stage("pipeline"):
+        provider.parse_main(
+            output_dir=output_dir, transactions=transactions, **parse_kwargs
+        )
+    if processed_label:
+        # skipped by subject, or exported; failed messages are listed again
+        kept = set(msg_ids)
+        to_label = [
+            msg_id
+            for msg_id in listed_ids
+            if msg_id not in kept or journal.is_done(msg_id)
+        ]
+        summary["labeled"] = mark_processed(service, to_label, label_id)
+    journal.close()
+    return summary
@@ -0,0 +1,451 @@
+import argparse
+import datetime
+import json
+import math
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from rich import print
+
+import codec
+from atomic_io import atomic_write_text
+from export_journal import ExportJournal
+from gmail_export import fetch_message, is_exported, read_skipped_ids
+from gmail_helpers import ListMessagesMatchingQuery, date_query, get_gmail_service
+from instrumentation import METRICS
+from pipeline import DEFAULT_FETCH_WORKERS
+from providers import PROVIDERS
+
+OUTPUT_DIR = Path("output")
+# messages sampled per month in the first round (2 are needed for a variance)
+FIRST_ROUND_PER_MONTH = 4
+# stop once the 95% interval of the period total is within this fraction of it
+DEFAULT_TARGET_PRECISION = 0.05
+DEFAULT_MAX_SAMPLES = 2000
+# two-sided 95% quantile of the normal distribution
+Z_95 = 1.959964
+# a month whose sample has no spread still gets this fraction of the pooled
+# spread in the allocation, so that a few unlucky samples do not starve it
+MIN_SPREAD_SHARE = 0.1
+
+# one sampled message: (txn_type, amount) of its transaction, None if it is not one
+Sample = Optional[Tuple[str, float]]
+
+
+@dataclass
+class Stratum:
+    """One calendar month of the listing, sampled in a random order"""
+
+    month: str  # "YYYY-MM"
+    msg_ids: List[str]  # shuffled: the first `len(samples)` are the sample
+    samples: List[Sample] = field(default_factory=list)
+
+    @property
+    def population(self) -> int:
+        return len(self.msg_ids)
+
+    def remaining(self) -> List[str]:
+        return self.msg_ids[len(self.samples) :]
+
+
+def month_windows(after, before) -> List[Tuple[str, datetime.date, datetime.date]]:
+    """("YYYY-MM", after, before) of every calendar month overlapping [after, before)"""
+    start = datetime.date.fromisoformat(str(after))
+    end = datetime.date.fromisoformat(str(before))
+    windows = []
+    month_start = start.replace(day=1)
+    while month_start < end:
+        next_month = (month_start + datetime.timedelta(days=32)).replace(day=1)
+        windows.append(
+            (f"{month_start:%Y-%m}", max(start, month_start), min(end, next_month))
+        )
+        month_start = next_month
+    return windows
+
+
+def estimate_total(values: List[float], population: int) -> Tuple[float, float]:
+    """
+    Estimated sum of a value over the `population` messages of a stratum, from
+    its values on a simple random sample without replacement
+
+    Returns:
+        The estimate and its variance (with the finite population correction:
+        0 once the whole stratum is sampled, infinite below 2 samples)
+    """
+    n = len(values)
+    if n >= population:
+        return float(sum(values)), 0.0
+    if n < 2:
+        return (population * values[0] if values else 0.0), math.inf
+    mean = sum(values) / n
+    spread = sum((v - mean) ** 2 for v in values) / (n - 1)
+    return population * mean, population**2 * (1 - n / population) * spread / n
+
+
+def _interval(total: float, variance: float) -> Optional[List[float]]:
+    """95% confidence interval; amounts and counts are never negative"""
+    if math.isinf(variance):
+        return None
+    half_width = Z_95 * math.sqrt(variance)
+    return [round(max(0.0, total - half_width), 2), round(total + half_width, 2)]
+
+
+def _combine(strata: List[Stratum], value: Callable[[Sample], float]) -> dict:
+    """Estimate of the sum of `value` over each stratum and over all of them"""
+    months = {}
+    grand_total = grand_variance = 0.0
+    for stratum in strata:
+        total, variance = estimate_total(
+            [value(s) for s in stratum.samples], stratum.population
+        )
+        months[stratum.month] = (total, variance)
+        grand_total += total
+        grand_variance += variance
+    return {"months": months, "total": (grand_total, grand_variance)}
+
+
+def _amount(sample: Sample) -> float:
+    return sample[1] if sample else 0.0
+
+
+def _count(sample: Sample) -> float:
+    return 1.0 if sample else 0.0
+
+
+def _type_amount(txn_type: str) -> Callable[[Sample], float]:
+    return lambda sample: sample[1] if sample and sample[0] == txn_type else 0.0
+
+
+def summarize(provider_name: str, strata: List[Stratum]) -> dict:
+    """
+    Stratified estimates of the spend and number of transactions, per month
+    and over the whole period, with 95% confidence intervals
+
+    Each month is estimated from its own sample (expansion estimator) and the
+    period from the sum of the months, whose variances add up.
+    """
+    amounts = _combine(strata, _amount)
+    counts = _combine(strata, _count)
+    txn_types = sorted({s[0] for stratum in strata for s in stratum.samples if s})
+    by_type = {}
+    for txn_type in txn_types:
+        total, variance = _combine(strata, _type_amount(txn_type))["total"]
+        by_type[txn_type] = {
+            "total": round(total, 2),
+            "total_ci": _interval(total, variance),
+        }
+
+    months = []
+    for stratum in strata:
+        total, total_variance = amounts["months"][stratum.month]
+        count, count_variance = counts["months"][stratum.month]
+        months.append(
+            {
+                "month": stratum.month,
+                "listed": stratum.population,
+                "sampled": len(stratum.samples),
+                "total": round(total, 2),
+                "total_ci": _interval(total, total_variance),
+                "count": round(count, 1),
+                "count_ci": _interval(count, count_variance),
+            }
+        )
+    total, total_variance = amounts["total"]
+    count, count_variance = counts["total"]
+    listed = sum(stratum.population for stratum in strata)
+    sampled = sum(len(stratum.samples) for stratum in strata)
+    return {
+        "provider": provider_name,
+        "listed": listed,
+        "sampled": sampled,
+        "exact": sampled == listed,
+        "total": round(total, 2),
+        "total_ci": _interval(total, total_variance),
+        "count": round(count, 1),
+        "count_ci": _interval(count, count_variance),
+        "by_type": by_type,
+        "months": months,
+    }
+
+
+def relative_precision(summary: dict) -> float:
+    """Half-width of the 95% interval of the period total, relative to the total"""
+    if summary["total_ci"] is None:
+        return math.inf
+    # the upper bound is never clipped at 0
+    high = summary["total_ci"][1]
+    if not summary["total"]:
+        return 0.0 if high == 0 else math.inf
+    return (high - summary["total"]) / summary["total"]
+
+
+def allocate(strata: List[Stratum], budget: int) -> List[int]:
+    """
+    Number of further samples to draw from each stratum, about `budget` in
+    total: Neyman allocation, in proportion to the number of messages of the
+    month times the spread of its sampled amounts
+    """
+    pooled = [_amount(s) for stratum in strata for s in stratum.samples]
+    pooled_spread = _std(pooled)
+    weights = []
+    for stratum in strata:
+        if not stratum.remaining():
+            weights.append(0.0)
+            continue
+        spread = _std([_amount(s) for s in stratum.samples])
+        weights.append(
+            stratum.population * max(spread, MIN_SPREAD_SHARE * pooled_spread, 1e-9)
+        )
+    total_weight = sum(weights)
+    if not total_weight:
+        return [0] * len(strata)
+    return [
+        min(len(stratum.remaining()), math.ceil(budget * weight / total_weight))
+        for stratum, weight in zip(strata, weights)
+    ]
+
+
+def _std(values: List[float]) -> float:
+    if len(values) < 2:
+        return 0.0
+    mean = sum(values) / len(values)
+    return math.sqrt(sum((v - mean) ** 2 for v in values) / (len(values) - 1))
+
+
+def list_strata(
+    get_service: Callable,
+    query: str,
+    after,
+    before,
+    rng: random.Random,
+    list_workers: int = 4,
+) -> List[Stratum]:
+    """List the messages matching `query` month by month, each month shuffled"""
+    windows = month_windows(after, before)
+
+    def list_month(window) -> List[str]:
+        _, month_after, month_before = window
+        messages = ListMessagesMatchingQuery(
+            get_service(),
+            user_id="me",
+            query=f"{query} {date_query(month_after, month_before)}".strip(),
+        )
+        if messages is None:
+            raise RuntimeError(f"Listing failed for month {window[0]}")
+        return [m["id"] for m in messages]
+
+    with ThreadPoolExecutor(max_workers=list_workers) as executor:
+        listed = list(executor.map(list_month, windows))
+
+    strata = []
+    seen = set()
+    for (month, _, _), msg_ids in zip(windows, listed):
+        # Gmail dates are resolved in the mailbox time zone, so a message may
+        # appear in two adjacent months: it is kept in the first one
+        msg_ids = [msg_id for msg_id in msg_ids if msg_id not in seen]
+        seen.update(msg_ids)
+        rng.shuffle(msg_ids)
+        strata.append(Stratum(month, msg_ids))
+    return strata
+
+
+def iter_preview(
+    provider_name: str,
+    output_dir: Path = OUTPUT_DIR,
+    credentials_filepath: str = "credentials.json",
+    token_filepath: str = "token.json",
+    after: str = None,
+    before: str = None,
+    fetch_workers: int = DEFAULT_FETCH_WORKERS,
+    target_precision: float = DEFAULT_TARGET_PRECISION,
+    max_samples: int = DEFAULT_MAX_SAMPLES,
+    seed: int = 0,
+) -> Iterator[dict]:
+    """
+    Estimate the spend of one provider from a stratified random sample of its
+    emails, refining the estimate round by round
+
+    The messages of the period are listed month by month (ids only). A first
+    round fetches and parses a few random messages of every month, then each
+    round draws as many new samples as all previous rounds together,
+    allocated to the months whose estimates are the most uncertain. Sampling
+    stops once the 95% interval of the period total is within
+    `target_precision` of it, after `max_samples` messages, or when every
+    message has been sampled (the estimates are then exact).
+
+    Sampled messages are saved like in a normal export, and messages already
+    exported are read from disk, so no fetch is wasted for the later backfill.
+
+    Args:
+        provider_name: key of `providers.PROVIDERS`
+        after: first day of the period ("YYYY-MM-DD"), default January 1st
+        before: day after the period, exclusive, default tomorrow
+        fetch_workers: number of fetching threads
+        target_precision: relative half-width of the 95% interval to reach
+        max_samples: maximum number of sampled messages
+        seed: seed of the sampling
+
+    Yields:
+        The estimates after each round, see `summarize`
+    """
+    start = time.perf_counter()
+    today = datetime.date.today()
+    after = after or today.replace(month=1, day=1).isoformat()
+    before = before or (today + datetime.timedelta(days=1)).isoformat()
+    provider = PROVIDERS[provider_name]
+    parser = provider.parser()
+    provider_dir = Path(output_dir) / provider_name
+    rng = random.Random(seed)
+
+    local = threading.local()
+
+    def get_service():
+        # Gmail API service objects are not thread-safe, one per thread
+        if not hasattr(local, "service"):
+            local.service = get_gmail_service(
+                scope_name="readonly",
+                credentials_filepath=credentials_filepath,
+                credentials_token_filepath=token_filepath,
+                force_new_token=False,
+            )
+        return local.service
+
+    query = f"from:{provider.sender} {provider.gmail_query()}".strip()
+    with METRICS.timer("preview_list"):
+        strata = list_strata(get_service, query, after, before, rng)
+    provider_dir.mkdir(exist_ok=True, parents=True)
+    journal = ExportJournal(provider_dir)
+    skipped = read_skipped_ids(provider_dir)
+
+    def sample_one(msg_id: str) -> Sample:
+        if msg_id in skipped:
+            return None
+        if is_exported(provider_dir, msg_id, journal=journal):
+            METRICS.cache_hit("export_cache")
+            with METRICS.timer("read_message"):
+                email_data = codec.load(provider_dir / f"{msg_id}.json")
+        else:
+            METRICS.cache_miss("export_cache")
+            email_data = fetch_message(get_service(), msg_id, provider_dir, journal=journal)
+            if email_data is None:
+                # counting it as "no transaction" would bias the estimate
+                raise RuntimeError(f"Could not fetch message {msg_id}")
+        txn = parser.transaction_from_email(email_data)
+        if txn is None:
+            return None
+        return txn.txn_type or provider_name, txn.amount
+
+    try:
+        allocation = [min(FIRST_ROUND_PER_MONTH, s.population) for s in strata]
+        sampled = 0
+        with ThreadPoolExecutor(max_workers=fetch_workers) as executor:
+            while sum(allocation):
+                batches = [
+                    stratum.remaining()[:n] for stratum, n in zip(strata, allocation)
+                ]
+                with METRICS.timer("preview_round"):
+                    # one map over all months, so every fetching thread stays busy
+                    results = iter(
+                        executor.map(
+                            sample_one, [msg_id for batch in batches for msg_id in batch]
+                        )
+                    )
+                    for stratum, batch in zip(strata, batches):
+                        stratum.samples += [next(results) for _ in batch]
+                sampled = sum(len(stratum.samples) for stratum in strata)
+                summary = summarize(provider_name, strata)
+                precision = relative_precision(summary)
+                summary["precision"] = None if math.isinf(precision) else round(precision, 4)
+                summary["seconds"] = round(time.perf_counter() - start, 1)
+                yield summary
+                if summary["exact"] or precision <= target_precision:
+                    break
+                budget = min(sampled, max_samples - sampled)
+                if budget <= 0:
+                    break
+                allocation = allocate(strata, budget)
+    finally:
+        journal.close()
+    METRICS.inc("preview_sampled", sampled)
+
+
+def preview(provider_name: str, **kwargs) -> dict:
+    """The final estimates of `iter_preview`, printing every round"""
+    summary = None
+    for summary in iter_preview(provider_name, **kwargs):
+        print(format_summary(summary))
+    return summary
+
+
+def _format_interval(
+    value: float, interval: Optional[List[float]], digits: int = 2
+) -> str:
+    if interval is None:
+        return f"{value:.{digits}f} (no interval yet)"
+    return f"{value:.{digits}f} [{interval[0]:.{digits}f}, {interval[1]:.{digits}f}]"
+
+
+def format_summary(summary: dict, months: bool = False) -> str:
+    """One line for the whole period, plus one per month if `months`"""
+    lines = [
+        f"{summary['provider']}: {summary['sampled']} of {summary['listed']} emails "
+        f"sampled in {summary['seconds']} s: spend {_format_interval(summary['total'], summary['total_ci'])} SGD, "
+        f"{_format_interval(summary['count'], summary['count_ci'], 0)} transactions"
+        + (" (exact)" if summary["exact"] else " (95% interval)")
+    ]
+    if months:
+        for month in summary["months"]:
+            if not month["listed"]:
+                continue
+            lines.append(
+                f"  {month['month']}: {month['sampled']:>4}/{month['listed']:<5} "
+                f"spend {_format_interval(month['total'], month['total_ci'])}, "
+                f"count {_format_interval(month['count'], month['count_ci'], 0)}"
+            )
+        for txn_type, estimate in summary["by_type"].items():
+            lines.append(
+                f"  {txn_type}: spend {_format_interval(estimate['total'], estimate['total_ci'])}"
+            )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Estimate monthly spend and counts from a sample of the emails"
+    )
+    parser.add_argument("provider", choices=list(PROVIDERS))
+    parser.add_argument("--output-dir", type=Path, default=OUTPUT_DIR)
+    parser.add_argument("--credentials", default="credentials.json")
+    parser.add_argument("--token", default="token.json")
+    parser.add_argument("--after", help="YYYY-MM-DD (default: January 1st)")
+    parser.add_argument("--before", help="YYYY-MM-DD (default: tomorrow)")
+    parser.add_argument(
+        "--target-precision", type=float, default=DEFAULT_TARGET_PRECISION
+    )
+    parser.add_argument("--max-samples", type=int, default=DEFAULT_MAX_SAMPLES)
+    parser.add_argument("--fetch-workers", type=int, default=DEFAULT_FETCH_WORKERS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", type=Path, help="also save the final estimates here")
+    args = parser.parse_args()
+
+    summary = preview(
+        args.provider,
+        output_dir=args.output_dir,
+        credentials_filepath=args.credentials,
+        token_filepath=args.token,
+        after=args.after,
+        before=args.before,
+        fetch_workers=args.fetch_workers,
+        target_precision=args.target_precision,
+        max_samples=args.max_samples,
+        seed=args.seed,
+    )
+    if summary is not None:
+        print(format_summary(summary, months=True))
+        if args.json:
+            atomic_write_text(args.json, json.dumps(summary, indent=4))
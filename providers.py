@@ -0,0 +1,77 @@
+import importlib
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional
+
+from gmail_helpers import date_query
+from html_normalize import normalize_email
+
+
+@dataclass(frozen=True)
+class Provider:
+    """
+    Everything the export / parse / repair stages need to know about one
+    source of transaction emails
+    """
+
+    name: str  # also the sub-directory of the output dir
+    sender: str
+    # decides from the subject alone whether an email is a transaction email
+    is_transaction_subject: Callable[[str], bool]
+    parser_module: str
+    # Gmail search operators that every transaction email matches. Gmail
+    # matches words, not substrings, so this is deliberately broader than
+    # `is_transaction_subject`, which is applied exactly on a metadata pre-pass
+    subject_query: str = ""
+
+    def gmail_query(
+        self, after: Optional[str] = None, before: Optional[str] = None
+    ) -> str:
+        """
+        Compile the provider filters into Gmail search operators (to be added
+        to `from:<sender>`)
+
+        Args:
+            after: only messages on or after this "YYYY-MM-DD" date
+            before: only messages before this "YYYY-MM-DD" date
+        """
+        return f"{self.subject_query} {date_query(after, before)}".strip()
+
+    def parser(self):
+        return importlib.import_module(self.parser_module)
+
+    def parse_main(self, output_dir, **kwargs):
+        return self.parser().main(output_dir=output_dir, **kwargs)
+
+    def normalize_email(self, email_data: dict) -> dict:
+        """
+        Compact the body of an exported email, keeping the original if this
+        provider's parser reads the compact body differently
+        """
+        return normalize_email(email_data, parse=self.parser().transaction_from_email)
+
+
+PROVIDERS: Dict[str, Provider] = {
+    "paylah": Provider(
+        name="paylah",
+        sender="paylah.alert@dbs.com",
+        is_transaction_subject=lambda subject: subject == "Transaction Alerts",
+        parser_module="parser_paylah",
+        subject_query="subject:(transaction alerts)",
+    ),
+    "fave": Provider(
+        name="fave",
+        sender="hi@myfave.com",
+        is_transaction_subject=lambda subject: subject.startswith(
+            "Your FavePay Receipt"
+        ),
+        parser_module="parser_fave",
+        subject_query="subject:(favepay receipt)",
+    ),
+    "grab": Provider(
+        name="grab",
+        sender="no-reply@grab.com",
+        is_transaction_subject=lambda subject: "e-receipt" in subject.lower(),
+        parser_module="parser_grab",
+        subject_query="subject:receipt",
+    ),
+}
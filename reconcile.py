@@ -0,0 +1,276 @@
+import argparse
+import csv
+from collections import deque
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from rich import print
+
+import codec
+from atomic_io import atomic_write
+from instrumentation import METRICS
+from ledger import OUTPUT_FIELDS, ledger_path, query_transactions
+from providers import PROVIDERS
+from txn_record import Transaction
+
+OUTPUT_DIR = Path("output")
+PAIRS_FILENAME = "reconciled_pairs.json"
+COMBINED_NAME = "master_combined"
+
+DEFAULT_TOLERANCE_MINUTES = 10
+# of two linked transactions, the combined ledger keeps the one of the
+# provider listed first: the merchant receipt rather than the payment alert
+DEFAULT_PREFERENCE = ("fave", "grab", "paylah")
+
+MINUTES_PER_DAY = 24 * 60
+# slack of a transaction without a time: anywhere within its day
+NO_TIME_SLACK = MINUTES_PER_DAY // 2
+# providers whose parsed times are on a 12-hour clock without AM/PM
+TWELVE_HOUR_PROVIDERS = {"fave"}
+
+COMBINED_FIELDS = ["provider"] + OUTPUT_FIELDS + ["linked_provider", "linked_txn_id"]
+
+
+class Event(NamedTuple):
+    """One candidate point in time of a transaction, for the sweep"""
+
+    cents: int
+    minute: int
+    # the transaction may be up to this many minutes away from `minute`
+    slack: int
+    index: int
+
+
+def _clock_candidates(txn_time: Optional[str], provider: str) -> Tuple[List[int], int]:
+    """
+    Minutes after midnight the transaction may have happened at, and the slack
+
+    PayLah times are 24-hour ("14:32"). Fave times lost their AM/PM in
+    parsing ("2:32"), so both readings are candidates. Grab has no time.
+    """
+    if not txn_time or ":" not in txn_time:
+        return [MINUTES_PER_DAY // 2], NO_TIME_SLACK
+    try:
+        hours, minutes = (int(part) for part in txn_time.strip().split(":")[:2])
+    except ValueError:
+        return [MINUTES_PER_DAY // 2], NO_TIME_SLACK
+    minute = hours * 60 + minutes
+    if provider in TWELVE_HOUR_PROVIDERS:
+        # "2:32" reads as 02:32 or 14:32, "12:05" as 00:05 or 12:05
+        return [minute % 720, minute % 720 + 720], 0
+    return [minute], 0
+
+
+def to_events(transactions: List[Transaction]) -> List[Event]:
+    """Sweep events of every dated transaction, sorted by amount then time"""
+    events = []
+    for index, txn in enumerate(transactions):
+        if not txn.date_ordinal:
+            continue
+        clocks, slack = _clock_candidates(txn.txn_time, txn.provider)
+        for clock in clocks:
+            events.append(
+                Event(
+                    txn.cents or 0,
+                    txn.date_ordinal * MINUTES_PER_DAY + clock,
+                    slack,
+                    index,
+                )
+            )
+    events.sort()
+    return events
+
+
+def sweep_join(
+    transactions: List[Transaction], tolerance_minutes: int = DEFAULT_TOLERANCE_MINUTES
+) -> List[Tuple[int, int, int]]:
+    """
+    Link transactions of different providers with the same amount that
+    happened within `tolerance_minutes` of each other.
+
+    Events are sorted by (amount, time) once, then swept in order: a window
+    of the still unmatched events of the same amount that are close enough
+    in time is kept, and each event is linked to the nearest earlier one of
+    another provider. Each transaction is linked at most once. This is
+    O(n log n) for the sort plus O(n * w) for the sweep, where w is the
+    number of same-amount transactions within the tolerance (small), instead
+    of comparing every pair.
+
+    Args:
+        transactions: records with a provider, see `load_transactions`
+        tolerance_minutes: maximum time difference of linked transactions
+
+    Returns:
+        (index, index, minutes apart) of every linked pair, earlier one
+        first; minutes apart is None if a transaction has no time
+    """
+    matched = set()
+    pairs = []
+    window: deque = deque()
+    for event in to_events(transactions):
+        if event.index in matched:
+            continue
+        reach = tolerance_minutes + event.slack + NO_TIME_SLACK
+        # drop events of another amount, or too long ago to match anything
+        while window and (
+            window[0].cents != event.cents or window[0].minute < event.minute - reach
+        ):
+            window.popleft()
+
+        provider = transactions[event.index].provider
+        best = None
+        for other in window:
+            if other.index in matched or other.index == event.index:
+                continue
+            if transactions[other.index].provider == provider:
+                continue
+            gap = event.minute - other.minute
+            if gap > tolerance_minutes + event.slack + other.slack:
+                continue
+            if best is None or gap < event.minute - best.minute:
+                best = other
+        if best is not None:
+            matched.update((best.index, event.index))
+            gap = None if event.slack or best.slack else event.minute - best.minute
+            pairs.append((best.index, event.index, gap))
+        else:
+            window.append(event)
+    return pairs
+
+
+def load_transactions(
+    providers: Iterable[str], output_dir: Path = OUTPUT_DIR, use_ledger: bool = True
+) -> List[Transaction]:
+    """
+    All transactions of `providers`, from the ledger or the master JSON files,
+    as compact records: a million of them fit in a few hundred MB
+    """
+    transactions = []
+    for provider in providers:
+        if use_ledger:
+            rows = query_transactions(
+                provider=provider, db_path=ledger_path(output_dir)
+            )
+        else:
+            master_json = Path(output_dir) / f"master_{provider}.json"
+            rows = codec.load(master_json) if master_json.exists() else []
+        for txn in rows:
+            # the ledger amounts are numbers, the master file ones strings
+            txn["txn_amount"] = float(txn.get("txn_amount") or 0)
+            transactions.append(Transaction.from_dict(txn, provider))
+    return transactions
+
+
+def combine(
+    transactions: List[Transaction],
+    pairs: List[Tuple[int, int, int]],
+    preference: Tuple[str, ...] = DEFAULT_PREFERENCE,
+) -> List[dict]:
+    """
+    Deduplicated ledger: one row per purchase, the linked transaction of the
+    less preferred provider being folded into "linked_provider"/"linked_txn_id"
+    """
+    rank = {provider: i for i, provider in enumerate(preference)}
+    dropped = set()
+    links: Dict[int, int] = {}
+    for a, b, _ in pairs:
+        keep, drop = sorted(
+            (a, b), key=lambda i: rank.get(transactions[i].provider, len(rank))
+        )
+        links[keep] = drop
+        dropped.add(drop)
+
+    combined = []
+    for index, txn in enumerate(transactions):
+        if index in dropped:
+            continue
+        row = {"provider": txn.provider, **txn.to_dict()}
+        if index in links:
+            linked = transactions[links[index]]
+            row["linked_provider"] = linked.provider
+            row["linked_txn_id"] = linked.txn_id
+        combined.append(row)
+    combined.sort(key=lambda x: (x.get("txn_date") or "", x.get("txn_time") or ""))
+    return combined
+
+
+def reconcile(
+    output_dir: Path = OUTPUT_DIR,
+    providers: Iterable[str] = tuple(PROVIDERS),
+    tolerance_minutes: int = DEFAULT_TOLERANCE_MINUTES,
+    preference: Tuple[str, ...] = DEFAULT_PREFERENCE,
+    use_ledger: bool = True,
+) -> dict:
+    """
+    Link the same purchase across providers and write the results:
+    `reconciled_pairs.json` with every linked pair, and the deduplicated
+    `master_combined.json` / `.csv` of all providers.
+
+    Returns:
+        Number of transactions, linked pairs and combined rows
+    """
+    output_dir = Path(output_dir)
+    with METRICS.timer("reconcile_load"):
+        transactions = load_transactions(providers, output_dir, use_ledger)
+    with METRICS.timer("reconcile_join"):
+        pairs = sweep_join(transactions, tolerance_minutes)
+    combined = combine(transactions, pairs, preference)
+
+    linked = [
+        {
+            "txn_amount": transactions[a].txn_amount,
+            "minutes_apart": minutes,
+            "first": {"provider": transactions[a].provider, **transactions[a].to_dict()},
+            "second": {"provider": transactions[b].provider, **transactions[b].to_dict()},
+        }
+        for a, b, minutes in pairs
+    ]
+    codec.dump(linked, output_dir / PAIRS_FILENAME, codec="json")
+    codec.dump(combined, output_dir / f"{COMBINED_NAME}.json", codec="json")
+    with atomic_write(output_dir / f"{COMBINED_NAME}.csv") as f:
+        writer = csv.DictWriter(f, fieldnames=COMBINED_FIELDS)
+        writer.writeheader()
+        for row in combined:
+            writer.writerow(row)
+
+    print(
+        f"Linked {len(pairs)} pairs among {len(transactions)} transactions, "
+        f"saved {len(combined)} combined transactions to {output_dir}"
+    )
+    return {
+        "transactions": len(transactions),
+        "pairs": len(pairs),
+        "combined": len(combined),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Link the same purchase across providers and deduplicate"
+    )
+    parser.add_argument(
+        "providers",
+        nargs="*",
+        metavar="provider",
+        help=f"one of {', '.join(PROVIDERS)} (default: all providers)",
+    )
+    parser.add_argument("--output-dir", type=Path, default=OUTPUT_DIR)
+    parser.add_argument(
+        "--tolerance-minutes", type=int, default=DEFAULT_TOLERANCE_MINUTES
+    )
+    parser.add_argument(
+        "--from-master",
+        action="store_true",
+        help="read the master JSON files instead of the ledger",
+    )
+    args = parser.parse_args()
+    unknown = set(args.providers) - set(PROVIDERS)
+    if unknown:
+        parser.error(f"unknown providers: {', '.join(sorted(unknown))}")
+
+    reconcile(
+        output_dir=args.output_dir,
+        providers=args.providers or list(PROVIDERS),
+        tolerance_minutes=args.tolerance_minutes,
+        use_ledger=not args.from_master,
+    )
@@ -0,0 +1,185 @@
+import argparse
+import hashlib
+import importlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import matplotlib
+
+# non-interactive backend: never opens a window, safe in batch jobs and workers
+matplotlib.use("Agg")
+
+from rich import print
+
+from atomic_io import atomic_write_text
+from ledger import LEDGER_FILENAME
+from rollups import monthly_table
+from txn_frame import load_frame, series
+
+OUT_DIR = Path("output")
+CHART_HASHES_FILENAME = "chart_hashes.json"
+
+# bump when the drawing code changes so that every chart is re-rendered once
+CHART_STYLE_VERSION = 1
+
+
+def _monthly_table(output_dir: Path, provider: str):
+    """Monthly (months, types, sums, counts) from the ledger rollups or the master JSON"""
+    ledger_db = output_dir / LEDGER_FILENAME
+    if ledger_db.exists():
+        return monthly_table(provider=provider, db_path=ledger_db)
+    master_json = output_dir / f"master_{provider}.json"
+    if not master_json.exists():
+        return None
+    frame = load_frame(master_json)
+    months, types, sums = frame.monthly_sum_by_type()
+    _, _, counts = frame.monthly_count_by_type()
+    return months, types, sums, counts
+
+
+def collect_chart_jobs(output_dir: Path = OUT_DIR) -> list:
+    """
+    Build one job per chart. A job only carries the plotted series and the
+    name of the drawing function, so it is cheap to hash and to send to a worker.
+    """
+    from analyze_grab import FOOD_COLOR, TRANSPORT_COLOR
+
+    output_dir = Path(output_dir)
+    jobs = []
+
+    grab = _monthly_table(output_dir, "grab")
+    if grab and grab[0]:
+        months, types, sums, _ = grab
+        for txn_type, color, filename in [
+            ("Grab Transport", TRANSPORT_COLOR, "grab_transport_spending.png"),
+            ("Grab Food", FOOD_COLOR, "grab_food_spending.png"),
+        ]:
+            jobs.append(
+                {
+                    "name": filename,
+                    "draw": "analyze_grab:draw_monthly_spending_chart",
+                    "kwargs": {
+                        "months": months,
+                        "spends": series(types, sums, txn_type).tolist(),
+                        "title": f"Monthly Spending on {txn_type}",
+                        "color": color,
+                    },
+                }
+            )
+
+    paylah = _monthly_table(output_dir, "paylah")
+    if paylah and paylah[0]:
+        months, types, sums, counts = paylah
+        jobs.append(
+            {
+                "name": "paylah_monthly_spending.png",
+                "draw": "analyze_paylah:draw_paylah_monthly_chart",
+                "kwargs": {
+                    "months": months,
+                    "types": types,
+                    "monthly_spend": sums.tolist(),
+                    "monthly_counts": counts.tolist(),
+                },
+            }
+        )
+
+    fave = _monthly_table(output_dir, "fave")
+    if fave and fave[0]:
+        months, _, sums, _ = fave
+        jobs.append(
+            {
+                "name": "fave_monthly_spending.png",
+                "draw": "analyze_grab:draw_monthly_spending_chart",
+                "kwargs": {
+                    "months": months,
+                    "spends": sums.sum(axis=0).tolist(),
+                    "title": "Monthly Spending on Fave",
+                    "color": "#E4335D",
+                },
+            }
+        )
+
+    return jobs
+
+
+def chart_hash(job: dict) -> str:
+    """Content hash of everything that determines the rendered PNG"""
+    payload = json.dumps(
+        [CHART_STYLE_VERSION, job["name"], job["draw"], job["kwargs"]],
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _render_job(job: dict, save_path: str) -> str:
+    """Worker entry point: import the drawing function and render one chart"""
+    module_name, func_name = job["draw"].split(":")
+    draw = getattr(importlib.import_module(module_name), func_name)
+    draw(save_path=save_path, **job["kwargs"])
+    return job["name"]
+
+
+def render_all_charts(
+    output_dir: Path = OUT_DIR, max_workers: int = None, force: bool = False
+) -> dict:
+    """
+    Render every provider chart in parallel worker processes, skipping charts
+    whose input series have not changed since the last run.
+
+    Args:
+        output_dir: directory of the ledger / master files and the PNGs
+        max_workers: number of worker processes, defaults to the CPU count
+        force: re-render every chart regardless of the recorded hashes
+
+    Returns:
+        A dictionary with the lists of "rendered" and "skipped" chart names
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(exist_ok=True, parents=True)
+    hashes_path = output_dir / CHART_HASHES_FILENAME
+    old_hashes = json.loads(hashes_path.read_text()) if hashes_path.exists() else {}
+    new_hashes = dict(old_hashes)
+
+    jobs = collect_chart_jobs(output_dir)
+    todo, skipped = [], []
+    for job in jobs:
+        digest = chart_hash(job)
+        save_path = output_dir / job["name"]
+        if not force and old_hashes.get(job["name"]) == digest and save_path.exists():
+            skipped.append(job["name"])
+            continue
+        todo.append((job, digest, save_path))
+
+    rendered = []
+    if todo:
+        max_workers = min(max_workers or os.cpu_count() or 1, len(todo))
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(_render_job, job, str(save_path)): (job, digest)
+                for job, digest, save_path in todo
+            }
+            for future in as_completed(futures):
+                job, digest = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"[red][ERROR][/red] Failed to render {job['name']}: {e}")
+                    new_hashes.pop(job["name"], None)
+                    continue
+                new_hashes[job["name"]] = digest
+                rendered.append(job["name"])
+
+    atomic_write_text(hashes_path, json.dumps(new_hashes, indent=4))
+    print(f"Rendered {len(rendered)} charts, skipped {len(skipped)} unchanged charts")
+    return {"rendered": sorted(rendered), "skipped": sorted(skipped)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render all spending charts")
+    parser.add_argument("--output-dir", type=Path, default=OUT_DIR)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--force", action="store_true", help="ignore chart hashes")
+    args = parser.parse_args()
+    render_all_charts(args.output_dir, max_workers=args.workers, force=args.force)
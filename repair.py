@@ -0,0 +1,325 @@
+import argparse
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List
+
+from rich import print
+
+import codec
+from export_journal import STAGE_DATA, STAGE_RAW, ExportJournal
+from gmail_export import get_msg_body, get_msg_metadata
+from instrumentation import METRICS
+from memory_budget import MEMORY, parse_kwargs_for_budget
+from providers import PROVIDERS
+
+OUTPUT_DIR = Path("output")
+INDEX_FILENAME = "archive_index.db"
+RAW_SUFFIX = "_raw_msg.json"
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS data_files (
+    id          TEXT PRIMARY KEY,
+    mtime_ns    INTEGER NOT NULL,
+    size        INTEGER NOT NULL,
+    valid       INTEGER NOT NULL,
+    date        TEXT,
+    subject     TEXT,
+    body_len    INTEGER
+);
+CREATE TABLE IF NOT EXISTS raw_files (
+    id          TEXT PRIMARY KEY,
+    mtime_ns    INTEGER NOT NULL,
+    size        INTEGER NOT NULL,
+    valid       INTEGER NOT NULL
+);
+"""
+
+
+############# Index
+
+
+def _connect_index(provider_dir: Path) -> sqlite3.Connection:
+    conn = sqlite3.connect(provider_dir / INDEX_FILENAME)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(INDEX_SCHEMA)
+    return conn
+
+
+def _scan(directory: Path, suffix: str) -> Dict[str, os.stat_result]:
+    """id -> stat of every file in `directory` ending with `suffix` (no file reads)"""
+    if not directory.is_dir():
+        return {}
+    found = {}
+    for entry in os.scandir(directory):
+        if entry.name.endswith(suffix) and entry.is_file():
+            found[entry.name[: -len(suffix)]] = entry.stat()
+    return found
+
+
+def _inspect_data_file(path: Path) -> tuple:
+    try:
+        data = codec.load(path)
+    except (ValueError, UnicodeDecodeError):
+        return 0, None, None, None
+    if not isinstance(data, dict):
+        # valid JSON, but not an exported message (e.g. "null" or a list)
+        return 0, None, None, None
+    return 1, data.get("date"), data.get("subject") or "", len(data.get("body") or "")
+
+
+def _inspect_raw_file(path: Path) -> int:
+    try:
+        msg = codec.load(path)
+        # the str(msg) fallback of save_raw_message is not JSON, and a
+        # truncated write is not either; both fail above
+        return int(isinstance(msg, dict) and "payload" in msg)
+    except (ValueError, UnicodeDecodeError):
+        return 0
+
+
+def refresh_index(provider_dir: Path) -> sqlite3.Connection:
+    """
+    Bring the archive index of one provider directory up to date.
+
+    Only files whose size or mtime differ from the index are opened, so after
+    the first run a refresh costs one directory listing per folder.
+
+    Returns:
+        An open connection to the refreshed index
+    """
+    provider_dir = Path(provider_dir)
+    conn = _connect_index(provider_dir)
+
+    for table, directory, suffix, inspect in [
+        ("data_files", provider_dir, ".json", _inspect_data_file),
+        ("raw_files", provider_dir / "raw", RAW_SUFFIX, _inspect_raw_file),
+    ]:
+        on_disk = _scan(directory, suffix)
+        indexed = {
+            row["id"]: (row["mtime_ns"], row["size"])
+            for row in conn.execute(f"SELECT id, mtime_ns, size FROM {table}")
+        }
+        changed = [
+            _id
+            for _id, st in on_disk.items()
+            if indexed.get(_id) != (st.st_mtime_ns, st.st_size)
+        ]
+        removed = [(_id,) for _id in indexed.keys() - on_disk.keys()]
+
+        rows = []
+        for _id in changed:
+            st = on_disk[_id]
+            details = inspect(directory / f"{_id}{suffix}")
+            if not isinstance(details, tuple):
+                details = (details,)
+            rows.append((_id, st.st_mtime_ns, st.st_size) + details)
+
+        with conn:
+            conn.executemany(f"DELETE FROM {table} WHERE id = ?", removed)
+            if rows:
+                placeholders = ", ".join("?" * len(rows[0]))
+                conn.executemany(
+                    f"INSERT OR REPLACE INTO {table} VALUES ({placeholders})", rows
+                )
+        if changed or removed:
+            print(f"Indexed {len(changed)} changed / {len(removed)} removed {table}")
+    return conn
+
+
+############# Inconsistency detection
+
+
+def find_issues(provider_name: str, output_dir: Path = OUTPUT_DIR) -> Dict[str, List]:
+    """
+    Detect inconsistencies in one provider archive from its index
+
+    Returns:
+        A dictionary of issue kind -> list of message ids, plus "stale_output"
+        set to True if the master output is older than the newest data file
+    """
+    provider = PROVIDERS[provider_name]
+    provider_dir = Path(output_dir) / provider_name
+    conn = refresh_index(provider_dir)
+
+    def ids(sql):
+        return [row[0] for row in conn.execute(sql)]
+
+    issues = {
+        # data file exists, is a transaction email, but has no body
+        "empty_body": [
+            row["id"]
+            for row in conn.execute(
+                "SELECT d.id, d.subject FROM data_files d JOIN raw_files r USING (id) "
+                "WHERE d.valid = 1 AND r.valid = 1 AND d.body_len = 0"
+            )
+            if provider.is_transaction_subject(row["subject"])
+        ],
+        # data file is truncated / not JSON but the raw message is fine
+        "invalid_data": ids(
+            "SELECT d.id FROM data_files d JOIN raw_files r USING (id) "
+            "WHERE d.valid = 0 AND r.valid = 1"
+        ),
+        # raw message exists but no data file was written
+        "missing_data": ids(
+            "SELECT r.id FROM raw_files r LEFT JOIN data_files d USING (id) "
+            "WHERE d.id IS NULL AND r.valid = 1"
+        ),
+        # raw message is truncated or was saved with the str(msg) fallback;
+        # it can't be repaired offline and has to be fetched again
+        "invalid_raw": ids("SELECT id FROM raw_files WHERE valid = 0"),
+    }
+
+    newest_data = conn.execute("SELECT MAX(mtime_ns) FROM data_files").fetchone()[0]
+    conn.close()
+    master_json = Path(output_dir) / f"master_{provider_name}.json"
+    issues["stale_output"] = bool(newest_data) and (
+        not master_json.exists() or master_json.stat().st_mtime_ns < newest_data
+    )
+    return issues
+
+
+############# Repair
+
+
+def rebuild_data_file(raw_path: str, data_path: str) -> bool:
+    """
+    Recreate `<id>.json` from `raw/<id>_raw_msg.json` without any network access.
+    Runs in a worker process.
+
+    Returns:
+        Whether the data file was rebuilt; False if the raw message cannot be
+        decoded (e.g. an unsupported mimeType), so one bad file does not stop
+        the repair of the others
+    """
+    try:
+        msg = codec.load(raw_path)
+        data = get_msg_metadata(msg)
+        data["body"] = get_msg_body(msg)
+        if not data["body"]:
+            return False
+        codec.dump(data, data_path)
+        return True
+    except Exception as e:
+        print(f"Cannot rebuild {data_path} from {raw_path}: {e!r}")
+        return False
+
+
+def repair_provider(
+    provider_name: str,
+    output_dir: Path = OUTPUT_DIR,
+    max_workers: int = None,
+    dry_run: bool = False,
+    drop_invalid_raw: bool = False,
+    reparse: bool = True,
+    memory_budget=None,
+) -> dict:
+    """
+    Detect and repair inconsistencies in one provider archive
+
+    Args:
+        provider_name: key of `providers.PROVIDERS`
+        output_dir: root output directory
+        max_workers: number of worker processes for re-decoding
+        dry_run: only report what would be repaired
+        drop_invalid_raw: delete unreadable raw files (and their data files) so
+            that the next export fetches those messages again
+        reparse: re-run the provider parser if its master output is stale
+        memory_budget: memory ceiling of the re-parse, e.g. "512M"
+
+    Returns:
+        The detected issues plus "fixed" and "failed" id lists
+    """
+    output_dir = Path(output_dir)
+    provider_dir = output_dir / provider_name
+    raw_dir = provider_dir / "raw"
+    issues = find_issues(provider_name, output_dir)
+
+    for kind, value in issues.items():
+        if isinstance(value, list):
+            print(f"{provider_name}: {kind}: {len(value)}")
+    print(f"{provider_name}: stale_output: {issues['stale_output']}")
+
+    to_rebuild = sorted(
+        set(issues["empty_body"] + issues["invalid_data"] + issues["missing_data"])
+    )
+    fixed, failed = [], []
+    if dry_run:
+        return dict(issues, fixed=fixed, failed=failed)
+
+    if to_rebuild:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = executor.map(
+                rebuild_data_file,
+                [str(raw_dir / f"{_id}{RAW_SUFFIX}") for _id in to_rebuild],
+                [str(provider_dir / f"{_id}.json") for _id in to_rebuild],
+                chunksize=64,
+            )
+            for _id, ok in zip(to_rebuild, results):
+                (fixed if ok else failed).append(_id)
+        # both files are now in place: record them so the export does not fetch them again
+        with ExportJournal(provider_dir) as journal:
+            journal.record_many(STAGE_RAW, fixed)
+            journal.record_many(STAGE_DATA, fixed)
+        print(f"{provider_name}: Rebuilt {len(fixed)} data files, {len(failed)} failed")
+
+    if drop_invalid_raw:
+        for _id in issues["invalid_raw"]:
+            (raw_dir / f"{_id}{RAW_SUFFIX}").unlink(missing_ok=True)
+            (provider_dir / f"{_id}.json").unlink(missing_ok=True)
+        # the export trusts its journal, so the removal has to be recorded there
+        with ExportJournal(provider_dir) as journal:
+            journal.forget(issues["invalid_raw"])
+        print(
+            f"{provider_name}: Removed {len(issues['invalid_raw'])} invalid raw files, "
+            "they will be fetched again by the next export"
+        )
+
+    if reparse and (issues["stale_output"] or fixed):
+        with MEMORY.stage(f"reparse_{provider_name}"):
+            PROVIDERS[provider_name].parse_main(
+                output_dir=output_dir,
+                **parse_kwargs_for_budget(memory_budget, provider_dir),
+            )
+
+    return dict(issues, fixed=fixed, failed=failed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Detect and repair inconsistencies in exported archives"
+    )
+    parser.add_argument(
+        "providers",
+        nargs="*",
+        metavar="provider",
+        help=f"one of {', '.join(PROVIDERS)} (default: all providers)",
+    )
+    parser.add_argument("--output-dir", type=Path, default=OUTPUT_DIR)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--drop-invalid-raw", action="store_true")
+    parser.add_argument("--no-reparse", action="store_true")
+    parser.add_argument("--memory-budget", help='memory ceiling, e.g. "512M"')
+    args = parser.parse_args()
+    unknown = set(args.providers) - set(PROVIDERS)
+    if unknown:
+        parser.error(f"unknown providers: {', '.join(sorted(unknown))}")
+
+    if args.memory_budget:
+        MEMORY.start(args.memory_budget)
+    for name in args.providers or list(PROVIDERS):
+        if not (args.output_dir / name).is_dir():
+            continue
+        repair_provider(
+            name,
+            output_dir=args.output_dir,
+            max_workers=args.workers,
+            dry_run=args.dry_run,
+            drop_invalid_raw=args.drop_invalid_raw,
+            reparse=not args.no_reparse,
+            memory_budget=args.memory_budget,
+        )
+    if args.memory_budget:
+        METRICS.write_reports(args.output_dir)
@@ -0,0 +1,124 @@
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+
+from ledger import connect_ledger_readonly
+
+
+def _rollup_query(sql: str, params: list, db_path: Path = None) -> List[dict]:
+    conn = connect_ledger_readonly(db_path)
+    rows = conn.execute(sql, params).fetchall()
+    conn.close()
+    return [dict(row) for row in rows]
+
+
+def _filters(provider: str = None, txn_type: str = None, bounds=None):
+    conditions, params = [], []
+    if provider:
+        conditions.append("provider = ?")
+        params.append(provider)
+    if txn_type:
+        conditions.append("txn_type = ?")
+        params.append(txn_type)
+    for condition, value in bounds or []:
+        if value:
+            conditions.append(condition)
+            params.append(value)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    return where, params
+
+
+def monthly_rollup(
+    provider: str = None,
+    txn_type: str = None,
+    start_month: str = None,
+    end_month: str = None,
+    db_path: Path = None,
+) -> List[dict]:
+    """
+    Monthly totals and counts per provider and txn_type, read from the
+    materialized rollup instead of scanning transactions
+
+    Args:
+        provider, txn_type: optional filters
+        start_month, end_month: optional inclusive "YYYY-MM" bounds
+        db_path: path to the ledger SQLite file
+
+    Returns:
+        A list of dicts with provider, txn_type, txn_month, total and count
+    """
+    where, params = _filters(
+        provider,
+        txn_type,
+        [("txn_month >= ?", start_month), ("txn_month <= ?", end_month)],
+    )
+    return _rollup_query(
+        f"SELECT provider, txn_type, txn_month, total, count FROM rollup_monthly "
+        f"{where} ORDER BY txn_month, provider, txn_type",
+        params,
+        db_path,
+    )
+
+
+def daily_rollup(
+    provider: str = None,
+    txn_type: str = None,
+    start_date: str = None,
+    end_date: str = None,
+    db_path: Path = None,
+) -> List[dict]:
+    """Daily totals and counts per provider and txn_type, see `monthly_rollup`"""
+    where, params = _filters(
+        provider,
+        txn_type,
+        [("txn_date >= ?", start_date), ("txn_date <= ?", end_date)],
+    )
+    return _rollup_query(
+        f"SELECT provider, txn_type, txn_date, total, count FROM rollup_daily "
+        f"{where} ORDER BY txn_date, provider, txn_type",
+        params,
+        db_path,
+    )
+
+
+def counterparty_rollup(
+    provider: str = None, n: int = None, db_path: Path = None
+) -> List[dict]:
+    """Totals and counts per counterparty (txn_to), largest total first"""
+    where, params = _filters(provider)
+    limit = ""
+    if n:
+        limit = "LIMIT ?"
+        params.append(n)
+    return _rollup_query(
+        f"SELECT provider, txn_to, total, count FROM rollup_counterparty "
+        f"{where} ORDER BY total DESC {limit}",
+        params,
+        db_path,
+    )
+
+
+def monthly_table(
+    provider: str = None, db_path: Path = None
+) -> Tuple[List[str], List[str], np.ndarray, np.ndarray]:
+    """
+    Monthly rollup pivoted into the same shape as
+    `TransactionFrame.monthly_sum_by_type` / `monthly_count_by_type`
+
+    Returns:
+        months, types, sums of shape (len(types), len(months)), counts of same shape
+    """
+    rows = monthly_rollup(provider=provider, db_path=db_path)
+    months = sorted({row["txn_month"] for row in rows})
+    types = sorted({row["txn_type"] for row in rows})
+    month_idx = {month: i for i, month in enumerate(months)}
+    type_idx = {txn_type: i for i, txn_type in enumerate(types)}
+
+    sums = np.zeros((len(types), len(months)))
+    counts = np.zeros((len(types), len(months)), dtype=np.int64)
+    for row in rows:
+        i, j = type_idx[row["txn_type"]], month_idx[row["txn_month"]]
+        sums[i, j] += row["total"]
+        counts[i, j] += row["count"]
+    return months, types, sums, counts
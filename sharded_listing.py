@@ -0,0 +1,160 @@
+import datetime
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Tuple
+
+from rich import print
+
+from gmail_helpers import EstimateResultSize, ListMessagesMatchingQuery, date_query
+from instrumentation import METRICS
+
+# no Gmail message is older than Gmail itself
+GMAIL_EPOCH = datetime.date(2004, 4, 1)
+DEFAULT_LIST_WORKERS = 8
+# a window is listed as a whole once Gmail estimates at most this many results
+DEFAULT_MAX_PER_WINDOW = 2000
+# requests per window estimate or listing before it fails
+ESTIMATE_ATTEMPTS = 3
+
+Window = Tuple[datetime.date, datetime.date]
+
+
+def _as_date(value, default: datetime.date) -> datetime.date:
+    if not value:
+        return default
+    return datetime.date.fromisoformat(str(value))
+
+
+def _window_query(query: str, window: Window) -> str:
+    return f"{query} {date_query(*window)}".strip()
+
+
+def _per_thread(service_factory: Callable) -> Callable:
+    """Gmail API service objects are not thread-safe: one service per thread"""
+    local = threading.local()
+
+    def get_service():
+        if not hasattr(local, "service"):
+            local.service = service_factory()
+        return local.service
+
+    return get_service
+
+
+def _with_retries(request: Callable, what: str):
+    """
+    Run `request` until it returns a result, backing off between attempts
+
+    Raises:
+        RuntimeError: if `request` still returned None after
+            `ESTIMATE_ATTEMPTS` attempts
+    """
+    for attempt in range(ESTIMATE_ATTEMPTS):
+        result = request()
+        if result is not None:
+            return result
+        if attempt + 1 < ESTIMATE_ATTEMPTS:
+            time.sleep(2**attempt)
+    raise RuntimeError(f"{what} failed")
+
+
+def plan_windows(
+    get_service: Callable,
+    query: str,
+    start: datetime.date,
+    end: datetime.date,
+    executor: ThreadPoolExecutor,
+    max_per_window: int = DEFAULT_MAX_PER_WINDOW,
+) -> List[Window]:
+    """
+    Split [start, end) into date windows of at most about `max_per_window`
+    messages each, bisecting the windows Gmail estimates to be larger.
+    Each level of the bisection is estimated concurrently. The estimates are
+    approximate, so windows estimated empty are kept: listing them costs one
+    request and cannot lose messages.
+
+    Returns:
+        Non-overlapping (after, before) windows, newest first
+
+    Raises:
+        RuntimeError: if a window could not be estimated after
+            `ESTIMATE_ATTEMPTS` requests
+    """
+
+    def estimate(window: Window) -> int:
+        return _with_retries(
+            lambda: EstimateResultSize(
+                get_service(), "me", _window_query(query, window)
+            ),
+            f"Estimating window {window}",
+        )
+
+    planned = []
+    pending = [(start, end)]
+    while pending:
+        estimates = list(executor.map(estimate, pending))
+        next_level = []
+        for (after, before), n in zip(pending, estimates):
+            days = (before - after).days
+            if n <= max_per_window or days <= 1:
+                planned.append((after, before))
+            else:
+                middle = after + datetime.timedelta(days=days // 2)
+                next_level += [(after, middle), (middle, before)]
+        pending = next_level
+    planned.sort(reverse=True)
+    return planned
+
+
+def list_msg_ids_sharded(
+    service_factory: Callable,
+    query: str,
+    after=None,
+    before=None,
+    max_workers: int = DEFAULT_LIST_WORKERS,
+    max_per_window: int = DEFAULT_MAX_PER_WINDOW,
+) -> List[str]:
+    """
+    List all messages matching `query` by listing date windows concurrently
+
+    Args:
+        service_factory: returns a new authorized Gmail API service
+        query: Gmail search query, e.g. "from:no-reply@grab.com"
+        after: first date to list ("YYYY-MM-DD"), defaults to the Gmail launch
+        before: date to list up to, exclusive, defaults to just after today
+        max_workers: number of concurrent listing threads
+        max_per_window: target number of messages per window
+
+    Returns:
+        Deduplicated message ids, newest window first
+
+    Raises:
+        RuntimeError: if a window could not be estimated or listed after
+            `ESTIMATE_ATTEMPTS` requests
+    """
+    start = _as_date(after, GMAIL_EPOCH)
+    end = _as_date(before, datetime.date.today() + datetime.timedelta(days=2))
+    get_service = _per_thread(service_factory)
+
+    def list_window(window: Window) -> List[str]:
+        messages = _with_retries(
+            lambda: ListMessagesMatchingQuery(
+                get_service(), user_id="me", query=_window_query(query, window)
+            ),
+            f"Listing window {window}",
+        )
+        return [m["id"] for m in messages]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        with METRICS.timer("plan_windows"):
+            windows = plan_windows(
+                get_service, query, start, end, executor, max_per_window
+            )
+        results = list(executor.map(list_window, windows))
+
+    # Gmail dates are resolved in the mailbox time zone, so a message may
+    # appear in two adjacent windows
+    msg_ids = list(dict.fromkeys(msg_id for ids in results for msg_id in ids))
+    print(f"Listed {len(msg_ids)} messages in {len(windows)} date windows")
+    return msg_ids
@@ -0,0 +1,169 @@
+import csv
+import heapq
+import json
+import os
+import tempfile
+from pathlib import Path
+from typing import Callable, Iterable, Iterator
+
+from rich import print
+
+import codec
+from atomic_io import tmp_path_for
+from instrumentation import METRICS, instrument
+from ledger import OUTPUT_FIELDS
+from online_stats import SpendStatsEngine
+from txn_record import as_dict
+
+DEFAULT_BATCH_SIZE = 5000
+
+
+def _txn_date_key(txn: dict):
+    return txn.get("txn_date") or ""
+
+
+def _read_run(run_path: Path) -> Iterator[dict]:
+    with run_path.open("rb") as f:
+        for line in f:
+            yield codec.loads(line)
+
+
+def external_sort(
+    items: Iterable[dict],
+    key: Callable = _txn_date_key,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    tmp_dir: Path = None,
+) -> Iterator[dict]:
+    """
+    Sort an arbitrarily long stream of dicts while holding at most
+    `batch_size` of them in memory. Each full batch is sorted and spilled to a
+    temporary JSON Lines run, and the runs are lazily k-way merged.
+
+    Args:
+        items: iterable of JSON serializable dicts or `txn_record.Transaction`
+            records (spilled as dicts)
+        key: sort key function
+        batch_size: maximum number of items held in memory at once
+        tmp_dir: directory for the temporary runs, defaults to the system temp dir
+
+    Yields:
+        The items in sorted order (stable for equal keys)
+    """
+    with tempfile.TemporaryDirectory(dir=tmp_dir, prefix="sort_runs_") as run_dir:
+        run_dir = Path(run_dir)
+        run_paths = []
+        batch = []
+
+        def _spill():
+            batch.sort(key=key)
+            run_path = run_dir / f"run_{len(run_paths):05d}.jsonl"
+            with run_path.open("wb") as f:
+                for item in batch:
+                    # compact single-line JSON, one item per line
+                    f.write(codec.dumps(as_dict(item), "json-fast") + b"\n")
+            run_paths.append(run_path)
+            batch.clear()
+
+        for item in items:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                _spill()
+
+        if not run_paths:
+            # everything fits in a single batch, no need to touch the disk
+            batch.sort(key=key)
+            yield from batch
+            return
+
+        if batch:
+            _spill()
+        yield from heapq.merge(*[_read_run(p) for p in run_paths], key=key)
+
+
+class StreamingTransactionWriter:
+    """
+    Incrementally write transactions to master_<name>.json, .jsonl and .csv
+
+    The JSON array is written element by element so that the output is
+    identical in shape to the in-memory writers, without holding the full list.
+    """
+
+    def __init__(self, output_dir: Path, name: str, fieldnames=OUTPUT_FIELDS):
+        output_dir = Path(output_dir)
+        self.out_json = output_dir / f"master_{name}.json"
+        self.out_jsonl = output_dir / f"master_{name}.jsonl"
+        self.out_csv = output_dir / f"master_{name}.csv"
+        self.fieldnames = fieldnames
+        self.count = 0
+
+    def __enter__(self):
+        # written under temporary names and renamed on success, so a crash
+        # mid-run leaves the previous master files intact
+        self._paths = [self.out_json, self.out_jsonl, self.out_csv]
+        self._tmp_paths = [tmp_path_for(path) for path in self._paths]
+        self._json_f, self._jsonl_f, self._csv_f = [
+            path.open("w") for path in self._tmp_paths
+        ]
+        self._csv_writer = csv.DictWriter(self._csv_f, fieldnames=self.fieldnames)
+        self._csv_writer.writeheader()
+        self._json_f.write("[")
+        return self
+
+    def write(self, txn: dict):
+        txn = as_dict(txn)
+        item = json.dumps(txn, indent=4).replace("\n", "\n    ")
+        self._json_f.write(("," if self.count else "") + "\n    " + item)
+        self._jsonl_f.write(json.dumps(txn) + "\n")
+        self._csv_writer.writerow(txn)
+        self.count += 1
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._json_f.write("\n]" if self.count else "]")
+        for f in (self._json_f, self._jsonl_f, self._csv_f):
+            f.close()
+        for tmp_path, path in zip(self._tmp_paths, self._paths):
+            if exc_type is None:
+                os.replace(tmp_path, path)
+            else:
+                tmp_path.unlink(missing_ok=True)
+        return False
+
+
+@instrument("stream_master_outputs")
+def stream_master_outputs(
+    transactions: Iterable[dict],
+    output_dir: Path,
+    provider: str,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+):
+    """
+    Sort the parsed transactions by date with bounded memory, then write them
+    to the master JSON / JSON Lines / CSV files and the ledger in one pass.
+
+    Args:
+        transactions: iterable of transaction dicts, e.g. a parser generator
+        output_dir: directory of the master files and the ledger
+        provider: provider name, used for the file names and the ledger
+        batch_size: maximum number of transactions held in memory at once
+    """
+    output_dir = Path(output_dir)
+    sorted_txns = external_sort(
+        transactions, key=_txn_date_key, batch_size=batch_size, tmp_dir=output_dir
+    )
+
+    with StreamingTransactionWriter(output_dir, provider) as writer:
+
+        def _written():
+            for txn in sorted_txns:
+                writer.write(txn)
+                yield txn
+
+        spend_stats = SpendStatsEngine.for_ledger(output_dir)
+        inserted = spend_stats.sync_provider(provider, _written(), output_dir)
+        spend_stats.save(output_dir)
+
+    METRICS.inc("transactions_written", writer.count)
+    print(f"Saved {writer.count} transactions to {writer.out_json}")
+    print(f"Saved {writer.count} transactions to {writer.out_jsonl}")
+    print(f"Saved {writer.count} transactions to {writer.out_csv}")
+    print(f"Added {inserted} new transactions to the ledger")
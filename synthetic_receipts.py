@@ -0,0 +1,174 @@
+import base64
+import datetime
+import random
+from typing import List
+
+MERCHANTS = [
+    "KOUFU PTE LTD",
+    "STARBUCKS COFFEE",
+    "NTUC FAIRPRICE CO-OPERATIVE LTD",
+    "SHENG SIONG SUPERMARKET",
+    "MR BEAN INTERNATIONAL",
+    "YA KUN KAYA TOAST",
+    "OLD CHANG KEE",
+    "GUARDIAN HEALTH & BEAUTY",
+]
+
+# inline marketing CSS, similar in bulk to what real receipts carry
+_STYLE_BLOCK = "\n".join(
+    f".c{i} {{ font-family: Helvetica, Arial, sans-serif; color: #{i * 99991 % 0xFFFFFF:06x}; "
+    f"padding: {i % 7}px {i % 5}px; line-height: 1.{i % 9}; }}"
+    for i in range(120)
+)
+_TRACKING_PIXEL = '<img src="https://t.example.com/open?id={0}" width="1" height="1" alt="" style="display:none">'
+
+
+def _random_date(rnd: random.Random) -> datetime.datetime:
+    start = datetime.datetime(2021, 1, 1)
+    return start + datetime.timedelta(minutes=rnd.randrange(3 * 365 * 24 * 60))
+
+
+def _marketing_rows(rnd: random.Random, n: int) -> str:
+    rows = []
+    for i in range(n):
+        rows.append(
+            f'<tr><td class="c{rnd.randrange(120)}" style="padding:4px;border:0">'
+            f'<a href="https://example.com/promo/{rnd.randrange(10**6)}" style="color:#00b14f">'
+            f"Promo {i}: save more on your next order</a></td></tr>"
+        )
+    return "\n".join(rows)
+
+
+def paylah_html(rnd: random.Random, malformed: bool = False) -> str:
+    dt = _random_date(rnd)
+    amount = rnd.uniform(1, 120)
+    rows = [
+        ("Date &amp; Time:", dt.strftime("%d %b %H:%M (SGT)")),
+        ("Amount:", f"SGD{amount:.2f}"),
+        ("From:", "PayLah! Wallet (Mobile ending 0920)"),
+        ("To:", rnd.choice(MERCHANTS)),
+    ]
+    if malformed:
+        rows = rows[: rnd.randrange(1, 4)]
+    table = "\n".join(
+        f'<tr><td style="font-weight:bold">{k}</td><td style="padding:2px">{v}</td></tr>'
+        for k, v in rows
+    )
+    html = f"""<html><head><style>{_STYLE_BLOCK}</style></head><body>
+<table width="100%"><tr><td>Dear Customer,</td></tr>
+<tr><td>We refer to your PayLah! transaction. Transaction Ref: TR{rnd.randrange(10**9):09d}</td></tr></table>
+<table><tbody>
+{table}
+</tbody></table>
+{_TRACKING_PIXEL.format(rnd.randrange(10**9))}
+<p style="font-size:10px">This is a system generated email, please do not reply.</p>
+</body></html>"""
+    return html[: len(html) // 2] if malformed and rnd.random() < 0.5 else html
+
+
+def fave_html(rnd: random.Random, malformed: bool = False) -> str:
+    dt = _random_date(rnd)
+    amount = rnd.uniform(2, 80)
+    paragraphs = [
+        "Thanks for paying with FavePay!",
+        "Receipt ID",
+        f"FP{rnd.randrange(10**8):08d}",
+        "Where",
+        rnd.choice(MERCHANTS),
+        dt.strftime("%d %b %Y, %I:%M%p"),
+        "Total",
+        f"S${amount:.2f}",
+    ]
+    if malformed:
+        paragraphs = paragraphs[: rnd.randrange(2, 7)]
+    body = "\n".join(
+        f'<p class="c{rnd.randrange(120)}" style="margin:0">{p}</p>' for p in paragraphs
+    )
+    return f"""<html><head><style>{_STYLE_BLOCK}</style></head><body>
+<div>{body}</div>
+<table>{_marketing_rows(rnd, 20)}</table>
+{_TRACKING_PIXEL.format(rnd.randrange(10**9))}
+</body></html>"""
+
+
+def grab_html(rnd: random.Random, malformed: bool = False) -> str:
+    kind = rnd.choice(["ride", "food"])
+    amount = rnd.uniform(4, 60)
+    currency = rnd.choice(["S$", "S$", "S$", "SGD", "RM"])
+    headline = "Hope you enjoyed your ride!" if kind == "ride" else "Your food order"
+    items = "\n".join(
+        f'<tr><td style="padding:4px">{rnd.randrange(1, 4)}x Item {i}</td>'
+        f'<td style="text-align:right">{currency} {rnd.uniform(1, 15):.2f}</td></tr>'
+        for i in range(rnd.randrange(1, 6))
+    )
+    total = (
+        ""
+        if malformed
+        else f'<tr><td><strong>TOTAL</strong></td></tr><tr><td style="font-size:20px">{currency} {amount:.2f}</td></tr>'
+    )
+    return f"""<!DOCTYPE html><html><head><meta charset="utf-8"><style>{_STYLE_BLOCK}</style>
+<script>window.dataLayer = window.dataLayer || [];</script></head><body style="margin:0">
+<!-- header -->
+<table width="600" align="center" style="background:#fff">
+<tr><td class="c1" style="font-size:18px">{headline}</td></tr>
+{total}
+{items}
+{_marketing_rows(rnd, 60)}
+</table>
+{_TRACKING_PIXEL.format(rnd.randrange(10**9))}
+</body></html>"""
+
+
+GENERATORS = {"paylah": paylah_html, "fave": fave_html, "grab": grab_html}
+
+
+def make_corpus(
+    provider: str, n: int, malformed_ratio: float = 0.05, seed: int = 0
+) -> List[str]:
+    """
+    Generate `n` synthetic receipt HTML bodies for a provider
+
+    Args:
+        provider: "paylah", "fave" or "grab"
+        n: number of receipts
+        malformed_ratio: fraction of receipts that are truncated or missing fields
+        seed: random seed, the corpus is deterministic for a given seed
+    """
+    rnd = random.Random(f"{provider}-{seed}")
+    generate = GENERATORS[provider]
+    return [generate(rnd, malformed=rnd.random() < malformed_ratio) for _ in range(n)]
+
+
+def _b64(s: str) -> str:
+    return base64.urlsafe_b64encode(s.encode("utf-8")).decode("ascii")
+
+
+def make_gmail_message(html: str, msg_id: str, multipart: bool = False) -> dict:
+    """
+    Wrap an HTML body into a Gmail API message dict, optionally as a nested
+    multipart/alternative payload with a text/plain part
+    """
+    if multipart:
+        payload = {
+            "mimeType": "multipart/mixed",
+            "parts": [
+                {
+                    "mimeType": "multipart/alternative",
+                    "parts": [
+                        {"mimeType": "text/plain", "body": {"data": _b64("receipt")}},
+                        {"mimeType": "text/html", "body": {"data": _b64(html)}},
+                    ],
+                }
+            ],
+        }
+    else:
+        payload = {"mimeType": "text/html", "body": {"data": _b64(html)}}
+    payload["headers"] = [{"name": "Subject", "value": "Transaction Alerts"}]
+    return {
+        "id": msg_id,
+        "threadId": msg_id,
+        "labelIds": ["INBOX"],
+        "internalDate": "1672531200000",
+        "sizeEstimate": len(html),
+        "payload": payload,
+    }
@@ -0,0 +1,200 @@
+import csv
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+import codec
+from ledger import connect_ledger_readonly, ledger_version, query_transactions
+
+
+class TransactionFrame:
+    """
+    Load-once, columnar view of a list of transactions.
+
+    Every column is a NumPy array of equal length. Categorical columns
+    (txn_type, txn_to, txn_category, provider) are stored as integer codes into a sorted list
+    of labels, and dates are additionally encoded as integer month codes
+    (year * 12 + month - 1) so that group-bys become a single `np.bincount`.
+    """
+
+    def __init__(self, transactions: List[dict]):
+        n = len(transactions)
+        self.txn_ids = np.array([t.get("txn_id") for t in transactions], dtype=object)
+        self.txn_times = np.array(
+            [t.get("txn_time") for t in transactions], dtype=object
+        )
+        self.txn_froms = np.array(
+            [t.get("txn_from") for t in transactions], dtype=object
+        )
+        self.amounts = np.fromiter(
+            (float(t.get("txn_amount") or 0) for t in transactions),
+            dtype=np.float64,
+            count=n,
+        )
+        self.dates = np.array(
+            [t.get("txn_date") or "NaT" for t in transactions], dtype="datetime64[D]"
+        )
+        self.has_date = ~np.isnat(self.dates)
+
+        months = self.dates.astype("datetime64[M]")
+        # integer month code: year * 12 + (month - 1), -1 for missing dates
+        self.month_codes = np.where(
+            self.has_date, months.astype(np.int64) + 1970 * 12, -1
+        )
+        self.day_codes = np.where(self.has_date, self.dates.astype(np.int64), -1)
+
+        self.types, self.type_codes = _encode(
+            [t.get("txn_type") or "" for t in transactions]
+        )
+        self.counterparties, self.to_codes = _encode(
+            [t.get("txn_to") or "" for t in transactions]
+        )
+        self.categories, self.category_codes = _encode(
+            [t.get("txn_category") or "" for t in transactions]
+        )
+        self.providers, self.provider_codes = _encode(
+            [t.get("provider") or "" for t in transactions]
+        )
+
+    def __len__(self):
+        return len(self.amounts)
+
+    ############# Constructors
+
+    @classmethod
+    def from_csv(cls, file_path) -> "TransactionFrame":
+        with open(file_path, newline="") as csvfile:
+            return cls(list(csv.DictReader(csvfile)))
+
+    @classmethod
+    def from_json(cls, file_path) -> "TransactionFrame":
+        return cls(codec.load(file_path))
+
+    @classmethod
+    def from_ledger(cls, provider: str = None, db_path=None) -> "TransactionFrame":
+        return cls(query_transactions(provider=provider, db_path=db_path))
+
+    ############# Group-by
+
+    def _grouped(self, codes: np.ndarray, labels: list, weights=None):
+        """
+        2-D group-by over (label, code) using one bincount.
+        Only codes present in the data are kept, in ascending order.
+        """
+        mask = codes >= 0
+        present, inverse = np.unique(codes[mask], return_inverse=True)
+        n_cols = len(present)
+        flat = self.type_codes[mask] * n_cols + inverse
+        w = None if weights is None else weights[mask]
+        table = np.bincount(flat, weights=w, minlength=len(labels) * n_cols)
+        return present, table.reshape(len(labels), n_cols)
+
+    def monthly_sum_by_type(self) -> Tuple[List[str], List[str], np.ndarray]:
+        """
+        Returns:
+            months: sorted "YYYY-MM" labels of all months with transactions
+            types: sorted txn_type labels
+            sums: array of shape (len(types), len(months))
+        """
+        present, sums = self._grouped(self.month_codes, self.types, self.amounts)
+        return month_labels(present), list(self.types), sums
+
+    def monthly_count_by_type(self) -> Tuple[List[str], List[str], np.ndarray]:
+        present, counts = self._grouped(self.month_codes, self.types)
+        return month_labels(present), list(self.types), counts.astype(np.int64)
+
+    def daily_sum_by_type(self) -> Tuple[List[str], List[str], np.ndarray]:
+        present, sums = self._grouped(self.day_codes, self.types, self.amounts)
+        days = np.datetime_as_string(present.astype("datetime64[D]")).tolist()
+        return days, list(self.types), sums
+
+    def sum_by_type(self) -> Dict[str, float]:
+        sums = np.bincount(
+            self.type_codes, weights=self.amounts, minlength=len(self.types)
+        )
+        return dict(zip(self.types, sums.tolist()))
+
+    def sum_by_counterparty(self) -> Dict[str, float]:
+        sums = np.bincount(
+            self.to_codes, weights=self.amounts, minlength=len(self.counterparties)
+        )
+        return dict(zip(self.counterparties, sums.tolist()))
+
+    def sum_by_category(self) -> Dict[str, float]:
+        sums = np.bincount(
+            self.category_codes, weights=self.amounts, minlength=len(self.categories)
+        )
+        return dict(zip(self.categories, sums.tolist()))
+
+    def row(self, i: int) -> dict:
+        """Materialize a single row as a transaction dict"""
+        return {
+            "txn_type": self.types[self.type_codes[i]],
+            "txn_id": self.txn_ids[i],
+            "txn_date": str(self.dates[i]) if self.has_date[i] else None,
+            "txn_time": self.txn_times[i],
+            "txn_amount": f"{self.amounts[i]:.2f}",
+            "txn_from": self.txn_froms[i],
+            "txn_to": self.counterparties[self.to_codes[i]],
+            "txn_category": self.categories[self.category_codes[i]],
+        }
+
+
+def _encode(values: List[str]):
+    labels, codes = np.unique(np.array(values, dtype=object), return_inverse=True)
+    return labels.tolist(), codes.astype(np.int64)
+
+
+def month_labels(month_codes: np.ndarray) -> List[str]:
+    return [f"{code // 12:04d}-{code % 12 + 1:02d}" for code in month_codes.tolist()]
+
+
+def series(labels: List[str], table: np.ndarray, label: str) -> np.ndarray:
+    """Row of a grouped table for `label`, or zeros if the label is absent"""
+    if label in labels:
+        return table[labels.index(label)]
+    return np.zeros(table.shape[1])
+
+
+_FRAME_CACHE: Dict[tuple, TransactionFrame] = {}
+
+
+def load_frame(file_path, provider: str = None) -> TransactionFrame:
+    """
+    Load a TransactionFrame from a master CSV/JSON file or the ledger database.
+    Frames are cached per file and invalidated when the file changes, so
+    repeated analysis calls in one process only parse the file once. Ledger
+    frames are keyed on `ledger_version`, since committed syncs can sit in the
+    WAL file without touching ledger.db itself.
+
+    Args:
+        file_path: path to master_*.csv, master_*.json or ledger.db
+        provider: provider to select when reading from the ledger
+    """
+    file_path = Path(file_path)
+    if file_path.suffix == ".db":
+        conn = connect_ledger_readonly(file_path)
+        try:
+            cache_key = (str(file_path.resolve()), provider, ledger_version(conn))
+        finally:
+            conn.close()
+    else:
+        stat = file_path.stat()
+        cache_key = (str(file_path.resolve()), provider, stat.st_mtime_ns, stat.st_size)
+    frame = _FRAME_CACHE.get(cache_key)
+    if frame is not None:
+        return frame
+
+    if file_path.suffix == ".db":
+        frame = TransactionFrame.from_ledger(provider=provider, db_path=file_path)
+    elif file_path.suffix == ".json":
+        frame = TransactionFrame.from_json(file_path)
+    else:
+        frame = TransactionFrame.from_csv(file_path)
+
+    # drop outdated frames of the same source
+    for key in [k for k in _FRAME_CACHE if k[:2] == cache_key[:2]]:
+        del _FRAME_CACHE[key]
+    _FRAME_CACHE[cache_key] = frame
+    return frame
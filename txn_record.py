@@ -0,0 +1,216 @@
+import datetime
+import sys
+from typing import KeysView, List, Optional, Union
+
+from ledger import OUTPUT_FIELDS
+
+# fields that can also be read and set by name, like the keys of a transaction dict
+FIELDS = frozenset(["provider"] + OUTPUT_FIELDS)
+# ordered and set-like, like the keys of a dict
+_OUTPUT_KEYS = dict.fromkeys(OUTPUT_FIELDS).keys()
+# strings shared by many transactions, stored once with `sys.intern`
+INTERNED_FIELDS = frozenset(
+    ["provider", "txn_type", "txn_time", "txn_from", "txn_to", "txn_category"]
+)
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def format_cents(cents: int) -> str:
+    """12345 -> "123.45", exactly (no float rounding)"""
+    sign = "-" if cents < 0 else ""
+    units, hundredths = divmod(abs(cents), 100)
+    return f"{sign}{units}.{hundredths:02d}"
+
+
+class Transaction:
+    """
+    Compact record of one parsed transaction, shared by all parsers
+
+    The amount is stored as integer cents and the date as a proleptic
+    Gregorian ordinal (0 if there is no date). Provider, type, time,
+    counterparties and category are interned, so the same merchant is one
+    string however many transactions it has. With `__slots__` and no
+    per-instance dict, a record takes about a third of the memory of the
+    equivalent transaction dict.
+
+    `txn_amount` and `txn_date` read and write the same strings as the
+    parsers always produced ("12.30", "2023-01-31"). A value that is not in
+    that canonical form (e.g. "1,234.50") is kept verbatim as well, so
+    outputs and ledger keys (`ledger.txn_key`) are unchanged.
+
+    For the code written against transaction dicts, fields can also be read
+    and set by name (`txn["txn_to"]`, `txn.get("txn_to")`), and `keys()`
+    lists the output fields, so `csv.DictWriter` and `dict(txn)` work too.
+    """
+
+    __slots__ = (
+        "provider",
+        "txn_type",
+        "txn_id",
+        "date_ordinal",
+        "txn_time",
+        "cents",
+        "txn_from",
+        "txn_to",
+        "txn_category",
+        "_date_text",
+        "_amount_text",
+    )
+
+    def __init__(
+        self,
+        txn_type: str = None,
+        txn_id: str = None,
+        txn_date: Union[str, datetime.date, None] = None,
+        txn_time: str = None,
+        txn_amount: Union[str, float, None] = None,
+        txn_from: str = None,
+        txn_to: str = None,
+        txn_category: str = None,
+        provider: str = None,
+    ):
+        self.provider = _intern(provider)
+        self.txn_type = _intern(txn_type)
+        self.txn_id = txn_id
+        self.txn_date = txn_date
+        self.txn_time = _intern(txn_time)
+        self.txn_amount = txn_amount
+        self.txn_from = _intern(txn_from)
+        self.txn_to = _intern(txn_to)
+        self.txn_category = _intern(txn_category)
+
+    @classmethod
+    def from_dict(cls, data: dict, provider: str = None) -> "Transaction":
+        """Record of a transaction dict (master file, ledger row, parser output)"""
+        return cls(
+            **{field: data.get(field) for field in OUTPUT_FIELDS},
+            provider=provider or data.get("provider"),
+        )
+
+    ############# Typed fields
+
+    @property
+    def txn_date(self) -> Optional[str]:
+        if self._date_text is not None:
+            return self._date_text
+        if not self.date_ordinal:
+            return None
+        return datetime.date.fromordinal(self.date_ordinal).isoformat()
+
+    @txn_date.setter
+    def txn_date(self, value: Union[str, datetime.date, None]):
+        self._date_text = None
+        self.date_ordinal = 0
+        if value is None:
+            return
+        if isinstance(value, datetime.date):
+            self.date_ordinal = value.toordinal()
+            return
+        try:
+            date = datetime.date.fromisoformat(value)
+            self.date_ordinal = date.toordinal()
+            if date.isoformat() == value:
+                return
+        except (TypeError, ValueError):
+            pass
+        self._date_text = value
+
+    @property
+    def txn_amount(self) -> Optional[str]:
+        if self._amount_text is not None:
+            return self._amount_text
+        if self.cents is None:
+            return None
+        return format_cents(self.cents)
+
+    @txn_amount.setter
+    def txn_amount(self, value: Union[str, float, None]):
+        self._amount_text = None
+        self.cents = None
+        if value is None:
+            return
+        if isinstance(value, (int, float)):
+            # e.g. the REAL amounts of the ledger
+            self.cents = round(value * 100)
+            return
+        try:
+            self.cents = round(float(value.replace(",", "")) * 100)
+            if format_cents(self.cents) == value:
+                return
+        except (AttributeError, ValueError):
+            pass
+        self._amount_text = value
+
+    @property
+    def amount(self) -> float:
+        """Amount as a number, 0 if unknown"""
+        return (self.cents or 0) / 100
+
+    ############# Conversions
+
+    def to_dict(self) -> dict:
+        """The transaction dict of the master files (without the provider)"""
+        return {
+            "txn_type": self.txn_type,
+            "txn_id": self.txn_id,
+            "txn_date": self.txn_date,
+            "txn_time": self.txn_time,
+            "txn_amount": self.txn_amount,
+            "txn_from": self.txn_from,
+            "txn_to": self.txn_to,
+            "txn_category": self.txn_category,
+        }
+
+    def to_row(self, fieldnames: List[str] = OUTPUT_FIELDS) -> list:
+        """Values of `fieldnames`, for `csv.writer`"""
+        return [getattr(self, field) for field in fieldnames]
+
+    ############# Dict compatibility
+
+    def get(self, field: str, default=None):
+        if field not in FIELDS:
+            return default
+        return getattr(self, field)
+
+    def __getitem__(self, field: str):
+        if field not in FIELDS:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def __setitem__(self, field: str, value):
+        if field not in FIELDS:
+            raise KeyError(field)
+        setattr(self, field, _intern(value) if field in INTERNED_FIELDS else value)
+
+    def __contains__(self, field: str) -> bool:
+        return field in FIELDS
+
+    def keys(self) -> KeysView[str]:
+        return _OUTPUT_KEYS
+
+    ############# Comparison
+
+    def _values(self) -> tuple:
+        return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Transaction):
+            return NotImplemented
+        return self._values() == other._values()
+
+    # mutable: not hashable
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return (
+            f"Transaction({self.provider!r}, {self.txn_type!r}, {self.txn_date!r}, "
+            f"{self.txn_amount!r}, to={self.txn_to!r})"
+        )
+
+
+def as_dict(txn: Union[Transaction, dict]) -> dict:
+    """A transaction dict, whether `txn` is a record or already a dict"""
+    return txn.to_dict() if isinstance(txn, Transaction) else txn
@@ -0,0 +1,401 @@
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import sqlite3
+import time
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from rich import print
+
+from export_journal import ExportJournal
+from gmail_export import all_msg_ids_from_sender, export_message, prefilter_msg_ids
+from gmail_helpers import get_gmail_service
+from instrumentation import METRICS
+from memory_budget import MEMORY, parse_kwargs_for_budget
+from providers import PROVIDERS
+
+OUTPUT_DIR = Path("output")
+QUEUE_FILENAME = "work_queue.db"
+DEFAULT_CHUNK_SIZE = 200
+DEFAULT_LEASE_SECONDS = 300
+DEFAULT_MAX_ATTEMPTS = 5
+
+QUEUE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    task_id         INTEGER PRIMARY KEY AUTOINCREMENT,
+    msg_ids         TEXT NOT NULL,
+    status          TEXT NOT NULL DEFAULT 'pending',
+    worker          TEXT,
+    lease_expires   REAL,
+    attempts        INTEGER NOT NULL DEFAULT 0,
+    done            INTEGER NOT NULL DEFAULT 0,
+    error           TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks (status, lease_expires);
+CREATE TABLE IF NOT EXISTS queued_messages (
+    msg_id          TEXT PRIMARY KEY,
+    task_id         INTEGER NOT NULL
+);
+"""
+
+
+def queue_path(provider_name: str, output_dir: Path = OUTPUT_DIR) -> Path:
+    return Path(output_dir) / provider_name / QUEUE_FILENAME
+
+
+def connect_queue(db_path: Path) -> sqlite3.Connection:
+    """
+    Open the queue database. Transactions are explicit (`BEGIN IMMEDIATE`) so
+    that a claim is a single atomic read-modify-write across processes.
+
+    The database may be shared by several machines through a network file
+    system, so it uses a rollback journal: WAL needs shared memory between
+    the processes, i.e. a single host. Only file locks are needed.
+    """
+    db_path = Path(db_path)
+    db_path.parent.mkdir(exist_ok=True, parents=True)
+    conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    # also converts a queue created in WAL mode by an earlier version
+    conn.execute("PRAGMA journal_mode=DELETE")
+    conn.executescript(QUEUE_SCHEMA)
+    return conn
+
+
+def worker_name() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+############# Coordinator
+
+
+def enqueue_ranges(
+    conn: sqlite3.Connection, msg_ids: List[str], chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> int:
+    """
+    Split the listed message ids into tasks of `chunk_size` ids each.
+
+    Ids that were enqueued by an earlier run are skipped, so the coordinator
+    can be re-run after new emails arrive without redoing finished ranges.
+
+    Returns:
+        The number of new tasks
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        known = {row[0] for row in conn.execute("SELECT msg_id FROM queued_messages")}
+        new_ids = [msg_id for msg_id in msg_ids if msg_id not in known]
+        n_tasks = 0
+        for i in range(0, len(new_ids), chunk_size):
+            chunk = new_ids[i : i + chunk_size]
+            cursor = conn.execute(
+                "INSERT INTO tasks (msg_ids) VALUES (?)", (json.dumps(chunk),)
+            )
+            conn.executemany(
+                "INSERT INTO queued_messages VALUES (?, ?)",
+                [(msg_id, cursor.lastrowid) for msg_id in chunk],
+            )
+            n_tasks += 1
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    return n_tasks
+
+
+def requeue_expired(conn: sqlite3.Connection, max_attempts: int = DEFAULT_MAX_ATTEMPTS):
+    """Release leases whose worker stopped renewing them (crashed or hung)"""
+    now = time.time()
+    conn.execute(
+        "UPDATE tasks SET status = 'failed' "
+        "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+        (now, max_attempts),
+    )
+    cursor = conn.execute(
+        "UPDATE tasks SET status = 'pending', worker = NULL, lease_expires = NULL "
+        "WHERE status = 'leased' AND lease_expires < ?",
+        (now,),
+    )
+    return cursor.rowcount
+
+
+def queue_status(conn: sqlite3.Connection) -> dict:
+    status = {"pending": 0, "leased": 0, "done": 0, "failed": 0}
+    for row in conn.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status"):
+        status[row[0]] = row[1]
+    status["messages"] = conn.execute("SELECT COUNT(*) FROM queued_messages").fetchone()[0]
+    return status
+
+
+############# Worker
+
+
+def claim_task(
+    conn: sqlite3.Connection,
+    worker: str,
+    lease_seconds: float = DEFAULT_LEASE_SECONDS,
+    max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+) -> Optional[Tuple[int, List[str]]]:
+    """
+    Lease the oldest pending task to `worker`
+
+    Returns:
+        (task_id, msg_ids), or None if there is nothing left to claim
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        requeue_expired(conn, max_attempts=max_attempts)
+        row = conn.execute(
+            "SELECT task_id, msg_ids FROM tasks WHERE status = 'pending' "
+            "ORDER BY task_id LIMIT 1"
+        ).fetchone()
+        if row is not None:
+            conn.execute(
+                "UPDATE tasks SET status = 'leased', worker = ?, lease_expires = ?, "
+                "attempts = attempts + 1 WHERE task_id = ?",
+                (worker, time.time() + lease_seconds, row["task_id"]),
+            )
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    if row is None:
+        return None
+    return row["task_id"], json.loads(row["msg_ids"])
+
+
+def renew_lease(
+    conn: sqlite3.Connection,
+    task_id: int,
+    worker: str,
+    done: int,
+    lease_seconds: float = DEFAULT_LEASE_SECONDS,
+) -> bool:
+    """
+    Extend the lease and record progress.
+
+    Returns:
+        False if the lease was lost (it expired and was re-queued), in which
+        case the worker should stop working on the task
+    """
+    cursor = conn.execute(
+        "UPDATE tasks SET lease_expires = ?, done = ? "
+        "WHERE task_id = ? AND worker = ? AND status = 'leased'",
+        (time.time() + lease_seconds, done, task_id, worker),
+    )
+    return cursor.rowcount == 1
+
+
+def finish_task(
+    conn: sqlite3.Connection,
+    task_id: int,
+    worker: str,
+    error: str = None,
+    max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+):
+    """
+    Mark a leased task done, or give it back to the queue on error (failed
+    for good after `max_attempts`). No-op if the lease was lost meanwhile.
+    """
+    if error is None:
+        status_sql = "'done'"
+    else:
+        status_sql = f"CASE WHEN attempts >= {int(max_attempts)} THEN 'failed' ELSE 'pending' END"
+    conn.execute(
+        f"UPDATE tasks SET status = {status_sql}, lease_expires = NULL, error = ? "
+        "WHERE task_id = ? AND worker = ? AND status = 'leased'",
+        (error, task_id, worker),
+    )
+
+
+def run_worker(
+    provider_name: str,
+    output_dir: Path = OUTPUT_DIR,
+    credentials_filepath: str = "credentials.json",
+    token_filepath: str = "token.json",
+    lease_seconds: float = DEFAULT_LEASE_SECONDS,
+    max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+    renew_every: int = 20,
+) -> dict:
+    """
+    Claim tasks until the queue is drained, exporting every message of each
+    claimed range into the shared provider directory.
+
+    Messages recorded in the shared export journal are skipped (see
+    `export_message`), so a range re-queued after a crash only fetches what
+    the crashed worker did not finish.
+
+    Returns:
+        Number of tasks and messages handled by this worker
+    """
+    output_dir = Path(output_dir)
+    out_dir = output_dir / provider_name
+    worker = worker_name()
+    conn = connect_queue(queue_path(provider_name, output_dir))
+    journal = ExportJournal(out_dir)
+    service = get_gmail_service(
+        scope_name="readonly",
+        credentials_filepath=credentials_filepath,
+        credentials_token_filepath=token_filepath,
+        force_new_token=False,
+    )
+
+    summary = {
+        "worker": worker,
+        "tasks": 0,
+        "cached": 0,
+        "fetched": 0,
+        "failed": 0,
+        "lost": 0,
+    }
+    while True:
+        claimed = claim_task(conn, worker, lease_seconds, max_attempts)
+        if claimed is None:
+            break
+        task_id, msg_ids = claimed
+        # pick up what other (possibly crashed) workers completed meanwhile
+        journal.refresh()
+        error = None
+        failed = 0
+        try:
+            for i, msg_id in enumerate(msg_ids, start=1):
+                result = export_message(
+                    service, msg_id=msg_id, out_dir=out_dir, journal=journal
+                )
+                summary[result] += 1
+                failed += result == "failed"
+                if i % renew_every == 0 and not renew_lease(
+                    conn, task_id, worker, i, lease_seconds
+                ):
+                    summary["lost"] += 1
+                    break
+            else:
+                if failed:
+                    # back to the queue: a retry only fetches the failed ones
+                    error = f"{failed} messages could not be fetched"
+                else:
+                    summary["tasks"] += 1
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            print(f"{provider_name}: task {task_id} failed on {worker}: {error}")
+        finish_task(conn, task_id, worker, error=error, max_attempts=max_attempts)
+    conn.close()
+    journal.close()
+    METRICS.inc("queue_tasks_done", summary["tasks"])
+    return summary
+
+
+def _worker_process(kwargs: dict) -> dict:
+    return run_worker(**kwargs)
+
+
+############# Entry points
+
+
+def coordinate(
+    provider_name: str,
+    output_dir: Path = OUTPUT_DIR,
+    credentials_filepath: str = "credentials.json",
+    token_filepath: str = "token.json",
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    list_workers: int = 1,
+) -> int:
+    """List the transaction emails of the provider and enqueue the new ones"""
+    provider = PROVIDERS[provider_name]
+
+    def service_factory():
+        return get_gmail_service(
+            scope_name="readonly",
+            credentials_filepath=credentials_filepath,
+            credentials_token_filepath=token_filepath,
+            force_new_token=False,
+        )
+
+    service = service_factory()
+    msg_ids = all_msg_ids_from_sender(
+        service=service,
+        sender=provider.sender,
+        extra_query=provider.gmail_query(),
+        list_workers=list_workers,
+        service_factory=service_factory,
+    )
+    conn = connect_queue(queue_path(provider_name, output_dir))
+    # only transaction emails are queued for a full fetch
+    known = {row[0] for row in conn.execute("SELECT msg_id FROM queued_messages")}
+    msg_ids = [msg_id for msg_id in msg_ids if msg_id not in known]
+    with ExportJournal(Path(output_dir) / provider_name) as journal:
+        msg_ids = prefilter_msg_ids(
+            service,
+            msg_ids,
+            Path(output_dir) / provider_name,
+            provider.is_transaction_subject,
+            journal=journal,
+        )
+    n_tasks = enqueue_ranges(conn, msg_ids, chunk_size=chunk_size)
+    print(f"{provider_name}: {len(msg_ids)} new messages, enqueued {n_tasks} new tasks")
+    print(queue_status(conn))
+    conn.close()
+    return n_tasks
+
+
+def run_workers(n_workers: int, **kwargs) -> List[dict]:
+    """Run `n_workers` worker processes on this machine until the queue is drained"""
+    with multiprocessing.Pool(n_workers) as pool:
+        return pool.map(_worker_process, [kwargs] * n_workers)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Split a large mailbox export across workers with a shared SQLite queue"
+    )
+    parser.add_argument("command", choices=["enqueue", "work", "status", "parse"])
+    parser.add_argument("provider", choices=list(PROVIDERS))
+    parser.add_argument("--output-dir", type=Path, default=OUTPUT_DIR)
+    parser.add_argument("--credentials", default="credentials.json")
+    parser.add_argument("--token", default="token.json")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--list-workers", type=int, default=1)
+    parser.add_argument("--lease-seconds", type=float, default=DEFAULT_LEASE_SECONDS)
+    parser.add_argument(
+        "--memory-budget", help='memory ceiling of the parse command, e.g. "512M"'
+    )
+    args = parser.parse_args()
+
+    if args.command == "enqueue":
+        coordinate(
+            args.provider,
+            output_dir=args.output_dir,
+            credentials_filepath=args.credentials,
+            token_filepath=args.token,
+            chunk_size=args.chunk_size,
+            list_workers=args.list_workers,
+        )
+    elif args.command == "work":
+        for summary in run_workers(
+            args.workers,
+            provider_name=args.provider,
+            output_dir=args.output_dir,
+            credentials_filepath=args.credentials,
+            token_filepath=args.token,
+            lease_seconds=args.lease_seconds,
+        ):
+            print(summary)
+    elif args.command == "status":
+        conn = connect_queue(queue_path(args.provider, args.output_dir))
+        print(queue_status(conn))
+    elif args.command == "parse":
+        if args.memory_budget:
+            MEMORY.start(args.memory_budget)
+        with MEMORY.stage("parse"):
+            PROVIDERS[args.provider].parse_main(
+                output_dir=args.output_dir,
+                **parse_kwargs_for_budget(
+                    args.memory_budget, args.output_dir / args.provider
+                ),
+            )
+        if args.memory_budget:
+            METRICS.write_reports(args.output_dir)